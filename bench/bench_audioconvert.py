@@ -0,0 +1,74 @@
+"""
+Compares the streaming NumPy converter with the original per chunk pydub conversion.
+
+Checks that converting a stream chunk by chunk gives the same bytes as a one shot conversion of the
+whole stream, then reports the throughput of both.  Needs pydub for the comparison (ffmpeg is not used).
+
+The two do not do the same work: pydub resamples with audioop.ratecv, linear interpolation without an anti
+aliasing filter or state between chunks, the NumPy converter runs a 31 tap low pass filter across chunk
+boundaries.  Both are over a thousand times realtime, the conversion is not where a turn spends its time.
+
+    python bench/bench_audioconvert.py
+"""
+import os
+import sys
+import time
+import numpy as np
+
+os.environ.setdefault('METRICS_EMF', 'false')
+os.environ.setdefault('METRICS_XRAY', 'off')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import audioconvert  # noqa: E402
+
+CHUNK_SIZE = 2048
+SECONDS = 10
+
+
+def synthetic_pcm(seconds=SECONDS, seed=1):
+    rng = np.random.default_rng(seed)
+    t = np.arange(audioconvert.ELEVEN_SAMPLE_RATE * seconds) / audioconvert.ELEVEN_SAMPLE_RATE
+    signal = 6000 * np.sin(2 * np.pi * 220 * t) + 2000 * np.sin(2 * np.pi * 1750 * t) + rng.normal(0, 400, len(t))
+    return signal.astype('<i2').tobytes()
+
+
+def chunks(pcm, size):
+    return [pcm[i:i + size] for i in range(0, len(pcm), size)]
+
+
+def stream_convert(pcm_chunks):
+    converter = audioconvert.PcmToMulawConverter()
+    return b''.join(converter.convert(chunk) for chunk in pcm_chunks) + converter.flush()
+
+
+def timed(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    pcm = synthetic_pcm()
+    one_shot = audioconvert.convert_eleven_pcm_to_twilio_mulaw(pcm)
+
+    # Odd sized chunks on purpose so chunks end in the middle of a sample
+    for size in (CHUNK_SIZE, 2047, 333, 1):
+        streamed = stream_convert(chunks(pcm, size))
+        assert streamed == one_shot, f"Streaming output differs from one shot conversion for chunk size {size}"
+    print(f"Streaming output matches one shot conversion ({len(one_shot)} µ-law bytes)")
+
+    pcm_chunks = chunks(pcm, CHUNK_SIZE)
+    numpy_seconds = timed(lambda: stream_convert(pcm_chunks))
+    pydub_seconds = timed(lambda: [audioconvert.convert_eleven_pcm_chunk_to_twilio_mulaw(c) for c in pcm_chunks])
+
+    for name, seconds in (('numpy streaming', numpy_seconds), ('pydub per chunk', pydub_seconds)):
+        print(f"{name:>16}: {len(pcm_chunks) / seconds:10.0f} chunks/s, {SECONDS / seconds:8.0f}x realtime")
+    print(f"NumPy throughput relative to pydub: {pydub_seconds / numpy_seconds:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
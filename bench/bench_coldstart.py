@@ -0,0 +1,129 @@
+"""
+Cold start benchmark for each Lambda entry path.
+
+Every path runs in a fresh interpreter: it imports lambda_function (the Lambda init phase), then the modules that
+path loads on its first event (lambda_function.ENTRY_PATH_MODULES).  For each phase it reports the import time,
+the SSM calls made and any other network connections attempted.  SSM is served by local_ssm with fake values and
+sockets are blocked, so nothing leaves the machine and a regression shows up as a non zero count.
+
+    python bench/bench_coldstart.py [--repeat 3] [--json]
+"""
+import os
+import ast
+import sys
+import json
+import argparse
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# Runs inside the fresh interpreter for one entry path
+_HARNESS = r'''
+import json, socket, sys, time, importlib
+sys.path.insert(0, {src_dir!r})
+
+network_calls = []
+
+def _blocked(*args, **kwargs):
+    network_calls.append(1)
+    raise OSError("network blocked by cold start benchmark")
+
+socket.socket.connect = _blocked
+socket.getaddrinfo = _blocked
+
+ssm = None
+
+def phase(fn):
+    ssm_before = sum(ssm.call_counts.values()) if ssm else 0
+    network_before = len(network_calls)
+    start = time.perf_counter()
+    error = None
+    try:
+        fn()
+    except Exception as e:
+        error = f"{{type(e).__name__}}: {{e}}"
+    return {{
+        'ms': round((time.perf_counter() - start) * 1000, 1),
+        'ssm_calls': sum(ssm.call_counts.values()) - ssm_before,
+        'network_calls': len(network_calls) - network_before,
+        'error': error,
+    }}
+
+def init():
+    global ssm
+    import utils
+    import local_ssm
+    ssm = local_ssm.LocalSSMClient({{name: 'cold-start-benchmark' for name in utils.KNOWN_PARAM_NAMES}})
+    utils.set_ssm_client(ssm)
+    importlib.import_module('lambda_function')
+
+result = {{'init': phase(init)}}
+modules = importlib.import_module('lambda_function').ENTRY_PATH_MODULES[{path!r}]
+result['route'] = phase(lambda: [importlib.import_module(module) for module in modules])
+print(json.dumps(result))
+'''
+
+
+def entry_paths():
+    """
+    Reads ENTRY_PATH_MODULES from lambda_function.py without importing it into this process.
+    """
+    with open(os.path.join(SRC_DIR, 'lambda_function.py')) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(getattr(t, 'id', None) == 'ENTRY_PATH_MODULES' for t in node.targets):
+            return ast.literal_eval(node.value)
+    raise ValueError("ENTRY_PATH_MODULES not found in lambda_function.py")
+
+
+def run_path(path):
+    env = {
+        **os.environ,
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        # Lambda provides credentials as environment variables, without them boto3 would query the metadata service
+        'AWS_ACCESS_KEY_ID': 'cold-start-benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'cold-start-benchmark',
+        'AWS_XRAY_CONTEXT_MISSING': 'IGNORE_ERROR',
+        'WARM_UP_ON_INIT': 'false',
+    }
+    env.pop('AWS_LAMBDA_INITIALIZATION_TYPE', None)
+    env.pop('SSM_LOCAL_PARAMS', None)
+    output = subprocess.run([sys.executable, '-c', _HARNESS.format(src_dir=SRC_DIR, path=path)],
+                            env=env, capture_output=True, text=True)
+    lines = [line for line in output.stdout.splitlines() if line.startswith('{"init"')]
+    if not lines:
+        raise RuntimeError(f"Entry path {path} failed: {output.stderr.strip()[-500:]}")
+    return json.loads(lines[-1])
+
+
+def measure(repeat=3):
+    """
+    Returns {path: {'init': {...}, 'route': {...}}} keeping the fastest of `repeat` fresh interpreters.
+    """
+    results = {}
+    for path in entry_paths():
+        runs = [run_path(path) for _ in range(repeat)]
+        results[path] = min(runs, key=lambda run: run['init']['ms'] + run['route']['ms'])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per path, fastest is reported')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = measure(args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'entry path':<18}{'phase':<7}{'import ms':>10}{'ssm calls':>11}{'network':>9}  error")
+    for path, phases in results.items():
+        for name, phase in phases.items():
+            print(f"{path:<18}{name:<7}{phase['ms']:>10}{phase['ssm_calls']:>11}{phase['network_calls']:>9}"
+                  f"  {phase['error'] or ''}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""
+Offline micro benchmarks for the hot paths of a call, compared against a saved baseline.
+
+Uses the fixtures in bench/fixtures (eleven labs PCM and Twilio webhook events), nothing touches the network.
+Each case reports one number, the best of --repeat runs:
+
+    convert_chunk            PCM chunks converted to µ-law per second (PcmToMulawConverter)
+    convert_to_frames        PCM chunks per second through the full conversion and framing generator
+    media_message_frame      160 byte frames per second turned into Twilio media messages
+    media_message_coalesced  coalesced 400 ms payloads per second turned into media messages
+    parse_<fixture>          microseconds per decode_and_parse_body call for each webhook fixture
+
+    python bench/bench_suite.py --save              # record a baseline for this machine
+    python bench/bench_suite.py                     # compare against it, exits 1 on a regression
+    python bench/bench_suite.py --threshold 0.1 --only convert
+
+The baseline (bench/baseline.json by default) is per machine.  Its "threshold" is the allowed relative slowdown
+for every case and "thresholds" overrides it per case, e.g. {"parse_twilio_respond_json": 0.3}.  Both are kept
+when the baseline is saved again.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import contextlib
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import fixtures  # noqa: E402
+import audioconvert  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+DEFAULT_THRESHOLD = 0.2
+MIN_RUN_SECONDS = 0.05  # each timed run loops the workload until it takes at least this long
+STREAM_SID = 'MZ00000000000000000000000000000000'
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Sends stdout (log lines, metric records) to /dev/null so printing still costs what it does in Lambda
+    without flooding the terminal.
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def best_seconds(fn, repeat):
+    """
+    Seconds for one call of fn, the best of `repeat` runs.  Like timeit, a run calls fn enough times to take at
+    least MIN_RUN_SECONDS so short workloads are not lost in timer noise.  The calibration doubles as a warm up.
+    """
+    with quiet():
+        loops = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(loops):
+                fn()
+            if time.perf_counter() - start >= MIN_RUN_SECONDS:
+                break
+            loops *= 2
+
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(loops):
+                fn()
+            elapsed = (time.perf_counter() - start) / loops
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_convert_chunk(repeat):
+    chunks = fixtures.pcm_chunks(fixtures.load_pcm())
+
+    def run():
+        converter = audioconvert.PcmToMulawConverter()
+        for chunk in chunks:
+            converter.convert(chunk)
+        converter.flush()
+
+    return len(chunks) / best_seconds(run, repeat), 'chunks/s', True
+
+
+def bench_convert_to_frames(repeat):
+    import websocket_handler
+    chunks = fixtures.pcm_chunks(fixtures.load_pcm())
+
+    def run():
+        for _ in websocket_handler.convert_to_frames(chunks, output_format='pcm_16000'):
+            pass
+
+    return len(chunks) / best_seconds(run, repeat), 'chunks/s', True
+
+
+def _mulaw_fixture():
+    return audioconvert.convert_eleven_pcm_to_twilio_mulaw(fixtures.load_pcm())
+
+
+def bench_media_message_frame(repeat):
+    import websocket_handler
+    mulaw = _mulaw_fixture()
+    frame_bytes = audioconvert.TWILIO_FRAME_BYTES
+    frames = [mulaw[i:i + frame_bytes] for i in range(0, len(mulaw) - frame_bytes + 1, frame_bytes)]
+    builder = websocket_handler.MediaMessageBuilder(STREAM_SID)
+
+    def run():
+        for frame in frames:
+            builder.build(frame)
+
+    return len(frames) / best_seconds(run, repeat), 'frames/s', True
+
+
+def bench_media_message_coalesced(repeat):
+    import websocket_handler
+    mulaw = _mulaw_fixture()
+    payload_bytes = 400 * audioconvert.TWILIO_SAMPLE_RATE // 1000
+    payloads = [mulaw[i:i + payload_bytes] for i in range(0, len(mulaw), payload_bytes)]
+    builder = websocket_handler.MediaMessageBuilder(STREAM_SID)
+
+    def run():
+        for payload in payloads:
+            builder.build(payload)
+
+    return len(payloads) / best_seconds(run, repeat), 'payloads/s', True
+
+
+def _parse_case(name):
+    def bench(repeat):
+        import http_handler
+        event = fixtures.load_webhook(name)
+        return best_seconds(lambda: http_handler.decode_and_parse_body(event), repeat) * 1e6, 'us/call', False
+
+    return bench
+
+
+CASES = {
+    'convert_chunk': bench_convert_chunk,
+    'convert_to_frames': bench_convert_to_frames,
+    'media_message_frame': bench_media_message_frame,
+    'media_message_coalesced': bench_media_message_coalesced,
+    **{f'parse_{name}': _parse_case(name) for name in fixtures.WEBHOOK_FIXTURES},
+}
+
+
+def run_cases(names, repeat):
+    results = {}
+    for name in names:
+        value, unit, higher_is_better = CASES[name](repeat)
+        results[name] = {'value': round(value, 3), 'unit': unit, 'higher_is_better': higher_is_better}
+    return results
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results, previous):
+    baseline = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'processor': platform.processor() or platform.machine()},
+        'threshold': (previous or {}).get('threshold', DEFAULT_THRESHOLD),
+        'thresholds': (previous or {}).get('thresholds', {}),
+        # Keep cases that were not run this time, e.g. with --only
+        'results': {**(previous or {}).get('results', {}), **results},
+    }
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2)
+        f.write('\n')
+
+
+def compare(results, baseline, threshold=None):
+    """
+    Returns one row per case: (name, baseline value, value, relative change, allowed slowdown, regressed).
+    The change is signed so that positive is always faster.
+    """
+    rows = []
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        allowed = threshold if threshold is not None else \
+            baseline.get('thresholds', {}).get(name, baseline.get('threshold', DEFAULT_THRESHOLD))
+        if base is None or not base['value']:
+            rows.append((name, None, result['value'], None, allowed, False))
+            continue
+        change = (result['value'] - base['value']) / base['value']
+        if not result['higher_is_better']:
+            change = -change
+        rows.append((name, base['value'], result['value'], change, allowed, change < -allowed))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline JSON file')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--threshold', type=float, help='allowed relative slowdown for every case, e.g. 0.2')
+    parser.add_argument('--only', help='run only the cases whose name contains this')
+    parser.add_argument('--repeat', type=int, default=7, help='runs per case, the best is reported')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    names = [name for name in CASES if not args.only or args.only in name]
+    results = run_cases(names, args.repeat)
+    baseline = load_baseline(args.baseline)
+
+    if args.save:
+        save_baseline(args.baseline, results, baseline)
+        print(f"Saved baseline {args.baseline}")
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+
+    rows = compare(results, baseline, args.threshold) if baseline and not args.save else None
+    print(f"{'case':<36}{'baseline':>12}{'now':>12}  {'unit':<11}{'change':>8}")
+    for name, result in results.items():
+        row = next((row for row in rows if row[0] == name), None) if rows else None
+        if row is None or row[1] is None:
+            print(f"{name:<36}{'':>12}{result['value']:>12.1f}  {result['unit']:<11}")
+            continue
+        _, base, value, change, allowed, regressed = row
+        flag = f"  REGRESSION (allowed -{allowed:.0%})" if regressed else ''
+        print(f"{name:<36}{base:>12.1f}{value:>12.1f}  {result['unit']:<11}{change:>+8.1%}{flag}")
+
+    if rows and any(row[5] for row in rows):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""
+Checks that a missed turn deadline plays the fallback audio, serially and with STREAM_PIPELINE.
+
+Text to speech and the streaming LLM are stand-ins that are slower than the deadline, so deadlines.hedged_stream
+raises DeadlineExceeded inside the audio stream.  For the text path and for ANSWER_STREAMING (LLM and TTS miss)
+every fallback frame must be posted before the mark.  Also checks that a source error part way through a stream
+still posts the frames converted before it.
+
+    python bench/deadline_fallback_check.py
+"""
+import os
+import sys
+import json
+import time
+import types
+import base64
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+_tmp = tempfile.mkdtemp(prefix='deadline_check_')
+with open(os.path.join(_tmp, 'ssm.json'), 'w') as f:
+    f.write('{}')
+FRAME = 160
+FALLBACK = bytes([0x42]) * FRAME * 12
+with open(os.path.join(_tmp, 'fallback.ulaw'), 'wb') as f:
+    f.write(FALLBACK)
+os.environ.update({
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'METRICS_EMF': 'false',
+    'METRICS_XRAY': 'off',
+    'SSM_LOCAL_PARAMS': os.path.join(_tmp, 'ssm.json'),
+    'AUDIO_CACHE_ENABLED': 'false',
+    'FILLERS_ENABLED': 'false',
+    'STREAM_COALESCE': 'false',
+    'DEADLINE_TTS_MIN_MS': '100',
+    'DEADLINE_FALLBACK_AUDIO': os.path.join(_tmp, 'fallback.ulaw'),
+})
+
+import deadlines  # noqa: E402
+
+SPEECH = bytes([0x10]) * FRAME
+SLOW_SECONDS = 0.6
+
+
+def install_fakes(tts_slow, llm_slow):
+    eleven = types.ModuleType('eleven')
+    eleven.OUTPUT_FORMAT = 'ulaw_8000'
+    eleven.TTS_PARALLEL_ENABLED = False
+    eleven.synthesis_params = lambda: {}
+
+    def audio():
+        if tts_slow:
+            time.sleep(SLOW_SECONDS)
+        for _ in range(5):
+            yield SPEECH
+
+    def say_stream(text, previous_text=None, next_text=None, deadline=None):
+        if deadline is not None:
+            return deadlines.hedged_stream(audio, deadline, stage='tts')
+        return audio()
+
+    eleven.say_stream = say_stream
+    sys.modules['eleven'] = eleven
+
+    query_lambda = types.ModuleType('query_lambda')
+
+    def stream_answer(question):
+        if llm_slow:
+            time.sleep(SLOW_SECONDS)
+        yield 'The library is open until ten tonight. '
+        yield 'Anything else?'
+
+    query_lambda.stream_answer = stream_answer
+    sys.modules['query_lambda'] = query_lambda
+
+
+def run(name, pipeline, speak):
+    import websocket_handler
+    websocket_handler.PIPELINE_ENABLED = pipeline
+    posted = []
+    websocket_handler.post_to_connection = lambda connection_id, message_str: posted.append(json.loads(message_str))
+    try:
+        speak(websocket_handler)
+    except Exception as e:
+        posted.append({'event': 'error', 'error': repr(e)})
+    media = b''.join(base64.b64decode(m['media']['payload']) for m in posted if m['event'] == 'media')
+    ok = FALLBACK in media and posted and posted[-1]['event'] == 'mark'
+    print(f"{'ok  ' if ok else 'FAIL'} {name}, pipeline {'on' if pipeline else 'off'}: "
+          f"{len(media) // FRAME} frames, last {posted[-1]['event'] if posted else None}")
+    return 0 if ok else 1
+
+
+def check_source_error(pipeline):
+    import websocket_handler
+    websocket_handler.PIPELINE_ENABLED = pipeline
+    posted = []
+    websocket_handler.post_to_connection = lambda connection_id, message_str: posted.append(message_str)
+
+    def failing():
+        for _ in range(6):
+            yield SPEECH
+        raise RuntimeError('connection reset')
+
+    try:
+        websocket_handler.stream_chunks('conn', websocket_handler.MediaMessageBuilder('MZ'), failing())
+        raised = False
+    except RuntimeError:
+        raised = True
+    ok = raised and len(posted) == 6
+    print(f"{'ok  ' if ok else 'FAIL'} source error, pipeline {'on' if pipeline else 'off'}: "
+          f"{len(posted)}/6 frames posted, error {'raised' if raised else 'lost'}")
+    return 0 if ok else 1
+
+
+def main():
+    failures = 0
+    for pipeline in (False, True):
+        install_fakes(tts_slow=True, llm_slow=False)
+        failures += run('text, TTS misses', pipeline, lambda wh: wh.stream_audio(
+            'MZ1', 'conn', 'Hello.', 'CA1', deadline=deadlines.Deadline(100)))
+        install_fakes(tts_slow=False, llm_slow=True)
+        failures += run('streaming answer, LLM misses', pipeline, lambda wh: wh.stream_answer_audio(
+            'MZ2', 'conn', 'Hours?', 'CA2', deadline=deadlines.Deadline(100)))
+        install_fakes(tts_slow=True, llm_slow=False)
+        failures += run('streaming answer, TTS misses', pipeline, lambda wh: wh.stream_answer_audio(
+            'MZ3', 'conn', 'Hours?', 'CA3', deadline=deadlines.Deadline(100)))
+        failures += check_source_error(pipeline)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
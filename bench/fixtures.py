@@ -0,0 +1,82 @@
+"""
+Offline fixtures for the benchmarks: eleven labs PCM audio and Twilio webhook events as the Lambda function URL
+delivers them (base64 encoded form posts, plus one JSON body), and a generated vector corpus.
+
+The PCM fixture is 16 kHz mono signed 16 bit little endian, the pcm_16000 format eleven labs streams.  The
+committed file is synthetic, voiced syllables with pauses between words, so it is reproducible.  To benchmark
+with a real TTS recording, save the raw response body of a stream request with output_format=pcm_16000 over it.
+
+    python bench/fixtures.py   # regenerates bench/fixtures/eleven_pcm_16000.raw
+"""
+import os
+import json
+import numpy as np
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+PCM_FIXTURE = os.path.join(FIXTURES_DIR, 'eleven_pcm_16000.raw')
+PCM_SAMPLE_RATE = 16000
+ELEVEN_CHUNK_BYTES = 2048  # stream_chunk_size eleven.say_stream asks for
+
+WEBHOOK_FIXTURES = (
+    'twilio_answer_ringing',
+    'twilio_answer_in_progress',
+    'twilio_respond_speech',
+    'twilio_respond_json',
+)
+
+
+def load_pcm():
+    with open(PCM_FIXTURE, 'rb') as f:
+        return f.read()
+
+
+def pcm_chunks(pcm, size=ELEVEN_CHUNK_BYTES):
+    """
+    Splits audio the way it arrives from the TTS stream.
+    """
+    return [pcm[i:i + size] for i in range(0, len(pcm), size)]
+
+
+def load_webhook(name):
+    with open(os.path.join(FIXTURES_DIR, f'{name}.json')) as f:
+        return json.load(f)
+
+
+def speech_like_pcm(seconds=4.0, seed=7):
+    """
+    Voiced syllables (a harmonic series with a wandering pitch) at about four per second with short pauses,
+    which exercises the resampler and µ-law encoder over the same level range as speech.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(PCM_SAMPLE_RATE * seconds)
+    t = np.arange(n) / PCM_SAMPLE_RATE
+    pitch = 140 + 30 * np.sin(2 * np.pi * 0.7 * t) + rng.normal(0, 2, n).cumsum() / 200
+    phase = 2 * np.pi * np.cumsum(pitch) / PCM_SAMPLE_RATE
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 12))
+
+    envelope = np.clip(np.sin(2 * np.pi * 4 * t), 0, None) ** 0.5
+    # Pause between words, roughly every third syllable
+    envelope *= (np.sin(2 * np.pi * 4 / 3 * t + 0.5) > -0.6)
+    signal = 9000 * envelope * voiced / 3 + rng.normal(0, 60, n)
+    return np.clip(signal, -32768, 32767).astype('<i2').tobytes()
+
+
+def vector_corpus(documents=300, dimensions=1536, topics=12, seed=11):
+    """
+    Rows like the PGVector collection holds, (page_content, metadata, embedding), clustered around a few topics
+    the way document chunks are, plus queries near those topics.  Returns (rows, queries).
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0, 1, (topics, dimensions))
+    topic_of = rng.integers(0, topics, documents)
+    embeddings = centers[topic_of] + rng.normal(0, 0.6, (documents, dimensions))
+    rows = [(f"Document {i} about topic {topic_of[i]}", {'source': f'doc-{i}.txt', 'topic': int(topic_of[i])},
+             embeddings[i].tolist()) for i in range(documents)]
+    queries = centers[rng.integers(0, topics, 50)] + rng.normal(0, 0.8, (50, dimensions))
+    return rows, queries
+
+
+if __name__ == '__main__':
+    with open(PCM_FIXTURE, 'wb') as f:
+        f.write(speech_like_pcm())
+    print(f"Wrote {PCM_FIXTURE}")
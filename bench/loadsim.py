@@ -0,0 +1,571 @@
+"""
+Load simulator: drives N concurrent calls through lambda_function.handler with local stand-ins for every service.
+
+Each call goes answer (ringing) -> start -> mark, then --turns times respond -> start -> mark, the same events
+Twilio and API Gateway deliver.  Nothing leaves the machine:
+
+    eleven labs   fake streaming TTS server, PCM from bench/fixtures with a configurable time to first byte and
+                  generation speed (multiple of realtime)
+    API Gateway   management API sink that records when every media message and mark arrives, optionally
+                  throttled to --sink-rate posts per second (429 LimitExceededException, as API Gateway does)
+    Twilio REST   stub that accepts the call redirect after each mark
+    SSM           local_ssm with fake values, counting calls per second
+    LLM           stand-in for query_lambda that answers after --llm-ms (unless --real-llm)
+
+It reports turn latency (webhook to first audio frame at the sink), frame pacing (gaps between media messages
+and streams whose playback buffer would have run dry), throttling, SSM call rate and peak RSS.  All calls run in
+this one process, which stands in for many Lambda containers: per process caches are shared between calls, use
+--cold-ssm to make every call start with an empty SSM cache.  The audio cache is off unless --audio-cache.
+
+    python bench/loadsim.py --calls 50 --concurrency 10 --turns 2 --tts-ttfb-ms 300 --tts-speed 2
+    python bench/loadsim.py --calls 20 --concurrency 20 --sink-rate 500 --json
+"""
+import os
+import re
+import sys
+import json
+import html
+import time
+import types
+import base64
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+import statistics
+from urllib.parse import urlencode, unquote, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+import fixtures  # noqa: E402
+
+PCM_BYTES_PER_SECOND = fixtures.PCM_SAMPLE_RATE * 2
+SPEECH_MS_PER_CHAR = 65  # about 15 characters a second of speech
+SSM_STANDARD_TPS = 40  # GetParameter(s) standard throughput limit per account and region
+
+ACCOUNT_SID = 'AC' + '0' * 32
+QUESTIONS = [
+    'What are the library hours on the weekend?',
+    'How do I reset my university password?',
+    'Where can I park on campus for a visit?',
+    'When does registration open for the spring semester?',
+]
+ANSWER = ("Sure thing, the library's open from ten in the morning until ten at night on weekends. "
+          "Is there anything else I can help you with?")
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# Stand-in services
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class FakeTTSHandler(_QuietHandler):
+    """
+    POST /v1/text-to-speech/<voice>/stream: waits ttfb, then streams PCM (chunked) at speed times realtime.
+    """
+
+    def do_HEAD(self):
+        # preconnect
+        self.send_empty(200)
+
+    def do_POST(self):
+        config = self.server.config
+        text = json.loads(self.read_body() or b'{}').get('text', '')
+        total = int(len(text) * SPEECH_MS_PER_CHAR / 1000 * PCM_BYTES_PER_SECOND) // 2 * 2
+        pcm = config['pcm']
+
+        time.sleep(config['ttfb'])
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/pcm')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        start = time.perf_counter()
+        bytes_per_second = PCM_BYTES_PER_SECOND * config['speed']
+        for offset in range(0, total, config['chunk_bytes']):
+            size = min(config['chunk_bytes'], total - offset)
+            delay = start + offset / bytes_per_second - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            begin = offset % len(pcm)
+            chunk = (pcm[begin:] + pcm)[:size]
+            self.wfile.write(f'{size:x}\r\n'.encode() + chunk + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class ManagementSinkHandler(_QuietHandler):
+    """
+    POST /sandbox/@connections/<id>: records the message, or answers 429 when over the rate limit.
+    """
+
+    def do_POST(self):
+        arrived = time.perf_counter()
+        connection_id = unquote(self.path.rsplit('/', 1)[1])
+        body = self.read_body()
+        if not self.server.limiter.allow():
+            self.server.recorder.throttled()
+            payload = b'{"message": "Rate exceeded"}'
+            self.send_response(429)
+            self.send_header('x-amzn-ErrorType', 'LimitExceededException')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        self.server.recorder.add(connection_id, arrived, body)
+        self.send_empty(200)
+
+
+class TwilioStubHandler(_QuietHandler):
+    """
+    POST /2010-04-01/Accounts/<account>/Calls/<call>.json: accepts a call update (the redirect after a mark).
+    """
+
+    def do_POST(self):
+        call_sid = self.path.rsplit('/', 1)[1].split('.')[0]
+        twiml = parse_qs(self.read_body().decode()).get('Twiml', [''])[0]
+        with self.server.lock:
+            self.server.redirects.append((time.perf_counter(), call_sid, twiml))
+        payload = json.dumps({'sid': call_sid, 'account_sid': ACCOUNT_SID, 'status': 'in-progress'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_server(handler_class, **attributes):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    return server
+
+
+class RateLimiter:
+    """
+    Token bucket, unlimited when rate is 0.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class FrameRecorder:
+    """
+    Arrival times of the media messages and marks per connection, as seen by the API Gateway stand-in.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.media = {}  # connection id -> [(arrival, audio ms)]
+        self.marks = {}  # connection id -> arrival
+        self.throttled_count = 0
+
+    def add(self, connection_id, arrived, body):
+        message = json.loads(body)
+        with self.lock:
+            if message.get('event') == 'media':
+                audio_ms = len(base64.b64decode(message['media']['payload'])) / 8
+                self.media.setdefault(connection_id, []).append((arrived, audio_ms))
+            elif message.get('event') == 'mark':
+                self.marks[connection_id] = arrived
+
+    def throttled(self):
+        with self.lock:
+            self.throttled_count += 1
+
+
+def install_fake_llm(latency, token_delay):
+    """
+    Puts a stand-in query_lambda in sys.modules so the respond route needs no OpenAI or Postgres.
+    """
+    module = types.ModuleType('query_lambda')
+
+    def query_chatgpt(question, deadline=None):
+        time.sleep(latency)
+        return ANSWER
+
+    def stream_answer(question):
+        time.sleep(latency)
+        for word in ANSWER.split(' '):
+            time.sleep(token_delay)
+            yield word + ' '
+
+    module.query_chatgpt = query_chatgpt
+    module.stream_answer = stream_answer
+    sys.modules['query_lambda'] = module
+
+
+class RssSampler:
+    """
+    Samples the resident set size of this process, Linux only (None elsewhere).
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_kb = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def rss_kb():
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except OSError:
+            return None
+
+    def _run(self):
+        while not self.stop.is_set():
+            rss = self.rss_kb()
+            if rss:
+                self.peak_kb = max(self.peak_kb, rss)
+            self.stop.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# Events
+
+def webhook_event(path, fields):
+    body = urlencode({'AccountSid': ACCOUNT_SID, 'ApiVersion': '2010-04-01', 'Direction': 'inbound', **fields})
+    return {
+        'version': '2.0',
+        'rawPath': path,
+        'rawQueryString': '',
+        'headers': {'content-type': 'application/x-www-form-urlencoded; charset=UTF-8'},
+        'requestContext': {'http': {'method': 'POST', 'path': path}},
+        'body': base64.b64encode(body.encode()).decode(),
+        'isBase64Encoded': True,
+    }
+
+
+def start_event(connection_id, stream_sid, call_sid, custom_parameters):
+    body = {
+        'event': 'start',
+        'sequenceNumber': '1',
+        'streamSid': stream_sid,
+        'start': {
+            'accountSid': ACCOUNT_SID,
+            'streamSid': stream_sid,
+            'callSid': call_sid,
+            'tracks': ['inbound'],
+            'mediaFormat': {'encoding': 'audio/x-mulaw', 'sampleRate': 8000, 'channels': 1},
+            'customParameters': custom_parameters,
+        },
+    }
+    return {'requestContext': {'eventType': 'MESSAGE', 'connectionId': connection_id}, 'body': json.dumps(body)}
+
+
+def mark_event(call_sid):
+    return {'event': 'mark', 'mark': {'name': f'eoaCallSid{call_sid}'}}
+
+
+def stream_parameters(response):
+    """
+    The <Parameter> values of the <Stream> in a TwiML response.
+    """
+    return {name: html.unescape(value)
+            for name, value in re.findall(r'<Parameter name="([^"]+)" value="([^"]*)"', response['body'])}
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# Simulation
+
+def run_call(index, args, handler, utils):
+    """
+    One call, returns its turns: {'call', 'turn', 'connection_id', 'started', 'mark_ms', 'error'}.
+    """
+    call_sid = f'CA{index:032x}'
+    rng = random.Random(index)
+    turns = []
+    if args.cold_ssm:
+        utils.invalidate_ssm_cache()
+
+    started = time.perf_counter()
+    try:
+        response = handler(webhook_event('/twilio/answer', {'CallSid': call_sid, 'CallStatus': 'ringing'}), None)
+        parameters = stream_parameters(response)
+        for turn in range(args.turns + 1):
+            # Twilio opens a new websocket connection for every <Connect><Stream>
+            connection_id = f'{call_sid}-{turn}'
+            turns.append({'call': index, 'turn': turn, 'connection_id': connection_id, 'started': started,
+                          'mark_ms': None, 'error': None})
+            handler(start_event(connection_id, f'MZ{index:030x}{turn:02x}', call_sid, parameters), None)
+
+            mark_start = time.perf_counter()
+            handler(mark_event(call_sid), None)
+            turns[-1]['mark_ms'] = (time.perf_counter() - mark_start) * 1000
+            if turn == args.turns:
+                break
+
+            time.sleep(args.caller_pause_ms / 1000)
+            started = time.perf_counter()
+            response = handler(webhook_event('/twilio/respond/', {
+                'CallSid': call_sid, 'CallStatus': 'in-progress', 'Confidence': '0.92',
+                'SpeechResult': rng.choice(QUESTIONS)}), None)
+            parameters = stream_parameters(response)
+            if not parameters:
+                raise RuntimeError(f"Respond returned no stream: {response}")
+    except Exception as e:
+        if turns:
+            turns[-1]['error'] = f'{type(e).__name__}: {e}'
+        else:
+            turns.append({'call': index, 'turn': 0, 'connection_id': None, 'started': started, 'mark_ms': None,
+                          'error': f'{type(e).__name__}: {e}'})
+    return turns
+
+
+def percentile_summary(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def nearest_rank(percent):
+        return values[max(0, -(-percent * len(values) // 100) - 1)]
+
+    return {'count': len(values), 'p50': round(nearest_rank(50), 1), 'p95': round(nearest_rank(95), 1),
+            'p99': round(nearest_rank(99), 1), 'max': round(values[-1], 1)}
+
+
+def analyze(turns, recorder, ssm_times, twilio_stub):
+    greeting_latency, answer_latency, mark_latency, gaps, stalled, missing = [], [], [], [], 0, 0
+    for turn in turns:
+        frames = recorder.media.get(turn['connection_id'])
+        if not frames:
+            missing += 1
+            continue
+        frames.sort()
+        (greeting_latency if turn['turn'] == 0 else answer_latency).append(
+            (frames[0][0] - turn['started']) * 1000)
+        if turn['mark_ms'] is not None:
+            mark_latency.append(turn['mark_ms'])
+
+        # Twilio plays from a buffer: it runs dry when less audio has arrived than the time since the first frame
+        first = frames[0][0]
+        buffered_ms = 0
+        for (arrived, audio_ms), previous in zip(frames, [None] + frames[:-1]):
+            if previous is not None:
+                gaps.append((arrived - previous[0]) * 1000)
+            if buffered_ms < (arrived - first) * 1000:
+                stalled += 1
+                break
+            buffered_ms += audio_ms
+
+    per_second = {}
+    for called in ssm_times:
+        per_second[int(called)] = per_second.get(int(called), 0) + 1
+
+    return {
+        'turns': len(turns),
+        'errors': [turn['error'] for turn in turns if turn['error']],
+        'turns_without_audio': missing,
+        'greeting_first_frame_ms': percentile_summary(greeting_latency),
+        'answer_first_frame_ms': percentile_summary(answer_latency),
+        'mark_to_redirect_ms': percentile_summary(mark_latency),
+        'frame_gap_ms': percentile_summary(gaps),
+        'frame_gap_stdev_ms': round(statistics.pstdev(gaps), 1) if gaps else None,
+        'streams_stalled': stalled,
+        'media_messages': sum(len(frames) for frames in recorder.media.values()),
+        'posts_throttled': recorder.throttled_count,
+        'redirects': len(twilio_stub.redirects),
+        'ssm_calls': len(ssm_times),
+        'ssm_peak_calls_per_second': max(per_second.values(), default=0),
+    }
+
+
+def configure_environment(args, tts, sink, twilio_stub, ssm_file):
+    os.environ.update({
+        'ELEVEN_BASE_URL': f'{tts.url}/v1',
+        'APIGATEWAY_ENDPOINT_URL': f'{sink.url}/sandbox',
+        'TWILIO_API_BASE': twilio_stub.url,
+        'SSM_LOCAL_PARAMS': ssm_file,
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'loadsim',
+        'AWS_SECRET_ACCESS_KEY': 'loadsim',
+        'AWS_XRAY_CONTEXT_MISSING': 'IGNORE_ERROR',
+        'METRICS_EMF': 'false',
+        'METRICS_XRAY': 'off',
+        'WARM_UP_ON_INIT': 'false',
+        'AUDIO_CACHE_ENABLED': 'true' if args.audio_cache else 'false',
+        'AUDIO_CACHE_DIR': os.path.join(tempfile.gettempdir(), 'loadsim_audio_cache'),
+        'ANSWER_STREAMING': 'true' if args.answer_streaming else 'false',
+        'STREAM_PIPELINE': 'true' if args.pipeline else 'false',
+        'STREAM_COALESCE': 'true' if args.coalesce else 'false',
+        'STT_BACKEND': 'stub',
+    })
+    os.environ.pop('AWS_LAMBDA_INITIALIZATION_TYPE', None)
+
+
+def simulate(args):
+    recorder = FrameRecorder()
+    tts = start_server(FakeTTSHandler, config={
+        'ttfb': args.tts_ttfb_ms / 1000, 'speed': args.tts_speed, 'chunk_bytes': fixtures.ELEVEN_CHUNK_BYTES,
+        'pcm': fixtures.load_pcm()})
+    sink = start_server(ManagementSinkHandler, recorder=recorder, limiter=RateLimiter(args.sink_rate))
+    twilio_stub = start_server(TwilioStubHandler, redirects=[])
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as ssm_file:
+        json.dump({}, ssm_file)
+    configure_environment(args, tts, sink, twilio_stub, ssm_file.name)
+
+    import utils
+    import local_ssm
+    import metrics
+
+    ssm_times = []
+
+    class CountingSSMClient(local_ssm.LocalSSMClient):
+        def get_parameter(self, *a, **kw):
+            ssm_times.append(time.perf_counter())
+            return super().get_parameter(*a, **kw)
+
+        def get_parameters(self, *a, **kw):
+            ssm_times.append(time.perf_counter())
+            return super().get_parameters(*a, **kw)
+
+    values = {name: 'loadsim' for name in utils.KNOWN_PARAM_NAMES}
+    values[utils.PARAM_PREFIX + 'twilioAccountSid'] = ACCOUNT_SID
+    values[utils.PARAM_PREFIX + 'apiSandboxHttpBase'] = 'loadsim.example.com'
+    values[utils.PARAM_PREFIX + 'apiSandboxWebsocketBase'] = 'loadsim.example.com'
+    utils.set_ssm_client(CountingSSMClient(values))
+    if not args.real_llm:
+        install_fake_llm(args.llm_ms / 1000, args.llm_token_ms / 1000)
+
+    log = open(args.log, 'w')
+    with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        import lambda_function
+        rss_before_kb = RssSampler.rss_kb()
+        started = time.perf_counter()
+        with RssSampler() as rss, ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [pool.submit(run_call, index, args, lambda_function.handler, utils)
+                       for index in range(args.calls)]
+            turns = [turn for future in futures for turn in future.result()]
+        wall_seconds = time.perf_counter() - started
+    log.close()
+    os.unlink(ssm_file.name)
+    for server in (tts, sink, twilio_stub):
+        server.shutdown()
+
+    report = {
+        'calls': args.calls,
+        'concurrency': args.concurrency,
+        'wall_seconds': round(wall_seconds, 2),
+        **analyze(turns, recorder, ssm_times, twilio_stub),
+        'ssm_limit_calls_per_second': SSM_STANDARD_TPS,
+    }
+    if rss_before_kb and rss.peak_kb:
+        report['rss_before_mb'] = round(rss_before_kb / 1024, 1)
+        report['rss_peak_mb'] = round(rss.peak_kb / 1024, 1)
+        report['rss_per_concurrent_call_mb'] = round((rss.peak_kb - rss_before_kb) / 1024 / args.concurrency, 2)
+    report['app_metrics'] = {name: stats for name, stats in metrics.summary().items() if stats}
+    return report
+
+
+def print_report(report):
+    def line(label, stats):
+        if stats:
+            print(f"  {label:<26} p50 {stats['p50']:>8}  p95 {stats['p95']:>8}  p99 {stats['p99']:>8}"
+                  f"  max {stats.get('max', ''):>8}  (n={stats['count']})")
+
+    print(f"{report['calls']} calls, concurrency {report['concurrency']}, {report['turns']} turns "
+          f"in {report['wall_seconds']} s, {len(report['errors'])} errors, "
+          f"{report['turns_without_audio']} turns without audio")
+    for error in report['errors'][:5]:
+        print(f"  error: {error}")
+    print("Latency ms")
+    line('greeting -> first frame', report['greeting_first_frame_ms'])
+    line('respond -> first frame', report['answer_first_frame_ms'])
+    line('mark -> redirect', report['mark_to_redirect_ms'])
+    print("Frame pacing")
+    line('gap between messages ms', report['frame_gap_ms'])
+    print(f"  gap stdev {report['frame_gap_stdev_ms']} ms, {report['streams_stalled']} streams stalled, "
+          f"{report['media_messages']} media messages, {report['posts_throttled']} posts throttled")
+    print(f"Twilio: {report['redirects']} redirects for {report['turns']} marks")
+    print(f"SSM: {report['ssm_calls']} calls, peak {report['ssm_peak_calls_per_second']}/s "
+          f"(limit {report['ssm_limit_calls_per_second']}/s)")
+    if 'rss_peak_mb' in report:
+        print(f"RSS: {report['rss_before_mb']} MB before, {report['rss_peak_mb']} MB peak, "
+              f"{report['rss_per_concurrent_call_mb']} MB per concurrent call")
+    print("App metrics ms")
+    for name, stats in sorted(report['app_metrics'].items()):
+        line(name, {key: round(value, 1) for key, value in stats.items()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=10, help='calls in flight at once')
+    parser.add_argument('--turns', type=int, default=1, help='question and answer turns after the greeting')
+    parser.add_argument('--caller-pause-ms', type=float, default=200, help='pause before each respond webhook')
+    parser.add_argument('--tts-ttfb-ms', type=float, default=250, help='fake TTS time to first byte')
+    parser.add_argument('--tts-speed', type=float, default=2.0, help='fake TTS generation speed, x realtime')
+    parser.add_argument('--sink-rate', type=float, default=0, help='management API posts/s allowed, 0 = no limit')
+    parser.add_argument('--llm-ms', type=float, default=800, help='stand-in LLM time to answer or first token')
+    parser.add_argument('--llm-token-ms', type=float, default=20, help='stand-in LLM delay per streamed word')
+    parser.add_argument('--real-llm', action='store_true', help='use the real query_lambda')
+    parser.add_argument('--answer-streaming', action='store_true', help='ANSWER_STREAMING=true')
+    parser.add_argument('--pipeline', action='store_true', help='STREAM_PIPELINE=true')
+    parser.add_argument('--coalesce', action='store_true', help='STREAM_COALESCE=true')
+    parser.add_argument('--audio-cache', action='store_true', help='AUDIO_CACHE_ENABLED=true')
+    parser.add_argument('--cold-ssm', action='store_true', help='empty the SSM cache at the start of every call')
+    parser.add_argument('--log', default=os.devnull, help='file for the app output')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    report = simulate(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 1 if report['errors'] or report['turns_without_audio'] or report['redirects'] < report['turns'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,43 @@
+"""
+Checks the sentence splitter that streaming answers, ingest chunking and parallel synthesis rely on.
+
+Each case is split in one piece and fed a few characters at a time like LLM tokens, both must give the expected
+sentences.
+
+    python bench/sentences_check.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import sentences  # noqa: E402
+
+CASES = [
+    ("That is the best. We fixed the problems. Call Dr. Smith at noon.",
+     ["That is the best.", "We fixed the problems.", "Call Dr. Smith at noon."]),
+    ("The library opens at nine. Ask Ms. Jones at the desk, e.g. for a study room. It closes at ten.",
+     ["The library opens at nine.", "Ask Ms. Jones at the desk, e.g. for a study room.", "It closes at ten."]),
+    ("Parking is on Main St. near the gym. Bring your ID card (i.e. the UMD one). Thanks!",
+     ["Parking is on Main St. near the gym.", "Bring your ID card (i.e. the UMD one).", "Thanks!"]),
+    ("It is the fastest. Is it? The podcasts. Yes, it is the last.",
+     ["It is the fastest.", "Is it? The podcasts.", "Yes, it is the last."]),
+]
+
+
+def streamed(text, size=3):
+    return list(sentences.iter_sentences(text[i:i + size] for i in range(0, len(text), size)))
+
+
+def main():
+    failures = 0
+    for text, expected in CASES:
+        for name, actual in (('whole', sentences.split_sentences(text)), ('streamed', streamed(text))):
+            if actual != expected:
+                failures += 1
+                print(f"FAIL {name} {text!r}: {actual}")
+    print(f"{len(CASES) * 2 - failures}/{len(CASES) * 2} splits match")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Checks the silence trimmer on synthetic signals.
+
+The signal is low level noise, a tone with a slow (quiet) onset, a short and a long pause, and trailing noise,
+encoded as µ-law like the frames that go to Twilio.  Checks that leading silence is dropped but the pre-roll
+before the onset is kept byte for byte, that short pauses are kept and long ones cut, that the trailing silence
+is collapsed, that the output stays frame aligned and does not depend on how the stream is chunked, and that
+normalization brings a quiet voice near the target level.
+
+    python bench/silence_trim_check.py
+"""
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import audioconvert  # noqa: E402
+import vad  # noqa: E402
+
+FRAME = audioconvert.TWILIO_FRAME_BYTES
+RATE = audioconvert.TWILIO_SAMPLE_RATE
+FRAME_MS = FRAME * 1000 // RATE
+
+
+def noise(ms, rng, level=30):
+    return rng.normal(0, level, RATE * ms // 1000)
+
+
+def tone(ms, amplitude, onset_ms=0):
+    t = np.arange(RATE * ms // 1000) / RATE
+    signal = amplitude * np.sin(2 * np.pi * 300 * t)
+    if onset_ms:
+        ramp = min(len(t), RATE * onset_ms // 1000)
+        signal[:ramp] *= np.linspace(0, 1, ramp)
+    return signal
+
+
+def encode(signal):
+    pcm = np.clip(np.rint(signal), -32768, 32767).astype(np.int16)
+    return audioconvert.ULAW_TABLE[pcm.view(np.uint16)].tobytes()
+
+
+def level_dbfs(mulaw):
+    samples = vad.ULAW_DECODE_TABLE[np.frombuffer(mulaw, dtype=np.uint8)].astype(np.float64)
+    return 20 * np.log10(max(np.sqrt(np.mean(samples * samples)), 1.0) / 32768)
+
+
+def trim(mulaw, chunk_frames=None, **kwargs):
+    trimmer = audioconvert.SilenceTrimmer(**kwargs)
+    if chunk_frames is None:
+        out = trimmer.push(mulaw)
+    else:
+        out = b''
+        rng = np.random.default_rng(7)
+        position = 0
+        while position < len(mulaw):
+            size = FRAME * int(rng.integers(1, chunk_frames + 1))
+            out += trimmer.push(mulaw[position:position + size])
+            position += size
+    return out + trimmer.flush(), trimmer
+
+
+def check(name, ok, detail=''):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}{': ' + detail if detail else ''}")
+    return 0 if ok else 1
+
+
+def main():
+    rng = np.random.default_rng(1)
+    parts = [noise(300, rng), tone(400, 8000, onset_ms=60), noise(200, rng), tone(300, 8000),
+             noise(1200, rng), tone(300, 8000), noise(800, rng)]
+    signal = encode(np.concatenate(parts))
+    onset = len(encode(parts[0]))
+    failures = 0
+
+    out, trimmer = trim(signal)
+    trimmed = trimmer.trimmed_ms
+    failures += check('frame aligned', len(out) % FRAME == 0, f'{len(out)} bytes')
+    failures += check('leading silence dropped', trimmed['leading'] == 300 - 80, f"{trimmed['leading']:.0f} ms")
+    failures += check('pre-roll and onset kept', out.startswith(signal[onset - 80 * RATE // 1000:][:len(out) // 4]))
+    failures += check('short pause kept, long pause cut', trimmed['pause'] == 1200 - 500, f"{trimmed['pause']:.0f} ms")
+    failures += check('trailing silence collapsed', trimmed['trailing'] == 800 - 60, f"{trimmed['trailing']:.0f} ms")
+    expected_ms = 80 + 400 + 200 + 300 + 500 + 300 + 60
+    failures += check('output length', len(out) * 1000 // RATE == expected_ms, f'{len(out) * 1000 // RATE} ms')
+
+    for chunk_frames in (1, 3, 17):
+        chunked, _ = trim(signal, chunk_frames=chunk_frames)
+        failures += check(f'same output in chunks of up to {chunk_frames} frames', chunked == out)
+
+    silent, _ = trim(encode(noise(500, rng)))
+    failures += check('silence only gives nothing', silent == b'')
+
+    quiet = encode(np.concatenate([noise(200, rng), tone(2000, 600), noise(200, rng)]))
+    normalized, _ = trim(quiet, target_dbfs=-20.0, max_gain_db=24.0)
+    tail_level = level_dbfs(normalized[-(FRAME * 50 + 60 * RATE // 1000):-(60 * RATE // 1000)])
+    failures += check('quiet voice normalized near -20 dBFS', abs(tail_level + 20) < 1.5,
+                      f'{level_dbfs(quiet[FRAME * 10:-FRAME * 10]):.1f} -> {tail_level:.1f} dBFS')
+    loud = encode(tone(2000, 30000))
+    limited, _ = trim(loud, target_dbfs=-20.0, max_gain_db=6.0)
+    failures += check('gain limited to max_gain_db', level_dbfs(limited[-FRAME * 50:]) >= level_dbfs(loud) - 6.5,
+                      f'{level_dbfs(loud):.1f} -> {level_dbfs(limited[-FRAME * 50:]):.1f} dBFS')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
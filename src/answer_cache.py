@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+ANSWER_CACHE_BACKEND = os.environ.get('ANSWER_CACHE_BACKEND', 'off')  # memory, sqlite or off
+# With ada-002, paraphrases that need different answers often score above 0.95.  Check the threshold against
+# real questions before turning the cache on, a hit gives the caller someone else's answer.
+ANSWER_CACHE_THRESHOLD = float(os.environ.get('ANSWER_CACHE_THRESHOLD', '0.95'))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', '500'))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get('ANSWER_CACHE_TTL_SECONDS', '86400'))
+ANSWER_CACHE_SQLITE_PATH = os.environ.get('ANSWER_CACHE_SQLITE_PATH', '/tmp/answer_cache.sqlite3')
+
+
+class InMemoryAnswerBackend:
+    """
+    Size bounded LRU of (question, embedding, answer) entries with a TTL.  Embeddings are kept normalized in one
+    matrix so a lookup is a single matrix vector product.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl_seconds=ANSWER_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # question -> (unit embedding, answer, created at)
+        self._matrix = None
+        self._keys = []
+        self._lock = threading.Lock()
+
+    def nearest(self, embedding):
+        """
+        Returns (similarity, question, answer) of the closest live entry, or None when the cache is empty.
+        """
+        with self._lock:
+            self._expire()
+            if not self._entries:
+                return None
+            if self._matrix is None:
+                self._keys = list(self._entries)
+                self._matrix = np.stack([self._entries[key][0] for key in self._keys])
+            similarities = self._matrix @ _normalize(embedding)
+            best = int(np.argmax(similarities))
+            question = self._keys[best]
+            return float(similarities[best]), question, self._entries[question][1]
+
+    def touch(self, question):
+        """
+        Marks an entry as recently used after a hit so the LRU keeps it.
+        """
+        with self._lock:
+            if question in self._entries:
+                self._entries.move_to_end(question)
+                self._touched(question)
+
+    def add(self, question, embedding, answer, created_at=None):
+        with self._lock:
+            self._entries[question] = (_normalize(embedding), answer, created_at or time.time())
+            self._entries.move_to_end(question)
+            self._added(question, self._entries[question])
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._removed(evicted)
+            self._matrix = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl_seconds
+        expired = [question for question, entry in self._entries.items() if entry[2] < cutoff]
+        for question in expired:
+            del self._entries[question]
+            self._removed(question)
+        if expired:
+            self._matrix = None
+
+    # Hooks for persistent backends, called with the lock held
+    def _added(self, question, entry):
+        pass
+
+    def _removed(self, question):
+        pass
+
+    def _touched(self, question):
+        pass
+
+
+class SqliteAnswerBackend(InMemoryAnswerBackend):
+    """
+    Write through SQLite copy of the in memory backend so the cache survives a process restart.  The file lives in
+    /tmp by default, point ANSWER_CACHE_SQLITE_PATH at shared storage (e.g. EFS) to share it between containers.
+    """
+
+    def __init__(self, path=ANSWER_CACHE_SQLITE_PATH, **kwargs):
+        super().__init__(**kwargs)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS answers ("
+                         "question TEXT PRIMARY KEY, embedding BLOB, answer TEXT, created_at REAL, last_used REAL)")
+        rows = self._db.execute("SELECT question, embedding, answer, created_at FROM answers "
+                                "ORDER BY last_used DESC LIMIT ?", (self.max_entries,)).fetchall()
+        for question, embedding, answer, created_at in reversed(rows):
+            self._entries[question] = (np.frombuffer(embedding, dtype=np.float32).astype(np.float64), answer,
+                                       created_at)
+        logger.info(f"Loaded {len(rows)} cached answers from {path}")
+
+    def _added(self, question, entry):
+        unit_embedding, answer, created_at = entry
+        self._db.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+                         (question, unit_embedding.astype(np.float32).tobytes(), answer, created_at, time.time()))
+        self._db.commit()
+
+    def _removed(self, question):
+        self._db.execute("DELETE FROM answers WHERE question = ?", (question,))
+        self._db.commit()
+
+    def _touched(self, question):
+        self._db.execute("UPDATE answers SET last_used = ? WHERE question = ?", (time.time(), question))
+        self._db.commit()
+
+
+class SemanticAnswerCache:
+    """
+    Answer cache keyed on the question embedding.  A question whose embedding is at least `threshold` cosine
+    similar to a cached one gets the cached answer without calling the LLM.
+    """
+
+    def __init__(self, backend, threshold=ANSWER_CACHE_THRESHOLD):
+        self.backend = backend
+        self.threshold = threshold
+        self._stats = {'hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+
+    def lookup(self, embedding):
+        nearest = self.backend.nearest(embedding)
+        hit = nearest is not None and nearest[0] >= self.threshold
+        with self._lock:
+            self._stats['hits' if hit else 'misses'] += 1
+        if not hit:
+            return None
+        similarity, question, answer = nearest
+        self.backend.touch(question)
+        logger.info(f"Answer cache hit with similarity {similarity:.3f} to cached question: {question}")
+        return answer
+
+    def store(self, question, embedding, answer):
+        self.backend.add(question, embedding, answer)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {**self._stats, 'hit_rate': self._stats['hits'] / lookups if lookups else 0.0,
+                    'size': len(self.backend)}
+
+
+def create_answer_cache(backend=ANSWER_CACHE_BACKEND):
+    """
+    Builds the cache selected by ANSWER_CACHE_BACKEND, or returns None when it is turned off.
+    """
+    if backend == 'off':
+        return None
+    if backend == 'sqlite':
+        return SemanticAnswerCache(SqliteAnswerBackend())
+    if backend == 'memory':
+        return SemanticAnswerCache(InMemoryAnswerBackend())
+    raise ValueError(f"Unknown ANSWER_CACHE_BACKEND: {backend}")
+
+
+def _normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float64)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
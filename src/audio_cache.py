@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import hashlib
+import threading
+import boto3
+
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Off by default like the other features: every answer would be kept, also the ones never asked again
+AUDIO_CACHE_ENABLED = os.environ.get('AUDIO_CACHE_ENABLED', 'false').lower() == 'true'
+AUDIO_CACHE_DIR = os.environ.get('AUDIO_CACHE_DIR', '/tmp/audio_cache')
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get('AUDIO_CACHE_MAX_BYTES', str(100 * 1024 * 1024)))
+# Optional shared tier so every container (and the deploy time pre-warm) use the same entries
+AUDIO_CACHE_S3_BUCKET = os.environ.get('AUDIO_CACHE_S3_BUCKET', '')
+AUDIO_CACHE_S3_PREFIX = os.environ.get('AUDIO_CACHE_S3_PREFIX', 'audio-cache/')
+
+
+def cache_key(text, voice_id, model_id, voice_settings, output_format, latency, silence_trim=None):
+    """
+    Content address of the Twilio ready µ-law audio for a piece of text and all the settings that change it.
+    :param silence_trim: the trimming and normalization settings, None when the audio is not trimmed
+    """
+    params = {
+        'text': text,
+        'voice_id': voice_id,
+        'model_id': model_id,
+        'voice_settings': voice_settings,
+        'output_format': output_format,
+        'latency': latency,
+    }
+    if silence_trim is not None:
+        # Left out when off, so the entries cached before trimming existed stay valid
+        params['silence_trim'] = silence_trim
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class LocalAudioCache:
+    """
+    LRU of µ-law audio files in /tmp, which survives while the Lambda container stays warm.  File modification time
+    is the last use time, the oldest files are deleted when the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith('.ulaw'):
+                    stat = os.stat(os.path.join(self.directory, name))
+                    entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.ulaw")
+
+
+class S3AudioCache:
+    """
+    Shared tier in S3.  Slower than /tmp but filled once for every container.
+    """
+
+    def __init__(self, bucket=AUDIO_CACHE_S3_BUCKET, prefix=AUDIO_CACHE_S3_PREFIX):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3_client = boto3.client('s3')
+
+    def get(self, key):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=f"{self.prefix}{key}.ulaw")
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read()
+
+    def put(self, key, data):
+        self.s3_client.put_object(Bucket=self.bucket, Key=f"{self.prefix}{key}.ulaw", Body=data)
+
+
+class AudioCache:
+    """
+    Tiered cache of final Twilio µ-law audio.  Lookups go through the tiers in order and a hit in a slower
+    tier is copied into the faster ones.  Tier errors are logged and treated as misses.
+    """
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self._stats = {'hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        for i, tier in enumerate(self.tiers):
+            try:
+                data = tier.get(key)
+            except Exception as e:
+                logger.error(f"Audio cache tier {type(tier).__name__} get failed: {e}")
+                continue
+            if data is not None:
+                for faster_tier in self.tiers[:i]:
+                    self._put_tier(faster_tier, key, data)
+                self._count('hits')
+                return data
+        self._count('misses')
+        return None
+
+    def put(self, key, data):
+        for tier in self.tiers:
+            self._put_tier(tier, key, data)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _put_tier(self, tier, key, data):
+        try:
+            tier.put(key, data)
+        except Exception as e:
+            logger.error(f"Audio cache tier {type(tier).__name__} put failed: {e}")
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+def create_audio_cache():
+    """
+    Builds the cache from the environment, or returns None when AUDIO_CACHE_ENABLED is false.
+    """
+    if not AUDIO_CACHE_ENABLED:
+        return None
+    tiers = [LocalAudioCache()]
+    if AUDIO_CACHE_S3_BUCKET:
+        tiers.append(S3AudioCache())
+    return AudioCache(tiers)
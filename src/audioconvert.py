@@ -1,23 +1,283 @@
-from pydub import AudioSegment
 import audioop
-from aws_xray_sdk.core import xray_recorder
+from collections import deque
+import numpy as np
+import vad
+
+ELEVEN_SAMPLE_RATE = 16000
+TWILIO_SAMPLE_RATE = 8000
+TWILIO_FRAME_BYTES = 160  # 20ms of 8kHz µ-law, one byte per sample
+MULAW_SILENCE = b'\xff'
+
+
+def _build_ulaw_table():
+    """
+    Builds a 65536 entry lookup table from every signed 16-bit PCM sample (indexed as unsigned)
+    to its G.711 µ-law byte.  Matches audioop.lin2ulaw(..., 2) so the output is byte for byte the same.
+    """
+    samples = np.arange(-32768, 32768, dtype=np.int32)
+    pcm_14 = samples >> 2
+    mask = np.where(pcm_14 < 0, 0x7F, 0xFF)
+    magnitude = np.minimum(np.abs(pcm_14), 8159) + (0x84 >> 2)
+    segment = np.searchsorted(np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF]), magnitude)
+    ulaw = np.where(segment < 8, (segment << 4) | ((magnitude >> (segment + 1)) & 0x0F), 0x7F) ^ mask
+    table = np.empty(65536, dtype=np.uint8)
+    table[samples.astype(np.int16).view(np.uint16)] = ulaw.astype(np.uint8)
+    return table
+
+
+def _build_decimation_filter(taps=31, cutoff=0.45):
+    """
+    Windowed sinc low pass filter for 2:1 decimation split into its two polyphase branches.
+    The cutoff is relative to the output Nyquist frequency (4kHz), leaving a small transition band.
+    """
+    n = np.arange(taps) - (taps - 1) / 2
+    h = cutoff / 2 * np.sinc(cutoff / 2 * n) * np.hamming(taps)
+    h /= h.sum()
+    return h[0::2].copy(), h[1::2].copy()
+
+
+ULAW_TABLE = _build_ulaw_table()
+_EVEN_TAPS, _ODD_TAPS = _build_decimation_filter()
+# np.correlate with the reversed taps is np.convolve, without the copy convolve makes to flip them on every call
+_EVEN_TAPS_REVERSED, _ODD_TAPS_REVERSED = _EVEN_TAPS[::-1].copy(), _ODD_TAPS[::-1].copy()
+
+
+class PcmToMulawConverter:
+    """
+    Streaming 16kHz 16-bit mono PCM to 8kHz µ-law converter.  Create one per call and feed it the chunks in order.
+
+    The decimation filter history and any odd byte or odd sample left at the end of a chunk are carried over to
+    the next chunk, so converting a stream chunk by chunk gives exactly the same bytes as converting it in one go.
+    """
+
+    def __init__(self):
+        self._pending_byte = b''
+        self._pending_sample = np.zeros(0, dtype=np.float64)
+        self._even_history = np.zeros(len(_EVEN_TAPS) - 1, dtype=np.float64)
+        self._odd_history = np.zeros(len(_ODD_TAPS), dtype=np.float64)
+
+    def convert(self, chunk):
+        """
+        Converts the next PCM chunk and returns the µ-law bytes that are ready.  May return b'' for tiny chunks.
+        """
+        data = self._pending_byte + chunk
+        usable = len(data) - (len(data) % 2)
+        self._pending_byte = data[usable:]
+        samples = np.frombuffer(data, dtype='<i2', count=usable // 2).astype(np.float64)
+        if len(self._pending_sample):
+            samples = np.concatenate((self._pending_sample, samples))
+        return self._decimate_and_encode(samples)
+
+    def flush(self):
+        """
+        Pushes the filter tail through with silence and returns the last µ-law bytes of the stream.
+        A dangling odd byte can not be a sample and is dropped.
+        """
+        self._pending_byte = b''
+        tail_length = len(_EVEN_TAPS) + len(_ODD_TAPS)
+        tail_length += (tail_length + len(self._pending_sample)) % 2
+        tail = np.zeros(tail_length, dtype=np.float64)
+        return self._decimate_and_encode(np.concatenate((self._pending_sample, tail)))
+
+    def _decimate_and_encode(self, samples):
+        pairs = len(samples) // 2
+        self._pending_sample = samples[pairs * 2:]
+        if pairs == 0:
+            return b''
+
+        # Polyphase decimation: y[m] = sum(h_even[j] * x[2m - 2j]) + sum(h_odd[j] * x[2m - 2j - 1])
+        even = np.concatenate((self._even_history, samples[0:pairs * 2:2]))
+        odd = np.concatenate((self._odd_history, samples[1:pairs * 2:2]))
+        decimated = np.correlate(even, _EVEN_TAPS_REVERSED, 'valid')
+        decimated += np.correlate(odd[:-1], _ODD_TAPS_REVERSED, 'valid')
+        self._even_history = even[len(even) - len(self._even_history):]
+        self._odd_history = odd[len(odd) - len(self._odd_history):]
+
+        pcm_8k = np.clip(np.rint(decimated, out=decimated), -32768, 32767, out=decimated).astype(np.int16)
+        return ULAW_TABLE[pcm_8k.view(np.uint16)].tobytes()
+
+
+class MulawPassthrough:
+    """
+    Converter for audio that eleven labs already delivers as 8kHz µ-law (output_format=ulaw_8000).
+    One byte per sample, so there is nothing to carry between chunks.
+    """
+
+    def convert(self, chunk):
+        return chunk
+
+    def flush(self):
+        return b''
+
+
+def converter_for_format(output_format):
+    """
+    Returns a new per call converter from the eleven labs output format to Twilio µ-law.
+    """
+    if output_format == 'ulaw_8000':
+        return MulawPassthrough()
+    if output_format == 'pcm_16000':
+        return PcmToMulawConverter()
+    raise ValueError(f"No converter for eleven labs output format {output_format}")
+
+
+class FramePacketizer:
+    """
+    Cuts a µ-law byte stream into whole Twilio media frames.  Bytes that do not fill a frame are carried over
+    to the next push, and flush pads the last partial frame with silence so every payload is frame aligned.
+    """
+
+    def __init__(self, frame_bytes=TWILIO_FRAME_BYTES):
+        self.frame_bytes = frame_bytes
+        self._carry = b''
+
+    def push(self, mulaw_bytes):
+        """
+        Returns all complete frames available so far as one byte string (a multiple of frame_bytes, maybe empty).
+        """
+        data = self._carry + mulaw_bytes
+        aligned = len(data) - (len(data) % self.frame_bytes)
+        self._carry = data[aligned:]
+        return data[:aligned]
+
+    def flush(self):
+        """
+        Returns the carried over bytes padded with silence to a full frame, or b'' if nothing is left.
+        """
+        if not self._carry:
+            return b''
+        frame = self._carry.ljust(self.frame_bytes, MULAW_SILENCE)
+        self._carry = b''
+        return frame
+
+
+class SilenceTrimmer:
+    """
+    Streaming stage on frame aligned µ-law that drops the near silence TTS audio starts with, collapses the
+    silence before the end (and overly long pauses), and optionally normalizes the loudness.
+
+    A frame is silent when its level is below threshold_dbfs.  The last pre_roll_ms of silence before the first
+    loud frame is kept, so quiet word onsets (f, s, h) are not cut.  Silence after speech is held back until the
+    next loud frame, then at most max_pause_ms of it goes out.  At the end at most trailing_keep_ms is kept.
+    With target_dbfs the speech level is tracked and a smoothed gain of up to max_gain_db applied.
+    """
+
+    def __init__(self, threshold_dbfs=-50.0, pre_roll_ms=80, trailing_keep_ms=60, max_pause_ms=500,
+                 target_dbfs=None, max_gain_db=12.0, frame_bytes=TWILIO_FRAME_BYTES):
+        frame_ms = frame_bytes * 1000 / TWILIO_SAMPLE_RATE
+        self.threshold_dbfs = threshold_dbfs
+        self.trailing_keep_frames = int(trailing_keep_ms // frame_ms)
+        self.max_pause_frames = int(max_pause_ms // frame_ms)
+        self.target_dbfs = target_dbfs
+        self.max_gain_db = max_gain_db
+        self.frame_bytes = frame_bytes
+        self.frame_ms = frame_ms
+        self.started = False
+        self.trimmed_ms = {'leading': 0.0, 'pause': 0.0, 'trailing': 0.0}
+        self._pre_roll = deque(maxlen=int(pre_roll_ms // frame_ms))
+        self._held = []
+        self._speech_dbfs = None
+        self._gain_db = 0.0
+
+    def push(self, mulaw_bytes):
+        """
+        Returns the frames ready to be sent, maybe b''.  Input and output are whole frames.
+        """
+        count = len(mulaw_bytes) // self.frame_bytes
+        if count == 0:
+            return b''
+        frames = np.frombuffer(mulaw_bytes, dtype=np.uint8, count=count * self.frame_bytes).reshape(count, -1)
+        samples = vad.ULAW_DECODE_TABLE[frames].astype(np.float64)
+        rms = np.sqrt(np.mean(samples * samples, axis=1))
+        levels = 20 * np.log10(np.maximum(rms, 1.0) / 32768)
+
+        out = []
+        for frame, level in zip(frames, levels):
+            loud = level >= self.threshold_dbfs
+            if not self.started:
+                if not loud:
+                    if len(self._pre_roll) == self._pre_roll.maxlen:
+                        self.trimmed_ms['leading'] += self.frame_ms
+                    if self._pre_roll.maxlen:
+                        self._pre_roll.append(frame)
+                    else:
+                        self.trimmed_ms['leading'] += self.frame_ms
+                    continue
+                self.started = True
+                out.extend(self._pre_roll)
+                self._pre_roll.clear()
+            elif not loud:
+                self._held.append(frame)
+                continue
+
+            if self._held:
+                self.trimmed_ms['pause'] += max(0, len(self._held) - self.max_pause_frames) * self.frame_ms
+                out.extend(self._held[:self.max_pause_frames])
+                self._held = []
+            self._track_level(level)
+            out.append(frame)
+        return self._encode(out)
+
+    def flush(self):
+        """
+        Returns what is left at the end of the stream, the held silence cut to trailing_keep_ms.
+        """
+        if not self.started:
+            self.trimmed_ms['leading'] += len(self._pre_roll) * self.frame_ms
+            self._pre_roll.clear()
+            return b''
+        self.trimmed_ms['trailing'] += max(0, len(self._held) - self.trailing_keep_frames) * self.frame_ms
+        out = self._held[:self.trailing_keep_frames]
+        self._held = []
+        return self._encode(out)
+
+    def _track_level(self, level):
+        if self.target_dbfs is None:
+            return
+        # Fast at first so the opening words are already close to the target, then slow so it does not pump
+        alpha = 0.3 if self._speech_dbfs is None else 0.05
+        self._speech_dbfs = level if self._speech_dbfs is None else \
+            self._speech_dbfs + alpha * (level - self._speech_dbfs)
+        wanted = min(self.max_gain_db, max(-self.max_gain_db, self.target_dbfs - self._speech_dbfs))
+        self._gain_db += 0.2 * (wanted - self._gain_db)
+
+    def _encode(self, frames):
+        if not frames:
+            return b''
+        block = np.concatenate(frames)
+        if self.target_dbfs is None or abs(self._gain_db) < 0.1:
+            return block.tobytes()
+        samples = vad.ULAW_DECODE_TABLE[block].astype(np.float64) * 10 ** (self._gain_db / 20)
+        pcm = np.clip(np.rint(samples), -32768, 32767).astype(np.int16)
+        return ULAW_TABLE[pcm.view(np.uint16)].tobytes()
+
+
+def convert_eleven_pcm_to_twilio_mulaw(pcm_bytes):
+    """
+    One shot conversion of a whole PCM stream, equivalent to feeding it through a single PcmToMulawConverter.
+    """
+    converter = PcmToMulawConverter()
+    return converter.convert(pcm_bytes) + converter.flush()
 
 
 def convert_eleven_pcm_chunk_to_twilio_mulaw(chunk):
+    """
+    Original stateless pydub conversion of a single chunk.  Kept for comparison only, stream_audio uses
+    PcmToMulawConverter which keeps the filter state between chunks and does not need pydub.
+    """
+    from pydub import AudioSegment
+
     # Convert from PCM with 16kHz sample rate to PCM with 8kHz sample rate
     # The audio is assumed to have 1 channel and 2 bytes per sample (16 bits per sample)
-    xray_recorder.begin_subsegment('convert_pcm_to_mulaw')
-    xray_recorder.put_metadata('pcm_chunk_length', len(chunk))
     pcm_audio = AudioSegment(
         data=chunk,
         sample_width=2,  # 16 bits per sample
-        frame_rate=16000,  # 16kHz sample rate
+        frame_rate=ELEVEN_SAMPLE_RATE,  # 16kHz sample rate
         channels=1  # Mono
     )
-    resampled_pcm_audio = pcm_audio.set_frame_rate(8000)  # Resampling to 8kHz
+    resampled_pcm_audio = pcm_audio.set_frame_rate(TWILIO_SAMPLE_RATE)  # Resampling to 8kHz
     resampled_pcm_bytes = resampled_pcm_audio.raw_data
 
     # Convert PCM to µ-law
     mulaw_bytes = audioop.lin2ulaw(resampled_pcm_bytes, 2)  # 2 bytes per sample (16 bits)
-    xray_recorder.end_subsegment()
     return mulaw_bytes
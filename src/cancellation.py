@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+import threading
+import boto3
+
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Where cancel requests for a stream are kept.  memory only reaches streams in this process (server mode, tests),
+# on Lambda the stop and media events run in other containers than the start event, so use dynamodb there.
+CANCEL_BACKEND = os.environ.get('CANCEL_BACKEND', 'memory').lower()
+CANCEL_TABLE = os.environ.get('CANCEL_TABLE', '')
+# How often a streaming start event checks the shared backend, the memory backend is checked on every frame
+CANCEL_POLL_MS = int(os.environ.get('CANCEL_POLL_MS', '200'))
+CANCEL_TTL_SECONDS = int(os.environ.get('CANCEL_TTL_SECONDS', '3600'))
+
+# Reasons a stream is cancelled
+BARGE_IN = 'barge_in'
+STOP = 'stop'
+GONE = 'gone'
+
+
+class InMemoryCancelRegistry:
+    """
+    Cancel requests of the streams in this process, by stream sid.
+    """
+
+    poll_seconds = 0.0
+
+    def __init__(self, ttl_seconds=CANCEL_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._requests = {}  # stream sid -> (reason, requested at epoch seconds)
+        self._lock = threading.Lock()
+
+    def request_cancel(self, stream_sid, reason):
+        now = time.time()
+        with self._lock:
+            self._requests = {sid: request for sid, request in self._requests.items()
+                              if now - request[1] < self.ttl_seconds}
+            self._requests.setdefault(stream_sid, (reason, now))
+
+    def get(self, stream_sid):
+        """
+        Returns (reason, requested at epoch seconds) or None when the stream was not cancelled.
+        """
+        with self._lock:
+            return self._requests.get(stream_sid)
+
+
+class DynamoDbCancelRegistry:
+    """
+    Cancel requests shared by every container, one item per cancelled stream in a table with partition key
+    streamSid (string) and TTL attribute expiresAt.
+    """
+
+    poll_seconds = CANCEL_POLL_MS / 1000
+
+    def __init__(self, table_name, ttl_seconds=CANCEL_TTL_SECONDS, client=None):
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+        self.client = client or boto3.client('dynamodb')
+
+    def request_cancel(self, stream_sid, reason):
+        now = time.time()
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'streamSid': {'S': stream_sid},
+                    'reason': {'S': reason},
+                    'requestedAt': {'N': repr(now)},
+                    'expiresAt': {'N': str(int(now) + self.ttl_seconds)},
+                },
+                # The first reason wins, e.g. a barge in is not overwritten by the stop that follows
+                ConditionExpression='attribute_not_exists(streamSid)')
+        except self.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    def get(self, stream_sid):
+        item = self.client.get_item(TableName=self.table_name, Key={'streamSid': {'S': stream_sid}},
+                                    ConsistentRead=True).get('Item')
+        if item is None:
+            return None
+        return item['reason']['S'], float(item['requestedAt']['N'])
+
+
+def create_cancel_registry():
+    if CANCEL_BACKEND == 'dynamodb':
+        if not CANCEL_TABLE:
+            raise ValueError("CANCEL_BACKEND=dynamodb needs CANCEL_TABLE")
+        return DynamoDbCancelRegistry(CANCEL_TABLE)
+    if CANCEL_BACKEND == 'memory':
+        return InMemoryCancelRegistry()
+    raise ValueError(f"Unknown CANCEL_BACKEND {CANCEL_BACKEND}, use memory or dynamodb")
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = create_cancel_registry()
+        return _registry
+
+
+def request_cancel(stream_sid, reason):
+    logger.info(f"Cancel requested for stream {stream_sid}: {reason}")
+    get_registry().request_cancel(stream_sid, reason)
+
+
+class CancelToken(threading.Event):
+    """
+    Stop event for one outgoing stream.  Besides being set locally (e.g. the connection is gone) it turns set
+    when the registry has a cancel request for the stream, checked at most every poll_seconds.  Can be passed
+    as the cancel of streampipeline.run_pipeline, which only watches it.
+    """
+
+    def __init__(self, stream_sid, registry=None):
+        super().__init__()
+        self.stream_sid = stream_sid
+        self.registry = registry or get_registry()
+        self.reason = None
+        self.requested_at = None
+        self._next_check = 0.0
+        self._check_lock = threading.Lock()
+
+    def cancel(self, reason):
+        if not super().is_set():
+            self.reason, self.requested_at = reason, time.time()
+        self.set()
+
+    def is_set(self):
+        if super().is_set():
+            return True
+        now = time.monotonic()
+        if now < self._next_check or not self._check_lock.acquire(blocking=False):
+            return False
+        try:
+            self._next_check = now + self.registry.poll_seconds
+            request = self.registry.get(self.stream_sid)
+        except Exception as e:
+            logger.error(f"Checking cancel requests for stream {self.stream_sid} failed: {e}")
+            return False
+        finally:
+            self._check_lock.release()
+        if request is None:
+            return False
+        if not super().is_set():
+            self.reason, self.requested_at = request
+        self.set()
+        return True
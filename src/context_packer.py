@@ -0,0 +1,145 @@
+import os
+import re
+import sys
+import threading
+import metrics
+
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Packs the retrieved documents into a token budget before they are stuffed into the prompt.  The answer is one
+# or two sentences, a long context only adds time to first token and cost.
+CONTEXT_PACKING_ENABLED = os.environ.get('CONTEXT_PACKING_ENABLED', 'false').lower() == 'true'
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '1200'))
+# Word shingle overlap above which a document is a near duplicate of a better ranked one
+CONTEXT_DEDUP_THRESHOLD = float(os.environ.get('CONTEXT_DEDUP_THRESHOLD', '0.85'))
+# The last document is trimmed to what is left of the budget, unless that is less than this
+CONTEXT_MIN_DOCUMENT_TOKENS = int(os.environ.get('CONTEXT_MIN_DOCUMENT_TOKENS', '48'))
+CONTEXT_ENCODING = os.environ.get('CONTEXT_ENCODING', 'cl100k_base')  # gpt-35-turbo
+
+# How the stuff chain of RetrievalQAWithSourcesChain formats each document, and what it puts between them
+DOCUMENT_FORMAT = "Content: {page_content}\nSource: {source}"
+DOCUMENT_SEPARATOR = "\n\n"
+
+_SHINGLE_WORDS = 3
+_SENTENCE_END = re.compile(r'[.!?]["\')\]]*(\s|$)')
+
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    """
+    The tiktoken encoding, loaded on first use.  None when it cannot be loaded, e.g. tiktoken has to download
+    the BPE file and there is no internet access from the VPC, then token counts are estimated.
+    """
+    global _encoding, _encoding_failed
+    with _encoding_lock:
+        if _encoding is None and not _encoding_failed:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding(CONTEXT_ENCODING)
+            except Exception as e:
+                logger.warning(f"Could not load tiktoken encoding {CONTEXT_ENCODING}, estimating tokens: {e}")
+                _encoding_failed = True
+        return _encoding
+
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    Cuts text to at most max_tokens, back to the last complete sentence when there is one.
+    """
+    encoding = get_encoding()
+    if encoding is None:
+        cut = text[:max(0, (max_tokens - 1) * 4)]
+    else:
+        tokens = encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        cut = encoding.decode(tokens[:max_tokens])
+    ends = [match.end() for match in _SENTENCE_END.finditer(cut)]
+    return cut[:ends[-1]].rstrip() if ends else cut
+
+
+def format_document(page_content, metadata):
+    return DOCUMENT_FORMAT.format(page_content=page_content, source=(metadata or {}).get('source', ''))
+
+
+def _shingles(text):
+    words = re.findall(r'\w+', text.lower())
+    return {tuple(words[i:i + _SHINGLE_WORDS]) for i in range(max(1, len(words) - _SHINGLE_WORDS + 1))}
+
+
+def is_near_duplicate(shingles, kept_shingles, threshold=CONTEXT_DEDUP_THRESHOLD):
+    """
+    True when most of this document's shingles are in a kept document, which also catches a document that is
+    contained in a longer one.
+    """
+    return any(len(shingles & kept) / max(1, min(len(shingles), len(kept))) >= threshold
+               for kept in kept_shingles)
+
+
+def pack(documents, budget=CONTEXT_TOKEN_BUDGET, dedup_threshold=CONTEXT_DEDUP_THRESHOLD,
+         min_document_tokens=CONTEXT_MIN_DOCUMENT_TOKENS):
+    """
+    Keeps the documents that fit the token budget, best ranked first.  Near duplicates of a kept document are
+    dropped and the first document that does not fit is trimmed to the rest of the budget.
+    :param documents: [(page_content, metadata)] in retrieval order, nearest first
+    :return: ([(page_content, metadata)], stats)
+    """
+    packed = []
+    kept_shingles = []
+    used = 0
+    stats = {'retrieved': len(documents), 'duplicates': 0, 'trimmed': 0}
+    for page_content, metadata in documents:
+        shingles = _shingles(page_content)
+        if is_near_duplicate(shingles, kept_shingles, dedup_threshold):
+            stats['duplicates'] += 1
+            continue
+
+        separator = count_tokens(DOCUMENT_SEPARATOR) if packed else 0
+        tokens = count_tokens(format_document(page_content, metadata)) + separator
+        if used + tokens <= budget:
+            packed.append((page_content, metadata))
+            kept_shingles.append(shingles)
+            used += tokens
+            continue
+
+        # Room for part of it, the format around the content costs tokens too
+        overhead = count_tokens(format_document('', metadata)) + separator
+        room = budget - used - overhead
+        if room >= min_document_tokens:
+            trimmed = truncate_to_tokens(page_content, room)
+            packed.append((trimmed, metadata))
+            used += count_tokens(format_document(trimmed, metadata)) + separator
+            stats['trimmed'] += 1
+        # The budget is spent, the rest ranks lower than what was cut
+        break
+
+    stats['packed'] = len(packed)
+    stats['dropped'] = stats['retrieved'] - stats['packed'] - stats['duplicates']
+    stats['context_tokens'] = used
+    return packed, stats
+
+
+def record(stats, prompt_tokens, **properties):
+    """
+    Records the prompt size of one query.
+    """
+    metrics.record('context_tokens', stats['context_tokens'], unit='Count', **properties)
+    metrics.record('prompt_tokens', prompt_tokens, unit='Count', **properties)
+    metrics.count('context_documents_dropped', stats['dropped'] + stats['duplicates'], **properties)
@@ -0,0 +1,210 @@
+import os
+import sys
+import threading
+import cancellation
+import deadlines
+import fillers
+import metrics
+import stt
+import vad
+
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Conversation mode keeps one media stream open for the whole call.  The endpointer finds the end of each
+# utterance on the inbound track, the audio goes to speech to text and the answer is spoken on the same stream,
+# so a turn skips the mark redirect, <Gather>, /twilio/respond and the new websocket.
+#
+# The session lives in the process that receives the stream's events.  That holds for the server mode, where
+# one process owns the websocket.  On Lambda API Gateway spreads the media events over containers and nothing
+# redirects the turn marks, so conversation mode is refused there and the call keeps the gather cycle.
+ON_LAMBDA = 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+# Same switch as the http handler's, speak the answer sentence by sentence while the LLM is still generating
+ANSWER_STREAMING = os.environ.get('ANSWER_STREAMING', 'false').lower() == 'true'
+# Marks of conversation turns, they are not redirected like the eoaCallSid mark of the gather cycle
+TURN_MARK_PREFIX = 'eoaTurn'
+_MAX_SESSIONS = 1000
+
+# Turns are only ever cancelled in this process, so their tokens do not poll a shared cancel backend
+_turn_registry = cancellation.InMemoryCancelRegistry()
+
+
+class ConversationSession:
+    """
+    State of one call in conversation mode.  Media frames are fed from the websocket events, each turn (the
+    greeting, then one per utterance) is spoken by a worker thread so frames keep coming in while it plays.
+    A new turn cancels the one before it, and speech while a turn is playing clears Twilio's buffered audio.
+    """
+
+    def __init__(self, stream_sid, call_sid, connection_id, speech_to_text=None, endpointer=None):
+        self.stream_sid = stream_sid
+        self.call_sid = call_sid
+        self.connection_id = connection_id
+        self.speech_to_text = speech_to_text or stt.get_speech_to_text()
+        self.endpointer = endpointer or vad.Endpointer()
+        self.turn = 0
+        self.playing_mark = None  # mark of the turn Twilio is playing, until Twilio echoes it back
+        self.closed = False
+        self._cancel = None
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def greet(self, text):
+        import websocket_handler
+
+        def speak(cancel, mark):
+            self.playing_mark = mark
+            websocket_handler.stream_audio(self.stream_sid, self.connection_id, text, self.call_sid,
+                                           cancel=cancel, mark_name=mark)
+
+        self._start_turn(speak)
+
+    def on_media(self, mulaw_bytes):
+        was_in_speech = self.endpointer.in_speech
+        utterance = self.endpointer.push(mulaw_bytes)
+        if not was_in_speech and self.endpointer.in_speech and self.playing_mark is not None:
+            self.barge_in()
+        if utterance is not None:
+            metrics.record('utterance_ms', len(utterance) * 1000 / vad.MULAW_SAMPLE_RATE, call_sid=self.call_sid)
+            self._start_turn(lambda cancel, mark: self._answer(utterance, cancel, mark))
+
+    def on_mark(self, mark_name):
+        if mark_name == self.playing_mark:
+            self.playing_mark = None
+
+    def barge_in(self):
+        import websocket_handler
+
+        logger.info(f"Caller started speaking on stream {self.stream_sid}, cancelling turn {self.turn}")
+        metrics.count('barge_in_detected', mode='conversation')
+        with self._lock:
+            cancel = self._cancel
+        if cancel is not None:
+            cancel.cancel(cancellation.BARGE_IN)
+        # The turn may have posted all its audio already, Twilio still has it buffered
+        websocket_handler.send_clear(self.stream_sid, self.connection_id)
+        self.playing_mark = None
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            cancel = self._cancel
+        if cancel is not None:
+            cancel.cancel(cancellation.STOP)
+
+    def wait(self):
+        with self._lock:
+            worker = self._worker
+        if worker is not None:
+            worker.join()
+
+    def _answer(self, utterance, cancel, mark):
+        import websocket_handler
+
+        # The turn's budget starts when the caller stops speaking
+        deadline = deadlines.for_turn()
+        with metrics.span('stt', call_sid=self.call_sid):
+            question = self.speech_to_text.transcribe(utterance)
+        if not question or cancel.is_set():
+            logger.info(f"Nothing to answer on stream {self.stream_sid}, transcript: {question!r}")
+            return
+        logger.info(f"Caller said: {question}")
+
+        if ANSWER_STREAMING:
+            self.playing_mark = mark
+            websocket_handler.stream_answer_audio(self.stream_sid, self.connection_id, question, self.call_sid,
+                                                  cancel=cancel, mark_name=mark, deadline=deadline)
+            return
+
+        import query_lambda
+        def answer_once():
+            yield query_lambda.query_chatgpt(question, deadline=deadline)
+
+        with metrics.span('speech_to_answer', call_sid=self.call_sid, mode='conversation'):
+            answers = answer_once()
+            filler_set = fillers.get_fillers()
+            if filler_set is not None:
+                post_filler = websocket_handler.filler_player(
+                    self.connection_id, websocket_handler.MediaMessageBuilder(self.stream_sid), cancel=cancel)
+
+                def play(mulaw_audio):
+                    # Speech over the filler is a barge in like speech over the answer
+                    self.playing_mark = mark
+                    post_filler(mulaw_audio)
+
+                answers = fillers.mask_latency(answers, play, filler_set, call_sid=self.call_sid)
+            answer = next(answers)
+        if cancel.is_set():
+            return
+        self.playing_mark = mark
+        websocket_handler.stream_audio(self.stream_sid, self.connection_id, answer, self.call_sid,
+                                       cancel=cancel, mark_name=mark, deadline=deadline)
+
+    def _start_turn(self, speak):
+        with self._lock:
+            if self.closed:
+                return
+            previous, previous_cancel = self._worker, self._cancel
+            self.turn += 1
+            mark = f'{TURN_MARK_PREFIX}{self.turn}'
+            cancel = cancellation.CancelToken(f'{self.stream_sid}/{self.turn}', registry=_turn_registry)
+            self._cancel = cancel
+            self._worker = threading.Thread(target=self._run_turn, args=(speak, cancel, mark, previous),
+                                            name=f'turn-{self.stream_sid}-{self.turn}', daemon=True)
+            worker = self._worker
+        if previous_cancel is not None:
+            # The caller spoke again before the last answer was out, that answer is stale
+            previous_cancel.cancel(cancellation.BARGE_IN)
+        worker.start()
+
+    def _run_turn(self, speak, cancel, mark, previous):
+        # One turn posts to the stream at a time, the cancelled one stops at its next frame
+        if previous is not None:
+            previous.join()
+        try:
+            speak(cancel, mark)
+        except Exception as e:
+            logger.error(f"Conversation turn {mark} on stream {self.stream_sid} failed: {e}")
+            if self.playing_mark == mark:
+                self.playing_mark = None
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def start_session(stream_sid, call_sid, connection_id, greeting=None):
+    if ON_LAMBDA:
+        raise RuntimeError("Conversation mode needs the server mode, on Lambda keep the gather cycle")
+    session = ConversationSession(stream_sid, call_sid, connection_id)
+    with _sessions_lock:
+        if len(_sessions) >= _MAX_SESSIONS:
+            logger.warning(f"{len(_sessions)} conversation sessions open, dropping them")
+            for stale in _sessions.values():
+                stale.close()
+            _sessions.clear()
+        _sessions[stream_sid] = session
+    logger.info(f"Conversation session started for stream {stream_sid}")
+    if greeting:
+        session.greet(greeting)
+    return session
+
+
+def get_session(stream_sid):
+    with _sessions_lock:
+        return _sessions.get(stream_sid)
+
+
+def end_session(stream_sid):
+    with _sessions_lock:
+        session = _sessions.pop(stream_sid, None)
+    if session is not None:
+        session.close()
+        logger.info(f"Conversation session ended for stream {stream_sid} after {session.turn} turns")
+    return session
@@ -0,0 +1,216 @@
+import os
+import sys
+import time
+import queue
+import threading
+import metrics
+
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# A turn has a latency budget from the caller's question to the first audio of the answer.  With deadlines on,
+# the LLM and TTS calls are bounded by it, hedged when they are slow, and replaced by a canned answer or canned
+# audio when the budget runs out, instead of leaving the caller in silence.
+DEADLINE_ENABLED = os.environ.get('DEADLINE_ENABLED', 'false').lower() == 'true'
+DEADLINE_TURN_MS = float(os.environ.get('DEADLINE_TURN_MS', '8000'))
+# Text to speech always gets at least this long to its first byte, even when the LLM used up the turn budget
+DEADLINE_TTS_MIN_MS = float(os.environ.get('DEADLINE_TTS_MIN_MS', '2500'))
+# A second attempt is started when the first one has not returned after this long (about the p95), 0 turns
+# hedging off.  A hedge costs a second request, so keep these in the tail.
+HEDGE_LLM_AFTER_MS = float(os.environ.get('HEDGE_LLM_AFTER_MS', '3000'))
+HEDGE_TTS_AFTER_MS = float(os.environ.get('HEDGE_TTS_AFTER_MS', '800'))
+DEADLINE_FALLBACK_ANSWER = os.environ.get(
+    'DEADLINE_FALLBACK_ANSWER', "Sorry, I'm having trouble looking that up right now. Could you ask me again?")
+# µ-law audio played when text to speech misses the deadline, synthesized ahead of time (python src/deadlines.py)
+DEADLINE_FALLBACK_AUDIO = os.environ.get('DEADLINE_FALLBACK_AUDIO', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'fillers', 'fallback', 'fallback.ulaw'))
+
+_fallback_audio = None
+_fallback_audio_loaded = False
+_fallback_audio_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """
+    A point in wall clock time, so it can be passed to another invocation as epoch milliseconds.
+    """
+
+    def __init__(self, budget_ms=None, expires_at=None):
+        self.expires_at = expires_at if expires_at is not None else time.time() + budget_ms / 1000
+
+    @classmethod
+    def at(cls, epoch_ms):
+        return cls(expires_at=float(epoch_ms) / 1000)
+
+    @property
+    def epoch_ms(self):
+        return int(self.expires_at * 1000)
+
+    def remaining_ms(self):
+        return max(0.0, (self.expires_at - time.time()) * 1000)
+
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    def at_least(self, budget_ms):
+        """
+        This deadline, or one budget_ms from now if that is later.
+        """
+        return Deadline(expires_at=max(self.expires_at, time.time() + budget_ms / 1000))
+
+
+def for_turn():
+    """
+    A new turn deadline, or None when deadlines are off.
+    """
+    return Deadline(DEADLINE_TURN_MS) if DEADLINE_ENABLED else None
+
+
+def call(fn, deadline, hedge_after_ms=0, stage='call', discard=None):
+    """
+    Returns fn() if it finishes before the deadline, otherwise raises DeadlineExceeded.  With hedge_after_ms a
+    second attempt starts when the first has not returned by then, or right away when the first fails, and the
+    first to succeed wins.  Attempts run in threads that cannot be stopped, a late result is passed to discard.
+    Records hedge_fired (0/1) per call and hedge_won (0/1, the second attempt won) per fired hedge.
+    """
+    results = queue.Queue()
+    decided = []
+    lock = threading.Lock()
+
+    def attempt(number):
+        try:
+            result = (number, True, fn())
+        except Exception as e:
+            result = (number, False, e)
+        with lock:
+            late = bool(decided)
+            if not late:
+                results.put(result)
+        if late and result[1] and discard is not None:
+            discard(result[2])
+
+    def start(number):
+        threading.Thread(target=attempt, args=(number,), name=f'{stage}-attempt-{number}', daemon=True).start()
+
+    def decide():
+        with lock:
+            decided.append(True)
+            late = []
+            while not results.empty():
+                late.append(results.get_nowait())
+        for _, ok, value in late:
+            if ok and discard is not None:
+                discard(value)
+
+    start(0)
+    hedge_at = time.time() + hedge_after_ms / 1000 if hedge_after_ms > 0 else None
+    hedged = False
+    running = 1
+    while True:
+        wake_at = deadline.expires_at if hedged or hedge_at is None else min(hedge_at, deadline.expires_at)
+        try:
+            number, ok, value = results.get(timeout=max(0.0, wake_at - time.time()))
+        except queue.Empty:
+            if deadline.expired():
+                decide()
+                metrics.count('hedge_fired', int(hedged), stage=stage)
+                metrics.count('deadline_exceeded', stage=stage)
+                raise DeadlineExceeded(f"{stage} missed its deadline")
+            logger.info(f"{stage} slower than {hedge_after_ms:.0f} ms, starting a hedged attempt")
+            hedged = True
+            running += 1
+            start(1)
+            continue
+
+        running -= 1
+        if ok:
+            decide()
+            metrics.count('hedge_fired', int(hedged), stage=stage)
+            if hedged:
+                metrics.count('hedge_won', int(number == 1), stage=stage)
+            return value
+        logger.warning(f"{stage} attempt {number} failed: {value}")
+        if running == 0:
+            if hedged or hedge_at is None or deadline.expired():
+                decide()
+                raise value
+            # The hedge doubles as the retry
+            hedged = True
+            running += 1
+            start(1)
+
+
+def hedged_stream(open_stream, deadline, hedge_after_ms=0, stage='stream'):
+    """
+    Iterates the stream open_stream() returns, with the deadline and hedging (see call) applied to its first
+    chunk, e.g. the first audio of a TTS request.  The stream that loses is closed.
+    """
+
+    def first_chunk():
+        stream = open_stream()
+        try:
+            return stream, next(stream)
+        except StopIteration:
+            return stream, None
+        except Exception:
+            _close(stream)
+            raise
+
+    stream, first = call(first_chunk, deadline, hedge_after_ms, stage, discard=lambda result: _close(result[0]))
+    try:
+        if first is None:
+            return
+        yield first
+        yield from stream
+    finally:
+        _close(stream)
+
+
+def _close(stream):
+    close = getattr(stream, 'close', None)
+    if close is not None:
+        close()
+
+
+def get_fallback_audio():
+    """
+    The canned µ-law audio for a missed TTS deadline, None when there is no file.
+    """
+    global _fallback_audio, _fallback_audio_loaded
+    with _fallback_audio_lock:
+        if not _fallback_audio_loaded:
+            _fallback_audio_loaded = True
+            try:
+                with open(DEADLINE_FALLBACK_AUDIO, 'rb') as f:
+                    _fallback_audio = f.read()
+            except OSError as e:
+                logger.warning(f"No fallback audio, a missed TTS deadline will be silent: {e}")
+        return _fallback_audio
+
+
+def synthesize_fallback(path=DEADLINE_FALLBACK_AUDIO, text=DEADLINE_FALLBACK_ANSWER):
+    """
+    Synthesizes the canned answer into the fallback audio file, at build time.
+    """
+    import eleven
+    import websocket_handler
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    audio = b''.join(websocket_handler.convert_to_frames(eleven.say_stream(text)))
+    with open(path, 'wb') as f:
+        f.write(audio)
+    logger.info(f"Saved fallback audio {path}: {len(audio)} bytes")
+
+
+if __name__ == '__main__':
+    synthesize_fallback(*sys.argv[1:2])
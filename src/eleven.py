@@ -1,8 +1,15 @@
+import os
 import sys
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import utils
-from elevenlabs import generate, Voice, VoiceSettings
-from elevenlabs_monkey_patch import apply_patch
-from aws_xray_sdk.core import xray_recorder
+from elevenlabs import TTS, Voice, VoiceSettings
+from elevenlabs.api.model import Model
+from elevenlabs_monkey_patch import apply_patch, preconnect, ELEVENLABS_READ_TIMEOUT
+import sentences
+import metrics
+import deadlines
 # Initialize logging
 import logging
 from loguru import logger
@@ -12,37 +19,219 @@ logger.add(sys.stdout, format="{time} {level} {message}")
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-apply_patch()
+# ulaw_8000 skips the resampling and µ-law encoding in audioconvert, pcm_16000 is the fallback
+OUTPUT_FORMAT = os.environ.get('ELEVENLABS_OUTPUT_FORMAT', 'pcm_16000')
+apply_patch(OUTPUT_FORMAT)
 
+# The keep-alive TTS connection opened ahead of the first utterance, started by lambda_function's init
+_preconnect_thread = None
+_preconnect_lock = threading.Lock()
 
-def say_stream(text):
+MODEL_ID = "eleven_monolingual_v1"
+VOICE_SETTINGS = VoiceSettings(stability=0.71, similarity_boost=0.5, style=0.0, use_speaker_boost=True)
+STREAMING_LATENCY = 4
+
+# Parallel mode splits longer text at sentence (or clause) boundaries and synthesizes the chunks concurrently.
+# The audio is still played in order, the first chunk streams live while the later ones buffer.
+TTS_PARALLEL_ENABLED = os.environ.get('TTS_PARALLEL', 'false').lower() == 'true'
+# Requests in flight per call, keep TTS_PARALLEL_WORKERS x TTS_PARALLEL_CALLS within the eleven labs plan's
+# concurrency limit
+TTS_PARALLEL_WORKERS = int(os.environ.get('TTS_PARALLEL_WORKERS', '3'))
+# Calls synthesizing at once in this process (server mode), sizes the shared pool so a call's chunks do not
+# queue behind another call's.  A Lambda container serves one call at a time.
+TTS_PARALLEL_CALLS = int(os.environ.get('TTS_PARALLEL_CALLS', '1' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+                                        else '8'))
+# Chunks shorter than this are merged with the next sentence, very short requests sound clipped
+TTS_PARALLEL_MIN_CHARS = int(os.environ.get('TTS_PARALLEL_MIN_CHARS', '60'))
+# Longer sentences are split at clause boundaries
+TTS_PARALLEL_MAX_CHARS = int(os.environ.get('TTS_PARALLEL_MAX_CHARS', '250'))
+
+_executor = None
+_executor_lock = threading.Lock()
+_CHUNK_DONE = object()
+
+
+def synthesis_params():
+    """
+    Everything besides the text that changes the generated audio, including the silence trimming and
+    normalization applied before it is cached.  Used to key the audio cache.
+    """
+    import websocket_handler
+
+    return {
+        'voice_id': utils.get_ssm_param('elevenLabsVoiceId'),
+        'model_id': MODEL_ID,
+        'voice_settings': VOICE_SETTINGS.model_dump(),
+        'output_format': OUTPUT_FORMAT,
+        'latency': STREAMING_LATENCY,
+        'silence_trim': websocket_handler.silence_trim_params(),
+    }
+
+
+def start_preconnect():
+    """
+    Starts the preconnect in the background, once per container.  Returns its thread.
+    """
+    global _preconnect_thread
+    with _preconnect_lock:
+        if _preconnect_thread is None:
+            _preconnect_thread = threading.Thread(target=preconnect, name='eleven-preconnect', daemon=True)
+            _preconnect_thread.start()
+        return _preconnect_thread
+
+
+def wait_preconnect(timeout=None):
+    start_preconnect().join(timeout)
+
+
+def say_stream(text, previous_text=None, next_text=None, deadline=None):
     """
       Streams audio to the websocket from elevenlabs back to Twilio and send a mark
       message to Twilio to signal the end of the audio stream.  This must be invoked
       asynchronously.
 
-      For Eleven Labs API returns we must use the Monkey Patch for the moment to get PCM audio instead of MP3.
-      We need to down sample the audio from 16kHz to 8kHz and convert from PCM to µ-law for twilio.
-      The conversion is done using pydub and pydub using ffmpeg, so we need to install ffmpeg in the Dockerfile.
+      For Eleven Labs API returns we must use the Monkey Patch for the moment to get PCM or µ-law audio instead of MP3.
+      With ELEVENLABS_OUTPUT_FORMAT=ulaw_8000 the audio is already what twilio plays.  With pcm_16000
+      we need to down sample the audio from 16kHz to 8kHz and convert from PCM to µ-law for twilio.
+      The conversion is done with a streaming NumPy resampler in audioconvert, so no ffmpeg is needed.
+
+      previous_text and next_text are the text around this one when it is part of a longer utterance.
+      With a deadlines.Deadline the first audio is hedged after HEDGE_TTS_AFTER_MS, and the stream raises
+      DeadlineExceeded when there is none by the deadline.
       """
-    # TODO: The chunk size should be a multiple of the sample size to avoid any cut-off or padding issues.
+    if deadline is not None:
+        return deadlines.hedged_stream(lambda: say_stream(text, previous_text, next_text), deadline,
+                                       deadlines.HEDGE_TTS_AFTER_MS, stage='tts')
+
+    # Chunks can end in the middle of a sample, audioconvert carries the odd byte over to the next chunk.
     logger.info(f"Calling eleven labs with text length: {len(text)} and text: {text}")
     elevenlabs_api_key = utils.get_ssm_param('elevenLabsApiKey')
     voice_id = utils.get_ssm_param('elevenLabsVoiceId')
     logger.info(f"Eleven labs API key first 4 chars (avoid max chars error): {elevenlabs_api_key[:4]}")
-    xray_recorder.begin_subsegment('eleven_labs_generate_stream')
-    xray_recorder.put_metadata('eleven_labs_text_to_generate', text)
-    audio_stream = generate(
-        text=text,
-        api_key=elevenlabs_api_key,
-        stream_chunk_size=2048,
-        latency=4,
-        model="eleven_monolingual_v1",
-        voice=Voice(
+    # The patched TTS.generate_stream directly, generate() has no way to pass the context text.  Nothing is
+    # requested until the stream is read, the patch records the time to its first byte as tts_first_byte_ms.
+    return TTS.generate_stream(
+        text,
+        Voice(
             voice_id=voice_id,
-            settings=VoiceSettings(stability=0.71, similarity_boost=0.5, style=0.0, use_speaker_boost=True)
+            settings=VOICE_SETTINGS
         ),
-        stream=True
+        Model(model_id=MODEL_ID),
+        2048,
+        api_key=elevenlabs_api_key,
+        latency=STREAMING_LATENCY,
+        output_format=OUTPUT_FORMAT,
+        previous_text=previous_text,
+        next_text=next_text,
     )
-    xray_recorder.end_subsegment()
-    return audio_stream
+
+
+def split_for_synthesis(text, min_chars=TTS_PARALLEL_MIN_CHARS, max_chars=TTS_PARALLEL_MAX_CHARS):
+    """
+    Splits text into chunks of whole sentences, merging short ones, and splits sentences longer than max_chars
+    after a comma, semicolon or colon.
+    """
+    pieces = []
+    for sentence in sentences.split_sentences(text, min_chars=1):
+        while len(sentence) > max_chars:
+            cut = max(sentence.rfind(mark, 0, max_chars) for mark in (', ', '; ', ': '))
+            if cut < min_chars:
+                break
+            pieces.append(sentence[:cut + 1])
+            sentence = sentence[cut + 2:]
+        pieces.append(sentence)
+
+    chunks = []
+    for piece in pieces:
+        if chunks and len(chunks[-1]) < min_chars:
+            chunks[-1] += ' ' + piece
+        else:
+            chunks.append(piece)
+    # A short tail goes with the chunk before it
+    if len(chunks) > 1 and len(chunks[-1]) < min_chars:
+        tail = chunks.pop()
+        chunks[-1] += ' ' + tail
+    return chunks
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # The first chunk of each call is fetched by the caller, the pool only prefetches the ones after it
+            _executor = ThreadPoolExecutor(max_workers=max(1, (TTS_PARALLEL_WORKERS - 1) * TTS_PARALLEL_CALLS),
+                                           thread_name_prefix='tts-chunk')
+        return _executor
+
+
+def say_stream_parallel(text, deadline=None):
+    """
+    Same audio stream as say_stream, but the text is synthesized in chunks, up to TTS_PARALLEL_WORKERS at once.
+    The first chunk streams live on the caller's thread, so it never waits for the shared pool.  The later ones
+    are prefetched into their own queues, a new one starts as the one before it starts playing, and the queues
+    are drained in order.  Each request gets the neighbouring chunks as context.  Closing the stream cancels
+    the chunks not started and stops the ones in flight.  The deadline applies to the first chunk, the others
+    are buffered by the time they play.  Raises TimeoutError when a chunk sends nothing for
+    ELEVENLABS_READ_TIMEOUT seconds.
+    """
+    chunks = split_for_synthesis(text)
+    if len(chunks) < 2:
+        yield from say_stream(text, deadline=deadline)
+        return
+
+    logger.info(f"Synthesizing {len(chunks)} chunks in parallel")
+    metrics.record('tts_parallel_chunks', len(chunks), unit='Count')
+    abandoned = threading.Event()
+    queues = [queue.Queue() for _ in chunks]
+
+    def context(index):
+        return ' '.join(chunks[:index]) or None, ' '.join(chunks[index + 1:]) or None
+
+    def fetch(index):
+        audio_stream = None
+        try:
+            previous_text, next_text = context(index)
+            audio_stream = say_stream(chunks[index], previous_text=previous_text, next_text=next_text)
+            for audio in audio_stream:
+                if abandoned.is_set():
+                    break
+                queues[index].put(audio)
+        except Exception as e:
+            queues[index].put(e)
+        finally:
+            if audio_stream is not None:
+                audio_stream.close()
+            queues[index].put(_CHUNK_DONE)
+
+    futures = []
+
+    def prefetch_until(last):
+        while len(futures) < min(last, len(chunks) - 1):
+            futures.append(_get_executor().submit(fetch, len(futures) + 1))
+
+    try:
+        prefetch_until(TTS_PARALLEL_WORKERS - 1)
+        previous_text, next_text = context(0)
+        yield from say_stream(chunks[0], previous_text=previous_text, next_text=next_text, deadline=deadline)
+        for index in range(1, len(chunks)):
+            prefetch_until(index + TTS_PARALLEL_WORKERS - 1)
+            stopwatch = metrics.Stopwatch()
+            first = True
+            while True:
+                try:
+                    audio = queues[index].get(timeout=ELEVENLABS_READ_TIMEOUT)
+                except queue.Empty:
+                    raise TimeoutError(f"No audio for chunk {index} in {ELEVENLABS_READ_TIMEOUT} seconds")
+                if first:
+                    # Time the caller would hear a gap at this join, 0 when the chunk was already buffered
+                    metrics.record('tts_join_wait_ms', stopwatch.elapsed_ms(), chunk=index)
+                first = False
+                if audio is _CHUNK_DONE:
+                    break
+                if isinstance(audio, Exception):
+                    raise audio
+                yield audio
+    finally:
+        abandoned.set()
+        for future in futures:
+            future.cancel()
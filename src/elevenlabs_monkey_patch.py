@@ -1,14 +1,111 @@
-# TODO: The ONLY thing this monkey patch is doing is adding this query parameter: &output_format=pcm_16000
+# TODO: The ONLY thing this monkey patch is doing is adding the output_format query parameter, e.g. &output_format=pcm_16000
 # TODO: Remove this patch when they add the output_format param to the python API
 # TODO: See https://github.com/elevenlabs/elevenlabs-python/issues/111
+# It also sends the request through a pooled keep-alive session instead of a new connection per utterance.
+import os
+import sys
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from typing import Iterator, Optional  # Monkey patch
 from elevenlabs import TTS  # Monkey patch
 from elevenlabs.api.model import Model  # Monkey patch
-from elevenlabs.api.base import API, api_base_url_v1  # Monkey patch
+from elevenlabs.api.base import api_base_url_v1  # Monkey patch
+from elevenlabs.api.error import APIError
 from elevenlabs import Voice
+import metrics
 
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+SUPPORTED_OUTPUT_FORMATS = ('pcm_16000', 'ulaw_8000')
+
+ELEVENLABS_POOL_SIZE = int(os.environ.get('ELEVENLABS_POOL_SIZE', '4'))
+ELEVENLABS_CONNECT_TIMEOUT = float(os.environ.get('ELEVENLABS_CONNECT_TIMEOUT', '3'))
+ELEVENLABS_READ_TIMEOUT = float(os.environ.get('ELEVENLABS_READ_TIMEOUT', '15'))
+
+# Connect time of the last new connection opened by this thread, reset for each request
+_connect_timing = threading.local()
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connect_timing.connect_ms = (time.perf_counter() - start) * 1000
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()  # DNS, TCP and TLS handshake
+        _connect_timing.connect_ms = (time.perf_counter() - start) * 1000
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedAdapter(HTTPAdapter):
+    """
+    Keep-alive adapter whose connections record how long they took to open.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+def _create_session():
+    session = requests.Session()
+    adapter = _TimedAdapter(pool_connections=1, pool_maxsize=ELEVENLABS_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+session = _create_session()
+
+
+def preconnect():
+    """
+    Opens a keep-alive connection to the TTS endpoint so the first utterance skips DNS, TCP and TLS setup.
+    lambda_function starts it in the background at init.  Failures are ignored, the request just connects on demand.
+    """
+    _connect_timing.connect_ms = 0.0
+    try:
+        session.head(api_base_url_v1, timeout=(ELEVENLABS_CONNECT_TIMEOUT, ELEVENLABS_CONNECT_TIMEOUT))
+    except requests.RequestException as e:
+        logger.warning(f"Eleven labs preconnect failed, will connect on first request: {e}")
+        return None
+    return _connect_timing.connect_ms
+
+
+def apply_patch(output_format='pcm_16000'):
+    """
+    :param output_format: pcm_16000 (resampled and encoded by audioconvert) or ulaw_8000 (already what Twilio
+                          plays, passed straight through)
+    """
+    if output_format not in SUPPORTED_OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported eleven labs output format {output_format}, use one of {SUPPORTED_OUTPUT_FORMATS}")
 
-def apply_patch():
     def my_generate_stream(
             text: str,
             voice: Voice,
@@ -16,17 +113,52 @@ def apply_patch():
             stream_chunk_size: int = 2048,
             api_key: Optional[str] = None,
             latency: int = 1,
+            output_format: str = output_format,
+            previous_text: Optional[str] = None,
+            next_text: Optional[str] = None,
     ) -> Iterator[bytes]:
-        url = f"{api_base_url_v1}/text-to-speech/{voice.voice_id}/stream?optimize_streaming_latency={latency}&output_format=pcm_16000"
-        print("Monkey patch URL: " + url)
+        # generate() passes its own default (mp3), which audioconvert would decode as PCM.  Callers pass the
+        # configured format explicitly, anything else is an error rather than noise on the call.
+        if output_format not in SUPPORTED_OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported eleven labs output format {output_format}, pass one of {SUPPORTED_OUTPUT_FORMATS}")
+        url = f"{api_base_url_v1}/text-to-speech/{voice.voice_id}/stream?optimize_streaming_latency={latency}&output_format={output_format}"
+        logger.info(f"Monkey patch URL: {url}")
         data = dict(
             text=text,
             model_id=model.model_id,
             voice_settings=voice.settings.model_dump() if voice.settings else None,
         )  # type: ignore
-        response = API.post(url, json=data, stream=True, api_key=api_key)
-        for chunk in response.iter_content(chunk_size=stream_chunk_size):
-            if chunk:
-                yield chunk
+        # Text around a chunk of a longer utterance, so the prosody carries across the joins
+        if previous_text:
+            data['previous_text'] = previous_text
+        if next_text:
+            data['next_text'] = next_text
+        headers = {"xi-api-key": api_key or os.environ.get("ELEVEN_API_KEY")}
+
+        _connect_timing.connect_ms = 0.0
+        start = time.perf_counter()
+        response = session.post(url, json=data, headers=headers, stream=True,
+                                timeout=(ELEVENLABS_CONNECT_TIMEOUT, ELEVENLABS_READ_TIMEOUT))
+        # Read in the thread that sent the request, the stream may be read on from another one
+        connect_ms = _connect_timing.connect_ms
+        if response.status_code != 200:
+            raise APIError(response.text, str(response.status_code))
+
+        first_chunk = True
+        try:
+            for chunk in response.iter_content(chunk_size=stream_chunk_size):
+                if chunk:
+                    if first_chunk:
+                        first_chunk = False
+                        first_byte_ms = (time.perf_counter() - start) * 1000
+                        metrics.record(metrics.TTS_FIRST_BYTE, first_byte_ms, connect_ms=connect_ms,
+                                       text_length=len(text))
+                        metrics.record('tts_connect_ms', connect_ms)
+                        metrics.record('tts_wait_first_byte_ms', first_byte_ms - connect_ms)
+                        metrics.count('tts_reused_connection', int(connect_ms == 0.0))
+                    yield chunk
+        finally:
+            # Returns the connection to the pool, or drops it if the stream was abandoned part way
+            response.close()
 
     TTS.generate_stream = my_generate_stream  # Monkey patch
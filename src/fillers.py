@@ -0,0 +1,154 @@
+import os
+import re
+import sys
+import queue
+import threading
+import metrics
+
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Latency masking: when the answer is not ready within FILLER_THRESHOLD_MS a short filler phrase is played on
+# the media stream, and the answer is queued right behind it.  The fillers are µ-law files synthesized ahead
+# of time (python src/fillers.py DIR), held in memory, so playing one never calls text to speech.
+FILLERS_ENABLED = os.environ.get('FILLERS_ENABLED', 'false').lower() == 'true'
+FILLER_THRESHOLD_MS = float(os.environ.get('FILLER_THRESHOLD_MS', '700'))
+FILLER_AUDIO_DIR = os.environ.get('FILLER_AUDIO_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                    'fillers'))
+FILLER_PHRASES = [phrase.strip() for phrase in os.environ.get(
+    'FILLER_PHRASES', "Let me check on that.|One moment.|Good question, let me look that up.").split('|')
+                  if phrase.strip()]
+FILLER_EXTENSION = '.ulaw'  # raw 8 kHz µ-law, frame aligned, the bytes that go in the media messages
+
+
+class FillerSet:
+    """
+    Filler audio held in memory, handed out in rotation so the caller does not hear the same one twice in a row.
+    """
+
+    def __init__(self, fillers):
+        """
+        :param fillers: [(name, µ-law bytes)]
+        """
+        self.fillers = list(fillers)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, directory=FILLER_AUDIO_DIR):
+        names = sorted(name for name in os.listdir(directory) if name.endswith(FILLER_EXTENSION))
+        fillers = []
+        for name in names:
+            with open(os.path.join(directory, name), 'rb') as f:
+                fillers.append((name[:-len(FILLER_EXTENSION)], f.read()))
+        return cls(fillers)
+
+    def __len__(self):
+        return len(self.fillers)
+
+    def next(self):
+        """
+        Returns (name, µ-law bytes) of the next filler.
+        """
+        with self._lock:
+            filler = self.fillers[self._next % len(self.fillers)]
+            self._next += 1
+            return filler
+
+
+_fillers = None
+_fillers_loaded = False
+_fillers_lock = threading.Lock()
+
+
+def get_fillers():
+    """
+    Returns the filler set, loaded on first use, or None when masking is off or there are no filler files.
+    """
+    global _fillers, _fillers_loaded
+    with _fillers_lock:
+        if not _fillers_loaded:
+            _fillers_loaded = True
+            if FILLERS_ENABLED:
+                try:
+                    _fillers = FillerSet.load()
+                except OSError as e:
+                    logger.error(f"Could not load fillers from {FILLER_AUDIO_DIR}: {e}")
+                if not _fillers:
+                    logger.warning(f"No filler audio in {FILLER_AUDIO_DIR}, latency masking is off")
+                    _fillers = None
+                else:
+                    logger.info(f"Loaded {len(_fillers)} fillers from {FILLER_AUDIO_DIR}")
+        return _fillers
+
+
+def mask_latency(items, play, filler_set, threshold_ms=FILLER_THRESHOLD_MS, **properties):
+    """
+    Yields from items, e.g. the sentences of a streaming answer.  When the first one takes longer than
+    threshold_ms, play is called with the µ-law audio of a filler before waiting on.  Posting the filler before
+    the first answer audio means Twilio plays them back to back without overlapping.
+    """
+    items = iter(items)
+    first = queue.Queue(maxsize=1)
+
+    def fetch_first():
+        try:
+            first.put((True, next(items)))
+        except StopIteration:
+            first.put((False, None))
+        except Exception as e:
+            first.put((None, e))
+
+    threading.Thread(target=fetch_first, name='filler-wait', daemon=True).start()
+    try:
+        found, value = first.get(timeout=threshold_ms / 1000)
+        metrics.count('filler_played', 0, **properties)
+    except queue.Empty:
+        name, audio = filler_set.next()
+        logger.info(f"Answer not ready after {threshold_ms:.0f} ms, playing filler {name}")
+        metrics.count('filler_played', 1, **properties)
+        play(audio)
+        found, value = first.get()
+
+    if found is None:
+        raise value
+    if not found:
+        return
+    try:
+        yield value
+        yield from items
+    finally:
+        close = getattr(items, 'close', None)
+        if close is not None:
+            close()
+
+
+def filler_file_name(phrase):
+    return re.sub(r'[^a-z0-9]+', '_', phrase.lower()).strip('_') + FILLER_EXTENSION
+
+
+def synthesize(phrases, directory):
+    """
+    Synthesizes the filler phrases with the configured voice and saves them as µ-law files.  Run at build time,
+    e.g. before building the image, never while a call is waiting.
+    """
+    import eleven
+    import websocket_handler
+
+    os.makedirs(directory, exist_ok=True)
+    for phrase in phrases:
+        audio = b''.join(websocket_handler.convert_to_frames(eleven.say_stream(phrase)))
+        path = os.path.join(directory, filler_file_name(phrase))
+        with open(path, 'wb') as f:
+            f.write(audio)
+        logger.info(f"Saved filler {path}: {len(audio)} bytes")
+
+
+if __name__ == '__main__':
+    synthesize(FILLER_PHRASES, sys.argv[1] if len(sys.argv) > 1 else FILLER_AUDIO_DIR)
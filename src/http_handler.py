@@ -1,3 +1,4 @@
+import os
 import utils
 import sys
 from twilio.twiml.voice_response import VoiceResponse
@@ -5,8 +6,8 @@ import json
 from urllib.parse import urlparse
 from urllib.parse import parse_qs
 import base64
-from aws_xray_sdk.core import xray_recorder
-import query_lambda
+import metrics
+import deadlines
 
 # Initialize logging
 import logging
@@ -18,6 +19,20 @@ logger.add(sys.stdout, format="{time} {level} {message}")
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+GREETING_TEXT = "I'm UMD Bot, how can I help you?"
+
+# Streaming mode hands the question to the websocket side, which speaks the answer sentence by sentence
+# while the LLM is still generating it instead of waiting for the whole answer here
+ANSWER_STREAMING = os.environ.get('ANSWER_STREAMING', 'false').lower() == 'true'
+
+# Conversation mode keeps the first stream open for the whole call, the websocket side finds the end of each
+# utterance and answers on the same stream, there is no gather and no redirect per turn.  See conversation.py.
+# Server mode only, on Lambda the stream's events are spread over containers and the gather cycle is kept.
+CONVERSATION_MODE = os.environ.get('CONVERSATION_MODE', 'false').lower() == 'true'
+if CONVERSATION_MODE and 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+    logger.warning("CONVERSATION_MODE needs the server mode, keeping the gather cycle on Lambda")
+    CONVERSATION_MODE = False
+
 
 def handler(event, context):
     logger.info(f"Route: {event['rawPath']}")
@@ -68,16 +83,21 @@ def set_voice(event):
 
 def twilio_answer(event, decoded_body):
     logger.info(f"Twilio answer called with event: {event}")
-    xray_recorder.begin_subsegment('twilio_answer')
+    with metrics.span('twilio_answer'):
+        return _twilio_answer(decoded_body)
+
+
+def _twilio_answer(decoded_body):
     response = VoiceResponse()
 
     call_status = decoded_body['CallStatus']
     # When it first rings stream the intro message
     if call_status == 'ringing':
         websocket_url = f'wss://{utils.get_ssm_param("apiSandboxWebsocketBase")}/sandbox'
-        response.connect().stream(url=websocket_url, name="my_stream", track='inbound_track').parameter(
-            name='textToSay',
-            value="I'm UMD Bot, how can I help you?")
+        stream = response.connect().stream(url=websocket_url, name="my_stream", track='inbound_track')
+        stream.parameter(name='textToSay', value=GREETING_TEXT)
+        if CONVERSATION_MODE:
+            stream.parameter(name='mode', value='conversation')
         return utils.send_twiml(response)
         # response.say("I'm UMD Bot, how can I help you?")
 
@@ -86,13 +106,16 @@ def twilio_answer(event, decoded_body):
                     speechModel='experimental_conversations')
 
     logger.info("Answer response: " + str(response))
-    xray_recorder.end_subsegment()
     return utils.send_twiml(response)
 
 
 def twilio_respond(event, decoded_body):
     logger.info(f"Twilio respond called with event: {event}")
-    xray_recorder.begin_subsegment('twilio_respond')
+    with metrics.span('twilio_respond', call_sid=decoded_body.get('CallSid')):
+        return _twilio_respond(decoded_body)
+
+
+def _twilio_respond(decoded_body):
     response = VoiceResponse()
 
     # If the user didn't say anything just return to gather
@@ -103,24 +126,42 @@ def twilio_respond(event, decoded_body):
 
     speech_result = decoded_body['SpeechResult']
     logger.info(f"Twilio transcribed voice to text as: {speech_result}")
+    # Latency budget from the question to the first audio of the answer, None when deadlines are off
+    deadline = deadlines.for_turn()
+
+    websocket_url = f'wss://{utils.get_ssm_param("apiSandboxWebsocketBase")}/sandbox'
+    if ANSWER_STREAMING:
+        stream = response.connect().stream(url=websocket_url, name="my_stream", track='inbound_track')
+        stream.parameter(name='question', value=speech_result)
+        if deadline is not None:
+            # The websocket side bounds the first sentence and its audio by what is left of the turn
+            stream.parameter(name='deadlineAt', value=str(deadline.epoch_ms))
+        logger.info("Respond response (streaming answer): " + str(response))
+        return utils.send_twiml(response)
 
-    chat_gpt_answer = query_lambda.query_chatgpt(speech_result)
+    # Imported here so the answer, setvoice and streaming routes do not pay for loading langchain
+    import query_lambda
+    with metrics.span('speech_to_answer', call_sid=decoded_body.get('CallSid')):
+        chat_gpt_answer = query_lambda.query_chatgpt(speech_result, deadline=deadline)
     logger.info(f"Chat GPT answer (need to parse into string): {chat_gpt_answer}")
 
-    websocket_url = f'wss://{utils.get_ssm_param("apiSandboxWebsocketBase")}/sandbox'
-    response.connect().stream(url=websocket_url, name="my_stream", track='inbound_track').parameter(
-        name='textToSay',
-        value=chat_gpt_answer)
+    stream = response.connect().stream(url=websocket_url, name="my_stream", track='inbound_track')
+    stream.parameter(name='textToSay', value=chat_gpt_answer)
+    if deadline is not None:
+        # The websocket side gives text to speech what is left of the turn
+        stream.parameter(name='deadlineAt', value=str(deadline.epoch_ms))
 
     logger.info("Respond response: " + str(response))
-    xray_recorder.end_subsegment()
     return utils.send_twiml(response)
 
 
 def decode_and_parse_body(event):
     logger.info("Entering decode_and_parse_body function with event: " + str(event))
-    xray_recorder.begin_subsegment('decode_and_parse_body')
+    with metrics.span('decode_and_parse_body'):
+        return _decode_and_parse_body(event)
+
 
+def _decode_and_parse_body(event):
     decoded_body = event['body']
 
     # Decode base64 if necessary
@@ -159,5 +200,4 @@ def decode_and_parse_body(event):
     else:
         logger.info("Content type did not match known types. Returning as-is.")
 
-    xray_recorder.end_subsegment()
     return parsed_body or decoded_body
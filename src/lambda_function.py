@@ -1,18 +1,18 @@
+import os
 import sys
 import json
-import websocket_handler
-import http_handler
+import time
+import threading
+import importlib
 import traceback
+import utils
+import metrics
 
-# Simple admin web interface
-from app import handler as fastapi_handler
+# Simple admin web interface, imported only when the route is enabled
+# from app import handler as fastapi_handler
 
-# X-Ray for performance monitoring
-from aws_xray_sdk.core import xray_recorder
-from aws_xray_sdk.core import patch_all
-
-xray_recorder.configure(service='TwilioElevenLabsDemo')
-patch_all()
+# X-Ray for performance monitoring, optional sink for metrics spans
+metrics.configure_xray('TwilioElevenLabsDemo')
 
 # try to use it with automatic instrumenting first
 
@@ -25,14 +25,42 @@ logger.add(sys.stdout, format="{time} {level} {message}")
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Modules each entry path needs.  They are imported by the route on first use so a cold start only pays for
+# its own path, e.g. a websocket mark never loads eleven labs or langchain.
+ENTRY_PATH_MODULES = {
+    'websocket_start': ['websocket_handler', 'eleven'],
+    'websocket_mark': ['websocket_handler', 'twilioumd'],
+    'websocket_media': ['websocket_handler'],
+    'http_answer': ['http_handler'],
+    'http_respond': ['http_handler', 'query_lambda'],
+}
+
+WARM_UP_ON_INIT = (os.environ.get('WARM_UP_ON_INIT', 'false').lower() == 'true' or
+                   os.environ.get('AWS_LAMBDA_INITIALIZATION_TYPE') == 'provisioned-concurrency')
+
+# Opens the keep-alive TTS connection during init, in a background thread so eleven labs is imported off the
+# init path, and the first utterance after a cold start does not pay for DNS, TCP and TLS
+ELEVENLABS_PRECONNECT = os.environ.get('ELEVENLABS_PRECONNECT', 'true').lower() == 'true'
+
 
 def handler(event, context):
     logger.info("Start of Lambda function. Incoming event: " + str(event))
 
     # Future admin web interface
     # if event.get('path', '').startswith('/web'):
+    #     from app import handler as fastapi_handler
     #     return fastapi_handler(event, context)
 
+    # Scheduled ping or provisioned concurrency hook, e.g. {"warmup": true}
+    if event.get('warmup'):
+        return warm_up()
+
+    # Deploy time hook to synthesize known phrases into the audio cache, e.g. {"prewarmAudio": []} for the greeting
+    if 'prewarmAudio' in event:
+        import websocket_handler
+        import http_handler
+        return websocket_handler.prewarm_audio_cache(event['prewarmAudio'] or [http_handler.GREETING_TEXT])
+
     # we only handle the mark event from twilio marking the end of the audio and that start event from twilio
     is_websocket_event = (
             ('requestContext' in event and 'eventType' in event['requestContext']) or
@@ -44,6 +72,7 @@ def handler(event, context):
     if is_websocket_event:
         try:
             logger.info("Call handler for websocket event")
+            import websocket_handler
             return websocket_handler.handle(event)
         except Exception as e:
             logger.error(f"An error occurred: {e}")
@@ -54,6 +83,7 @@ def handler(event, context):
     else:
         # Normal HTTP requests to navigate in twilio using twiml
         try:
+            import http_handler
             return http_handler.handler(event, context)
         except Exception as e:
             logger.error(f"An error occurred: {e}")
@@ -62,3 +92,46 @@ def handler(event, context):
                 'statusCode': 500,
                 'body': json.dumps({'error': str(e)})
             }
+
+
+def warm_up():
+    """
+    Does everything a cold start would otherwise do on the first calls: loads the SSM cache, imports every entry
+    path, creates the clients, opens the eleven labs keep-alive connection and builds the QA chain.  Runs at init
+    under provisioned concurrency (or with WARM_UP_ON_INIT=true) and on {"warmup": true} events.
+    """
+    start = time.perf_counter()
+    timings = {}
+
+    def step(name, fn):
+        step_start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            logger.error(f"Warm up step {name} failed: {e}")
+        timings[name] = round((time.perf_counter() - step_start) * 1000, 1)
+
+    step('ssm_prefetch', utils.prefetch_ssm_params)
+    for path, modules in ENTRY_PATH_MODULES.items():
+        step(f'import_{path}', lambda: [importlib.import_module(module) for module in modules])
+    step('apigateway_client', lambda: importlib.import_module('websocket_handler').get_client())
+    step('twilio_client', lambda: importlib.import_module('twilioumd').get_client())
+    if ELEVENLABS_PRECONNECT:
+        step('eleven_preconnect', lambda: importlib.import_module('eleven').wait_preconnect())
+    step('fillers', lambda: importlib.import_module('fillers').get_fillers())
+    step('qa_chain', lambda: importlib.import_module('query_lambda').get_qa_chain())
+
+    timings['total'] = round((time.perf_counter() - start) * 1000, 1)
+    logger.info(f"Warm up done: {timings}")
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'warmUpMs': timings})
+    }
+
+
+if ELEVENLABS_PRECONNECT:
+    threading.Thread(target=lambda: importlib.import_module('eleven').start_preconnect(),
+                     name='eleven-preconnect-init', daemon=True).start()
+
+if WARM_UP_ON_INIT:
+    warm_up()
@@ -0,0 +1,51 @@
+import json
+import threading
+
+
+class ParameterNotFound(Exception):
+    pass
+
+
+class LocalSSMClient:
+    """
+    In memory stand-in for the boto3 SSM client so the app can run offline.  Only implements the calls utils uses,
+    with the same request and response shapes.  Set SSM_LOCAL_PARAMS to a JSON file of {"/full/name": "value"}
+    to have utils use it instead of AWS.
+    """
+
+    class exceptions:
+        ParameterNotFound = ParameterNotFound
+
+    def __init__(self, parameters=None):
+        self._parameters = dict(parameters or {})
+        self._lock = threading.Lock()
+        self.call_counts = {'get_parameter': 0, 'get_parameters': 0, 'put_parameter': 0}
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def get_parameter(self, Name, WithDecryption=False):
+        with self._lock:
+            self.call_counts['get_parameter'] += 1
+            if Name not in self._parameters:
+                raise ParameterNotFound(f"Parameter {Name} not found.")
+            return {'Parameter': self._parameter(Name)}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        with self._lock:
+            self.call_counts['get_parameters'] += 1
+            return {
+                'Parameters': [self._parameter(name) for name in Names if name in self._parameters],
+                'InvalidParameters': [name for name in Names if name not in self._parameters]
+            }
+
+    def put_parameter(self, Name, Value, Type='String', Overwrite=False):
+        with self._lock:
+            self.call_counts['put_parameter'] += 1
+            self._parameters[Name] = Value
+            return {'Version': 1, 'Tier': 'Standard'}
+
+    def _parameter(self, name):
+        return {'Name': name, 'Type': 'String', 'Value': self._parameters[name]}
@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import math
+import time
+import threading
+import functools
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'TwilioElevenLabsDemo')
+METRICS_SERVICE = os.environ.get('METRICS_SERVICE', 'TwilioElevenLabsDemo')
+# Structured CloudWatch embedded metric format records on stdout, CloudWatch turns them into metrics
+METRICS_EMF_ENABLED = os.environ.get('METRICS_EMF', 'true').lower() == 'true'
+# X-Ray subsegments for spans: auto uses X-Ray when aws_xray_sdk is installed, off never does
+METRICS_XRAY = os.environ.get('METRICS_XRAY', 'auto').lower()
+METRICS_WINDOW = int(os.environ.get('METRICS_WINDOW', '1000'))
+METRICS_SUMMARY_INTERVAL_SECONDS = float(os.environ.get('METRICS_SUMMARY_INTERVAL_SECONDS', '60'))
+
+# The per turn latencies we tune for
+SPEECH_TO_ANSWER = 'speech_to_answer_ms'
+TTS_FIRST_BYTE = 'tts_first_byte_ms'
+FIRST_FRAME_POSTED = 'first_frame_posted_ms'
+STREAM_DURATION = 'stream_duration_ms'
+MARK_TO_REDIRECT = 'mark_to_redirect_ms'
+
+_samples = defaultdict(lambda: deque(maxlen=METRICS_WINDOW))
+_samples_lock = threading.Lock()
+_last_summary = time.monotonic()
+_xray_recorder = None
+
+
+def configure_xray(service):
+    """
+    Turns on the optional X-Ray sink: names the service and patches boto3, requests etc.  A no-op when METRICS_XRAY
+    is off or aws_xray_sdk is not installed, spans are still recorded as metrics.
+    """
+    global _xray_recorder
+    if METRICS_XRAY == 'off':
+        return
+    try:
+        from aws_xray_sdk.core import xray_recorder, patch_all
+    except ImportError:
+        logger.info("aws_xray_sdk not installed, spans are recorded as metrics only")
+        return
+    xray_recorder.configure(service=service)
+    patch_all()
+    _xray_recorder = xray_recorder
+
+
+def record(name, value, unit='Milliseconds', **properties):
+    """
+    Records one measurement: emits an EMF record and adds it to the in process percentile window.
+    Extra keyword properties (call_sid, text length...) are attached to the record but are not dimensions.
+    """
+    with _samples_lock:
+        _samples[name].append(value)
+    _emit({name: value}, {name: unit}, properties)
+    _maybe_emit_summary()
+
+
+def count(name, value=1, **properties):
+    record(name, value, unit='Count', **properties)
+
+
+@contextmanager
+def span(name, **properties):
+    """
+    Times a block as metric `<name>_ms`, and as an X-Ray subsegment when the sink is on.  The span is always
+    closed, also on early returns and exceptions.
+
+        with metrics.span('twilio_respond', call_sid=call_sid) as s:
+            s.put_metadata('question', question)
+    """
+    active = _Span(name)
+    start = time.perf_counter()
+    try:
+        yield active
+    except Exception as e:
+        active.error = type(e).__name__
+        raise
+    finally:
+        active.close()
+        if active.error:
+            properties['error'] = active.error
+        record(f"{name}_ms", (time.perf_counter() - start) * 1000, **properties)
+
+
+def timed(name=None):
+    """
+    Decorator form of span, named after the function by default.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name or fn.__name__):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class Stopwatch:
+    """
+    Measures a latency between two points that are not in one block, e.g. start of a stream to its first frame.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.start) * 1000
+
+
+def percentiles(name):
+    """
+    Returns count, p50, p95 and p99 of the recent values of a metric in this process, or None without samples.
+    """
+    with _samples_lock:
+        values = sorted(_samples.get(name, ()))
+    if not values:
+        return None
+    return {
+        'count': len(values),
+        'p50': _percentile(values, 50),
+        'p95': _percentile(values, 95),
+        'p99': _percentile(values, 99),
+    }
+
+
+def summary():
+    with _samples_lock:
+        names = list(_samples)
+    return {name: percentiles(name) for name in names}
+
+
+def emit_summary():
+    """
+    Emits p50/p95/p99 of every metric as one EMF record (metrics named <name>_p50 etc.).
+    """
+    values = {}
+    units = {}
+    for name, stats in summary().items():
+        if stats is None:
+            continue
+        for key in ('p50', 'p95', 'p99'):
+            values[f"{name}_{key}"] = stats[key]
+            units[f"{name}_{key}"] = 'Milliseconds' if name.endswith('_ms') else 'Count'
+    if values:
+        _emit(values, units, {'summary': True})
+
+
+def reset():
+    with _samples_lock:
+        _samples.clear()
+
+
+class _Span:
+    def __init__(self, name):
+        self.name = name
+        self.error = None
+        self._subsegment = None
+        if _xray_recorder is not None:
+            try:
+                self._subsegment = _xray_recorder.begin_subsegment(name)
+            except Exception as e:
+                logger.debug(f"X-Ray subsegment {name} not started: {e}")
+
+    def put_metadata(self, key, value):
+        if self._subsegment is not None:
+            self._subsegment.put_metadata(key, value)
+
+    def close(self):
+        if self._subsegment is not None:
+            try:
+                _xray_recorder.end_subsegment()
+            except Exception as e:
+                logger.debug(f"X-Ray subsegment {self.name} not ended: {e}")
+            self._subsegment = None
+
+
+def _percentile(sorted_values, percent):
+    # Nearest rank
+    index = max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def _emit(values, units, properties):
+    if not METRICS_EMF_ENABLED:
+        return
+    record_json = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Service']],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units.items()],
+            }],
+        },
+        'Service': METRICS_SERVICE,
+        **properties,
+        **values,
+    }
+    print(json.dumps(record_json, default=str), flush=True)
+
+
+def _maybe_emit_summary():
+    global _last_summary
+    now = time.monotonic()
+    if now - _last_summary < METRICS_SUMMARY_INTERVAL_SECONDS:
+        return
+    _last_summary = now
+    emit_summary()
@@ -0,0 +1,56 @@
+import re
+
+# A sentence ends at . ! ? (optionally followed by quotes or brackets) and then whitespace
+_SENTENCE_END = re.compile(r'[.!?]+["\')\]]*\s+')
+# Words that end in a period without ending the sentence, whole words only so "best." or "problems." still do
+_ABBREVIATION_END = re.compile(r'(?:^|[\s(])(mr|mrs|ms|dr|prof|st|vs|etc|e\.g|i\.e|u\.s)\.$', re.IGNORECASE)
+
+
+class SentenceSplitter:
+    """
+    Incrementally splits streamed text (e.g. LLM tokens) into complete sentences as soon as they end.
+    """
+
+    def __init__(self, min_chars=8):
+        self.min_chars = min_chars
+        self._buffer = ''
+
+    def push(self, text):
+        """
+        Adds text and returns the sentences completed by it, in order.
+        """
+        self._buffer += text
+        sentences = []
+        search_from = 0
+        for match in _SENTENCE_END.finditer(self._buffer):
+            candidate = self._buffer[search_from:match.end()].strip()
+            if len(candidate) < self.min_chars or _ABBREVIATION_END.search(candidate):
+                continue
+            sentences.append(candidate)
+            search_from = match.end()
+        self._buffer = self._buffer[search_from:]
+        return sentences
+
+    def flush(self):
+        """
+        Returns whatever is left once the stream has ended, or None if it is only whitespace.
+        """
+        rest = self._buffer.strip()
+        self._buffer = ''
+        return rest or None
+
+
+def iter_sentences(text_stream, min_chars=8):
+    """
+    Yields complete sentences from an iterator of text pieces.
+    """
+    splitter = SentenceSplitter(min_chars)
+    for text in text_stream:
+        yield from splitter.push(text)
+    rest = splitter.flush()
+    if rest:
+        yield rest
+
+
+def split_sentences(text, min_chars=8):
+    return list(iter_sentences([text], min_chars))
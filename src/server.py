@@ -0,0 +1,138 @@
+"""
+Server mode: runs the app as one long lived process under uvicorn instead of one Lambda invocation per event.
+
+Twilio's media stream websocket ends here instead of at API Gateway, and /twilio/answer and /twilio/respond are
+served by the same process.  The events go to the same http_handler and websocket_handler as on Lambda, only the
+transport differs: audio is written to the websocket this process holds instead of posted through the API
+Gateway management API, and stop and media events always reach the stream they belong to, so the in memory
+cancel backend and conversation mode work as they are.
+
+The websockets are served by the event loop.  Text to speech, the LLM and the Twilio REST calls are blocking
+clients, they run in thread pools, so a stream only holds a thread while it is speaking.  The handlers stay
+synchronous on purpose, they are the ones Lambda runs and an async copy of them would drift from it.
+
+Point the apiSandboxWebsocketBase and apiSandboxHttpBase parameters at this server's host, then from src:
+
+    uvicorn server:app --host 0.0.0.0 --port 8080
+    python server.py
+"""
+import os
+import sys
+import json
+import uuid
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import Request, Response, WebSocket, WebSocketDisconnect
+from app import app
+import transport
+import conversation
+import websocket_handler
+
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+SERVER_HOST = os.environ.get('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', '8080'))
+# Threads for the work that blocks for seconds, each speaking stream and each /twilio/respond holds one
+SERVER_STREAM_THREADS = int(os.environ.get('SERVER_STREAM_THREADS', '256'))
+# Threads for the short events, marks, media and stops, kept apart so they are not queued behind the streams
+SERVER_EVENT_THREADS = int(os.environ.get('SERVER_EVENT_THREADS', '32'))
+# Runs the Lambda warm up at start, the process lives for many calls
+SERVER_WARM_UP = os.environ.get('SERVER_WARM_UP', 'true').lower() == 'true'
+
+_stream_executor = ThreadPoolExecutor(max_workers=SERVER_STREAM_THREADS, thread_name_prefix='stream')
+_event_executor = ThreadPoolExecutor(max_workers=SERVER_EVENT_THREADS, thread_name_prefix='event')
+_websockets = transport.WebSocketTransport()
+
+
+async def run_in(executor, fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args))
+
+
+@app.on_event('startup')
+async def start_server():
+    transport.set_transport(_websockets)
+    if SERVER_WARM_UP:
+        import lambda_function
+        await run_in(_stream_executor, lambda_function.warm_up)
+
+
+@app.on_event('shutdown')
+async def stop_server():
+    _stream_executor.shutdown(wait=False, cancel_futures=True)
+    _event_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def http_event(request, body):
+    """
+    The Lambda function URL event for a request, what http_handler.handler reads.
+    """
+    return {
+        'rawPath': request.url.path,
+        'rawQueryString': request.url.query,
+        'headers': dict(request.headers),
+        'body': body.decode('utf-8'),
+        'isBase64Encoded': False,
+    }
+
+
+@app.api_route('/setvoice', methods=['GET', 'POST'])
+@app.api_route('/twilio/{path:path}', methods=['GET', 'POST'])
+async def twilio_http(request: Request):
+    import http_handler
+    event = http_event(request, await request.body())
+    try:
+        result = await run_in(_stream_executor, http_handler.handler, event, None)
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        return Response(json.dumps({'error': str(e)}), status_code=500, media_type='application/json')
+    return Response(result.get('body', ''), status_code=result.get('statusCode', 200),
+                    headers=result.get('headers'))
+
+
+@app.websocket('/sandbox')
+async def media_stream(websocket: WebSocket):
+    """
+    One Twilio media stream.  Messages are handled in order, except the start event which streams the whole
+    answer, it runs on its own so the marks, media and stop behind it are not held up.
+    """
+    await websocket.accept()
+    connection_id = uuid.uuid4().hex
+    _websockets.register(connection_id, websocket, asyncio.get_running_loop())
+    stream_sid = None
+    stopped = False
+    try:
+        while True:
+            message_str = await websocket.receive_text()
+            body = json.loads(message_str)
+            event_type = body.get('event')
+            event = transport.websocket_event(connection_id, message_str)
+            if event_type == 'start':
+                stream_sid = body.get('streamSid')
+                asyncio.get_running_loop().run_in_executor(_stream_executor, websocket_handler.handle, event)
+                continue
+            if event_type == 'media' and not websocket_handler.BARGE_IN_ENABLED and \
+                    conversation.get_session(body.get('streamSid')) is None:
+                # 50 a second per call and nothing listens, skip the thread hop
+                continue
+            stopped = stopped or event_type == 'stop'
+            await run_in(_event_executor, websocket_handler.handle, event)
+    except WebSocketDisconnect:
+        logger.info(f"Media stream {stream_sid} disconnected")
+    finally:
+        _websockets.unregister(connection_id)
+        if stream_sid is not None and not stopped:
+            # Closed without a stop event, end the stream like a stop would
+            await run_in(_event_executor, websocket_handler.handle, {'event': 'stop', 'streamSid': stream_sid})
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host=SERVER_HOST, port=SERVER_PORT)
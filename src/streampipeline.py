@@ -0,0 +1,145 @@
+import sys
+import queue
+import threading
+
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+_DONE = object()
+_POLL_SECONDS = 0.1
+
+
+def run_pipeline(source, transform, encode, send, queue_size=8, posters=1, cancel=None):
+    """
+    Runs fetch, convert and post as overlapping stages linked by bounded queues so memory stays flat.
+
+    :param source: iterable read by the producer thread, e.g. the eleven labs audio stream
+    :param transform: generator function taking an iterator of source items and yielding outputs, run in its own
+                      thread so it can keep state and flush at the end
+    :param encode: called with each output by the posters, can run concurrently when posters > 1
+    :param send: called with each encoded output strictly in order, one at a time
+    :param queue_size: max items waiting between two stages
+    :param posters: number of poster threads.  Encoding overlaps but sends are still serialized in order.
+    :param cancel: optional threading.Event (e.g. a cancellation.CancelToken) that aborts all stages early.  It
+                   is only watched, never set, so the caller can still post after an error, e.g. fallback audio.
+    :return: None once every output has been sent.  Errors from the source or transform are re-raised after
+             what was converted before them has been sent.
+    """
+    stopped = _Stop(cancel)
+    # The producer also stops when the converter failed, nothing reads what it fetches any more
+    fetch_stopped = _Stop(stopped)
+    fetched = queue.Queue(maxsize=queue_size)
+    converted = queue.Queue(maxsize=queue_size)
+    turnstile = _Turnstile(stopped)
+    errors = []
+
+    def produce():
+        try:
+            for item in source:
+                if item is not None and not _put(fetched, item, fetch_stopped):
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            _put(fetched, _DONE, fetch_stopped)
+
+    def convert():
+        try:
+            outputs = transform(_drain(fetched, stopped))
+            for seq, output in enumerate(outputs):
+                if not _put(converted, (seq, output), stopped):
+                    return
+        except Exception as e:
+            errors.append(e)
+            fetch_stopped.set()
+        finally:
+            for _ in range(posters):
+                _put(converted, _DONE, stopped)
+
+    def post():
+        for seq, output in _drain(converted, stopped):
+            try:
+                message = encode(output)
+                turnstile.wait_for_turn(seq)
+                send(message)
+            except Exception as e:
+                logger.error(f"Error posting pipelined audio: {e}")
+            finally:
+                turnstile.advance(seq)
+
+    threads = [threading.Thread(target=produce, name='stream-producer', daemon=True),
+               threading.Thread(target=convert, name='stream-converter', daemon=True)]
+    threads += [threading.Thread(target=post, name=f'stream-poster-{i}', daemon=True) for i in range(posters)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+class _Stop:
+    """
+    Stop signal of the stages, set by the pipeline itself or by the event it watches.
+    """
+
+    def __init__(self, watched=None):
+        self._event = threading.Event()
+        self._watched = watched
+
+    def set(self):
+        self._event.set()
+
+    def is_set(self):
+        return self._event.is_set() or (self._watched is not None and self._watched.is_set())
+
+
+class _Turnstile:
+    """
+    Lets posters encode in parallel but send strictly in sequence order.
+    """
+
+    def __init__(self, stop_event):
+        self._next_seq = 0
+        self._condition = threading.Condition()
+        self._stop_event = stop_event
+
+    def wait_for_turn(self, seq):
+        with self._condition:
+            while self._next_seq != seq and not self._stop_event.is_set():
+                self._condition.wait(_POLL_SECONDS)
+
+    def advance(self, seq):
+        with self._condition:
+            while self._next_seq != seq and not self._stop_event.is_set():
+                self._condition.wait(_POLL_SECONDS)
+            self._next_seq = seq + 1
+            self._condition.notify_all()
+
+
+def _put(q, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=_POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _drain(q, stop_event):
+    while not stop_event.is_set():
+        try:
+            item = q.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            continue
+        if item is _DONE:
+            return
+        yield item
@@ -0,0 +1,103 @@
+import io
+import os
+import sys
+import wave
+import threading
+import itertools
+import requests
+import vad
+
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Speech to text for the conversation mode, which captures the caller's utterances itself instead of using
+# Twilio's <Gather>.  openai posts to a Whisper style /audio/transcriptions endpoint, stub returns canned text
+# whatever the caller said and has to be chosen explicitly (bench/loadsim.py).
+STT_BACKEND = os.environ.get('STT_BACKEND', 'openai').lower()
+# Canned transcripts of the stub backend, separated by |, used in turn
+STT_STUB_TEXT = os.environ.get('STT_STUB_TEXT', 'What are the library hours?')
+STT_URL = os.environ.get('STT_URL', 'https://api.openai.com/v1/audio/transcriptions')
+STT_MODEL = os.environ.get('STT_MODEL', 'whisper-1')
+STT_LANGUAGE = os.environ.get('STT_LANGUAGE', 'en')
+STT_TIMEOUT_SECONDS = float(os.environ.get('STT_TIMEOUT_SECONDS', '10'))
+# SSM parameter holding the API key, read on first use
+STT_API_KEY_PARAM = os.environ.get('STT_API_KEY_PARAM', 'sttApiKey')
+
+
+def mulaw_to_wav(mulaw_bytes, sample_rate=vad.MULAW_SAMPLE_RATE):
+    """
+    Wraps Twilio µ-law audio in a 16 bit PCM WAV file, the format every transcription API takes.
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(vad.decode_mulaw(mulaw_bytes).astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+class StubSpeechToText:
+    """
+    Returns the canned transcripts in turn, whatever the audio.
+    """
+
+    def __init__(self, transcripts=None):
+        transcripts = transcripts or [text.strip() for text in STT_STUB_TEXT.split('|') if text.strip()]
+        self._transcripts = itertools.cycle(transcripts)
+        self._lock = threading.Lock()
+
+    def transcribe(self, mulaw_bytes, sample_rate=vad.MULAW_SAMPLE_RATE):
+        with self._lock:
+            return next(self._transcripts)
+
+
+class OpenAISpeechToText:
+    """
+    Transcribes with an OpenAI compatible /audio/transcriptions endpoint.
+    """
+
+    def __init__(self, api_key, url=STT_URL, model=STT_MODEL, language=STT_LANGUAGE, timeout=STT_TIMEOUT_SECONDS):
+        self.url = url
+        self.model = model
+        self.language = language
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Bearer {api_key}'
+
+    def transcribe(self, mulaw_bytes, sample_rate=vad.MULAW_SAMPLE_RATE):
+        response = self.session.post(
+            self.url,
+            files={'file': ('utterance.wav', mulaw_to_wav(mulaw_bytes, sample_rate), 'audio/wav')},
+            data={'model': self.model, 'language': self.language},
+            timeout=self.timeout)
+        response.raise_for_status()
+        return response.json().get('text', '').strip()
+
+
+def create_speech_to_text():
+    if STT_BACKEND == 'stub':
+        logger.warning("STT_BACKEND=stub, every utterance is transcribed as the canned STT_STUB_TEXT")
+        return StubSpeechToText()
+    if STT_BACKEND == 'openai':
+        import utils
+        return OpenAISpeechToText(utils.get_ssm_param(STT_API_KEY_PARAM))
+    raise ValueError(f"Unknown STT_BACKEND {STT_BACKEND}, use stub or openai")
+
+
+_speech_to_text = None
+_speech_to_text_lock = threading.Lock()
+
+
+def get_speech_to_text():
+    global _speech_to_text
+    with _speech_to_text_lock:
+        if _speech_to_text is None:
+            _speech_to_text = create_speech_to_text()
+        return _speech_to_text
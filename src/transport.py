@@ -0,0 +1,112 @@
+import sys
+import asyncio
+import threading
+
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# How the websocket handler reaches Twilio's media stream.  On Lambda the stream ends at API Gateway and every
+# message is posted through its management API.  In server mode (server.py) the stream ends in this process and
+# messages are written to the websocket.  websocket_handler only ever calls post(connection id, message).
+SEND_TIMEOUT_SECONDS = 10
+
+
+class ConnectionGone(Exception):
+    """
+    The websocket connection is closed, e.g. the caller hung up.  API Gateway's GoneException in server mode.
+    """
+
+
+class ApiGatewayTransport:
+    """
+    Posts messages through the API Gateway management API, the Lambda mode.
+    """
+
+    def __init__(self, get_client):
+        """
+        :param get_client: returns the apigatewaymanagementapi client, created on first use
+        """
+        self.get_client = get_client
+
+    def post(self, connection_id, message_str):
+        self.get_client().post_to_connection(ConnectionId=connection_id, Data=message_str)
+
+
+class WebSocketTransport:
+    """
+    Websockets held by this process, the server mode.  The websockets live on the event loop, post() is called
+    from the worker threads that stream the audio and waits until the message is written, so a stream is paced
+    by its socket like it is by post_to_connection on Lambda.
+    """
+
+    def __init__(self, send_timeout_seconds=SEND_TIMEOUT_SECONDS):
+        self.send_timeout_seconds = send_timeout_seconds
+        self._connections = {}  # connection id -> (websocket, event loop)
+        self._lock = threading.Lock()
+
+    def register(self, connection_id, websocket, loop):
+        with self._lock:
+            self._connections[connection_id] = (websocket, loop)
+
+    def unregister(self, connection_id):
+        with self._lock:
+            self._connections.pop(connection_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._connections)
+
+    def post(self, connection_id, message_str):
+        with self._lock:
+            connection = self._connections.get(connection_id)
+        if connection is None:
+            raise ConnectionGone(connection_id)
+        websocket, loop = connection
+        future = asyncio.run_coroutine_threadsafe(websocket.send_text(message_str), loop)
+        try:
+            future.result(timeout=self.send_timeout_seconds)
+        except Exception as e:
+            future.cancel()
+            with self._lock:
+                still_open = connection_id in self._connections
+            if not still_open:
+                raise ConnectionGone(connection_id) from e
+            raise
+
+
+def websocket_event(connection_id, message_str):
+    """
+    The Lambda event API Gateway sends for a websocket message, so server mode feeds websocket_handler.handle
+    the same events.
+    """
+    return {
+        'requestContext': {'connectionId': connection_id, 'eventType': 'MESSAGE'},
+        'body': message_str,
+    }
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport(default=None):
+    """
+    Returns the transport set by set_transport, else default (created once by the callable given).
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None and default is not None:
+            _transport = default()
+        return _transport
+
+
+def set_transport(transport):
+    global _transport
+    with _transport_lock:
+        _transport = transport
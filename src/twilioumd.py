@@ -1,6 +1,8 @@
 from twilio.rest import Client
 import utils
 import sys
+import os
+import threading
 
 # Initialize logging
 import logging
@@ -11,12 +13,25 @@ logger.add(sys.stdout, format="{time} {level} {message}")
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-account_sid = utils.get_ssm_param("twilioAccountSid")
-auth_token = utils.get_ssm_param("twilioAuthToken")
-client = Client(account_sid, auth_token)
+# Created on first use so importing this module costs no SSM calls
+_client = None
+_client_lock = threading.Lock()
 
-# Base URL of API
-http_api_base = utils.get_ssm_param("apiSandboxHttpBase")
+# Points the REST client somewhere other than api.twilio.com, e.g. the stub in bench/loadsim.py
+TWILIO_API_BASE = os.environ.get('TWILIO_API_BASE')
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            account_sid = utils.get_ssm_param("twilioAccountSid")
+            auth_token = utils.get_ssm_param("twilioAuthToken")
+            client = Client(account_sid, auth_token)
+            if TWILIO_API_BASE:
+                client.api.base_url = TWILIO_API_BASE
+            _client = client
+        return _client
 
 
 def twilio_redirect_twiml(call_sid):
@@ -25,5 +40,7 @@ def twilio_redirect_twiml(call_sid):
     :param call_sid:
     :return:
     """
-    client.calls(sid=call_sid).update(
+    # Base URL of API
+    http_api_base = utils.get_ssm_param("apiSandboxHttpBase")
+    get_client().calls(sid=call_sid).update(
         twiml=f'<Response><Redirect>https://{http_api_base}/twilio/answer/</Redirect></Response>')
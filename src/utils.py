@@ -1,26 +1,141 @@
+import os
+import time
+import threading
 import boto3
+import local_ssm
 
-ssm_client = boto3.client('ssm', region_name='us-east-1')
+PARAM_PREFIX = '/ai/elevenLabsTwilioDemo/'
+
+# Every parameter the app reads.  They are fetched together in one batched get_parameters call on a cold start
+# (and again when the TTL runs out) instead of one get_parameter call per lookup.
+KNOWN_PARAM_NAMES = [PARAM_PREFIX + key for key in (
+    'elevenLabsApiKey',
+    'elevenLabsVoiceId',
+    'apiSandboxWebsocketBase',
+    'apiSandboxHttpBase',
+    'twilioAccountSid',
+    'twilioAuthToken',
+)] + ['/umd-aurora-demo-azure-openai-key', '/postgrespass2']
+
+SSM_CACHE_TTL_SECONDS = float(os.environ.get('SSM_CACHE_TTL_SECONDS', '300'))
+_SSM_MAX_NAMES_PER_CALL = 10
+
+
+def _create_ssm_client():
+    local_params_file = os.environ.get('SSM_LOCAL_PARAMS')
+    if local_params_file:
+        return local_ssm.LocalSSMClient.from_file(local_params_file)
+    return boto3.client('ssm', region_name='us-east-1')
+
+
+ssm_client = _create_ssm_client()
+
+_cache = {}  # parameter name -> (value, expires at)
+_cache_lock = threading.Lock()
+_cache_stats = {'hits': 0, 'misses': 0, 'ssm_calls': 0}
 
 
 def get_ssm_param(key):
+    return get_ssm_param_by_name(f'{PARAM_PREFIX}{key}')
+
+
+def get_ssm_param_by_name(name):
+    """
+    Returns a parameter from the in process cache, going to SSM only when it is missing or older than the TTL.
+    """
+    value = _cached_value(name)
+    if value is not None:
+        return value
+
+    with _cache_lock:
+        _cache_stats['misses'] += 1
+
+    if name in KNOWN_PARAM_NAMES:
+        prefetch_ssm_params()
+        value = _cached_value(name, count_hit=False)
+        if value is not None:
+            return value
+
     response = ssm_client.get_parameter(
-        Name=f'/ai/elevenLabsTwilioDemo/{key}',
+        Name=name,
         WithDecryption=True
     )
-    return response['Parameter']['Value']
+    _count_ssm_call()
+    value = response['Parameter']['Value']
+    _store(name, value)
+    return value
+
+
+def prefetch_ssm_params(names=None):
+    """
+    Loads the given parameters (all known ones by default) into the cache with batched get_parameters calls.
+    """
+    names = list(names or KNOWN_PARAM_NAMES)
+    for i in range(0, len(names), _SSM_MAX_NAMES_PER_CALL):
+        response = ssm_client.get_parameters(
+            Names=names[i:i + _SSM_MAX_NAMES_PER_CALL],
+            WithDecryption=True
+        )
+        _count_ssm_call()
+        for parameter in response['Parameters']:
+            _store(parameter['Name'], parameter['Value'])
 
 
 def set_ssm_param(key, value):
+    name = f'{PARAM_PREFIX}{key}'
     response = ssm_client.put_parameter(
-        Name=f'/ai/elevenLabsTwilioDemo/{key}',
+        Name=name,
         Value=value,
         Type='String',
         Overwrite=True
     )
+    # Other warm containers pick the new value up when their cached copy expires
+    invalidate_ssm_cache(name)
     return response
 
 
+def invalidate_ssm_cache(name=None):
+    with _cache_lock:
+        if name is None:
+            _cache.clear()
+        else:
+            _cache.pop(name, None)
+
+
+def set_ssm_client(client):
+    """
+    Swaps the SSM client, e.g. for a local_ssm.LocalSSMClient, and clears the cache.
+    """
+    global ssm_client
+    ssm_client = client
+    invalidate_ssm_cache()
+
+
+def ssm_cache_stats():
+    with _cache_lock:
+        return {**_cache_stats, 'size': len(_cache)}
+
+
+def _cached_value(name, count_hit=True):
+    with _cache_lock:
+        entry = _cache.get(name)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        if count_hit:
+            _cache_stats['hits'] += 1
+        return entry[0]
+
+
+def _store(name, value):
+    with _cache_lock:
+        _cache[name] = (value, time.monotonic() + SSM_CACHE_TTL_SECONDS)
+
+
+def _count_ssm_call():
+    with _cache_lock:
+        _cache_stats['ssm_calls'] += 1
+
+
 def send_twiml(twiml):
     return {
         'statusCode': 200,
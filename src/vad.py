@@ -0,0 +1,136 @@
+import os
+import numpy as np
+from collections import deque
+
+# Frame energy above which the caller counts as speaking, and how far above the tracked noise floor it must be
+VAD_THRESHOLD_DBFS = float(os.environ.get('VAD_THRESHOLD_DBFS', '-35'))
+VAD_NOISE_MARGIN_DB = float(os.environ.get('VAD_NOISE_MARGIN_DB', '12'))
+# Speech must last this long before it counts, so clicks and coughs do not interrupt playback
+VAD_MIN_SPEECH_MS = int(os.environ.get('VAD_MIN_SPEECH_MS', '200'))
+# End of utterance: this much silence after speech, or the utterance reaching the max length
+VAD_END_SILENCE_MS = int(os.environ.get('VAD_END_SILENCE_MS', '700'))
+VAD_MAX_UTTERANCE_MS = int(os.environ.get('VAD_MAX_UTTERANCE_MS', '15000'))
+# Audio kept from before the onset so the first syllable is not cut off
+VAD_PRE_ROLL_MS = int(os.environ.get('VAD_PRE_ROLL_MS', '200'))
+
+MULAW_SAMPLE_RATE = 8000
+_NOISE_FLOOR_ALPHA = 0.05
+
+
+def _ulaw_decode_table():
+    """
+    16 bit linear value of every µ-law byte (G.711), the same values audioop.ulaw2lin gives.
+    """
+    u = ~np.arange(256, dtype=np.int32) & 0xFF
+    exponent = (u >> 4) & 0x07
+    magnitude = (((u & 0x0F) << 3) + 0x84 << exponent) - 0x84
+    return np.where(u & 0x80, -magnitude, magnitude).astype(np.int16)
+
+
+ULAW_DECODE_TABLE = _ulaw_decode_table()
+
+
+def decode_mulaw(mulaw_bytes):
+    return ULAW_DECODE_TABLE[np.frombuffer(mulaw_bytes, dtype=np.uint8)]
+
+
+def frame_dbfs(mulaw_bytes):
+    """
+    RMS level of a µ-law frame in dB relative to full scale, -inf for an empty frame.
+    """
+    if not mulaw_bytes:
+        return float('-inf')
+    samples = decode_mulaw(mulaw_bytes).astype(np.float64)
+    rms = np.sqrt(np.mean(samples * samples))
+    return 20 * np.log10(max(rms, 1.0) / 32768)
+
+
+class EnergyVad:
+    """
+    Energy voice activity detector for the inbound µ-law track.  A frame is speech when it is louder than both
+    the threshold and the tracked noise floor plus a margin.  push() reports speech onset once the caller has
+    been speaking for min_speech_ms without a break.
+    """
+
+    def __init__(self, threshold_dbfs=VAD_THRESHOLD_DBFS, margin_db=VAD_NOISE_MARGIN_DB,
+                 min_speech_ms=VAD_MIN_SPEECH_MS):
+        self.threshold_dbfs = threshold_dbfs
+        self.margin_db = margin_db
+        self.min_speech_ms = min_speech_ms
+        self.noise_floor_dbfs = threshold_dbfs - margin_db
+        self.speech_ms = 0.0
+
+    def is_speech(self, mulaw_bytes):
+        level = frame_dbfs(mulaw_bytes)
+        speech = level > max(self.threshold_dbfs, self.noise_floor_dbfs + self.margin_db)
+        if not speech and level > float('-inf'):
+            self.noise_floor_dbfs += _NOISE_FLOOR_ALPHA * (level - self.noise_floor_dbfs)
+        return speech
+
+    def push(self, mulaw_bytes):
+        """
+        Feeds one frame, returns True on the frame where speech onset is detected.
+        """
+        if not self.is_speech(mulaw_bytes):
+            self.speech_ms = 0.0
+            return False
+        before = self.speech_ms
+        self.speech_ms += len(mulaw_bytes) * 1000 / MULAW_SAMPLE_RATE
+        return before < self.min_speech_ms <= self.speech_ms
+
+    def reset(self):
+        self.speech_ms = 0.0
+
+
+class Endpointer:
+    """
+    Cuts the inbound µ-law track into utterances.  An utterance starts at speech onset, including the speech
+    before the onset was confirmed and some pre-roll, and ends after end_silence_ms of silence.
+    """
+
+    def __init__(self, detector=None, end_silence_ms=VAD_END_SILENCE_MS, max_utterance_ms=VAD_MAX_UTTERANCE_MS,
+                 pre_roll_ms=VAD_PRE_ROLL_MS):
+        self.detector = detector or EnergyVad()
+        self.end_silence_ms = end_silence_ms
+        self.max_utterance_bytes = max_utterance_ms * MULAW_SAMPLE_RATE // 1000
+        self.pre_roll_bytes = (pre_roll_ms + self.detector.min_speech_ms) * MULAW_SAMPLE_RATE // 1000
+        self.in_speech = False
+        self._pre_roll = deque()
+        self._pre_roll_size = 0
+        self._utterance = bytearray()
+        self._silence_ms = 0.0
+
+    def push(self, mulaw_bytes):
+        """
+        Feeds one frame, returns the whole utterance as µ-law bytes on the frame that ends it, otherwise None.
+        """
+        onset = self.detector.push(mulaw_bytes)
+        if not self.in_speech:
+            self._pre_roll.append(mulaw_bytes)
+            self._pre_roll_size += len(mulaw_bytes)
+            while self._pre_roll_size - len(self._pre_roll[0]) >= self.pre_roll_bytes:
+                self._pre_roll_size -= len(self._pre_roll.popleft())
+            if onset:
+                self.in_speech = True
+                self._utterance = bytearray(b''.join(self._pre_roll))
+                self._pre_roll.clear()
+                self._pre_roll_size = 0
+                self._silence_ms = 0.0
+            return None
+
+        self._utterance += mulaw_bytes
+        if self.detector.speech_ms > 0:
+            self._silence_ms = 0.0
+        else:
+            self._silence_ms += len(mulaw_bytes) * 1000 / MULAW_SAMPLE_RATE
+        if self._silence_ms >= self.end_silence_ms or len(self._utterance) >= self.max_utterance_bytes:
+            utterance = bytes(self._utterance)
+            self.reset()
+            return utterance
+        return None
+
+    def reset(self):
+        self.in_speech = False
+        self._utterance = bytearray()
+        self._silence_ms = 0.0
+        self.detector.reset()
@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import time
+import threading
+import numpy as np
+import metrics
+
+# Initialize logging
+import logging
+from loguru import logger
+
+logger.remove()
+logger.add(sys.stdout, format="{time} {level} {message}")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Serve retrieval from an in process copy of the PGVector collection instead of a query per question.  The
+# collection is small and changes rarely, it is loaded once and reloaded when its version changes.
+VECTOR_SNAPSHOT_ENABLED = os.environ.get('VECTOR_SNAPSHOT_ENABLED', 'false').lower() == 'true'
+# Optional directory with a saved snapshot, memory mapped at start so a cold start skips the full load, e.g.
+# baked into the image.  A snapshot loaded from the database is saved there when it is writable.
+VECTOR_SNAPSHOT_PATH = os.environ.get('VECTOR_SNAPSHOT_PATH', '')
+# How often the collection version is checked against the database, in the background
+VECTOR_SNAPSHOT_CHECK_SECONDS = float(os.environ.get('VECTOR_SNAPSHOT_CHECK_SECONDS', '300'))
+VECTOR_SNAPSHOT_COLLECTION = os.environ.get('VECTOR_SNAPSHOT_COLLECTION', 'sfscdemo')
+
+# The same k as PGVector.as_retriever()
+DEFAULT_K = 4
+
+_MATRIX_FILE = 'embeddings.npy'
+_DOCUMENTS_FILE = 'documents.json'
+
+# langchain's PGVector tables.  The version is a hash over the whole rows, so it changes with every added,
+# removed or updated row, also an in place update of the document, metadata or embedding.  It reads every
+# embedding, fine for a small collection checked every few minutes.
+_VERSION_SQL = """
+    SELECT count(*), coalesce(md5(string_agg(md5(e::text), ',' ORDER BY e.uuid)), '')
+    FROM langchain_pg_embedding e JOIN langchain_pg_collection c ON e.collection_id = c.uuid
+    WHERE c.name = :collection
+"""
+_ROWS_SQL = """
+    SELECT e.document, e.cmetadata, e.embedding::text
+    FROM langchain_pg_embedding e JOIN langchain_pg_collection c ON e.collection_id = c.uuid
+    WHERE c.name = :collection
+    ORDER BY e.uuid
+"""
+
+
+class VectorSnapshot:
+    """
+    Embeddings of a collection as one float32 matrix of unit rows, and the (page_content, metadata) of each row.
+    search() ranks like PGVector's default cosine distance.
+    """
+
+    def __init__(self, version, matrix, documents):
+        self.version = version
+        self.matrix = matrix
+        self.documents = documents
+
+    @classmethod
+    def from_rows(cls, version, rows):
+        """
+        :param rows: (page_content, metadata, embedding) per document
+        """
+        documents = [(content, metadata or {}) for content, metadata, _ in rows]
+        if not rows:
+            return cls(version, np.zeros((0, 0), dtype=np.float32), documents)
+        matrix = np.asarray([embedding for _, _, embedding in rows], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return cls(version, matrix / np.maximum(norms, np.finfo(np.float32).tiny), documents)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def search(self, embedding, k=DEFAULT_K):
+        """
+        Returns [(index, cosine distance)] of the k nearest documents, nearest first.
+        """
+        if not len(self):
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        similarities = self.matrix @ (query / max(float(np.linalg.norm(query)), np.finfo(np.float32).tiny))
+        k = min(k, len(similarities))
+        # argpartition finds the top k without sorting the whole collection, then only those k are sorted
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top], kind='stable')]
+        return [(int(index), 1.0 - float(similarities[index])) for index in top]
+
+    def save(self, path):
+        # Written next to the target and renamed over it, an older snapshot may still be memory mapped from there
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, _MATRIX_FILE + '.tmp'), 'wb') as f:
+            np.save(f, self.matrix)
+        with open(os.path.join(path, _DOCUMENTS_FILE + '.tmp'), 'w') as f:
+            json.dump({'version': self.version, 'documents': self.documents}, f)
+        os.replace(os.path.join(path, _MATRIX_FILE + '.tmp'), os.path.join(path, _MATRIX_FILE))
+        os.replace(os.path.join(path, _DOCUMENTS_FILE + '.tmp'), os.path.join(path, _DOCUMENTS_FILE))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a saved snapshot with the matrix memory mapped, pages are read as searches touch them.
+        """
+        with open(os.path.join(path, _DOCUMENTS_FILE)) as f:
+            saved = json.load(f)
+        matrix = np.load(os.path.join(path, _MATRIX_FILE), mmap_mode='r')
+        return cls(saved['version'], matrix, [tuple(document) for document in saved['documents']])
+
+
+def parse_vector(text):
+    """
+    Parses pgvector's text form, e.g. '[0.1,0.2,0.3]'.
+    """
+    return np.array(text.strip('[]').split(','), dtype=np.float32)
+
+
+def database_version(connection, collection=VECTOR_SNAPSHOT_COLLECTION):
+    import sqlalchemy
+    count, digest = connection.execute(sqlalchemy.text(_VERSION_SQL), {'collection': collection}).one()
+    return f'{count}:{digest}'
+
+
+def load_from_database(connection, collection=VECTOR_SNAPSHOT_COLLECTION):
+    import sqlalchemy
+    with metrics.span('vector_snapshot_load'):
+        version = database_version(connection, collection)
+        rows = [(document, metadata, parse_vector(embedding)) for document, metadata, embedding in
+                connection.execute(sqlalchemy.text(_ROWS_SQL), {'collection': collection})]
+        snapshot = VectorSnapshot.from_rows(version, rows)
+    logger.info(f"Loaded vector snapshot of {collection}: {len(snapshot)} documents, version {version}")
+    return snapshot
+
+
+class SnapshotStore:
+    """
+    The current snapshot of a collection.  Searches never wait on the database once a snapshot is loaded, the
+    version check runs in a background thread at most every check_seconds and swaps in a new snapshot.
+    """
+
+    def __init__(self, connect, collection=VECTOR_SNAPSHOT_COLLECTION, path=VECTOR_SNAPSHOT_PATH,
+                 check_seconds=VECTOR_SNAPSHOT_CHECK_SECONDS):
+        """
+        :param connect: returns a SQLAlchemy connection context manager, e.g. engine.connect
+        """
+        self.connect = connect
+        self.collection = collection
+        self.path = path
+        self.check_seconds = check_seconds
+        self._snapshot = None
+        self._next_check = 0.0
+        self._checking = False
+        self._lock = threading.Lock()
+
+    def current(self):
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = self._initial_snapshot()
+            snapshot = self._snapshot
+            check = not self._checking and time.monotonic() >= self._next_check
+            if check:
+                self._checking = True
+        if check:
+            threading.Thread(target=self._check, name='vector-snapshot-check', daemon=True).start()
+        return snapshot
+
+    def search(self, embedding, k=DEFAULT_K):
+        """
+        Returns [(page_content, metadata, cosine distance)] of the k nearest documents, nearest first.
+        """
+        snapshot = self.current()
+        with metrics.span('vector_snapshot_search', documents=len(snapshot)):
+            return [snapshot.documents[index] + (distance,) for index, distance in snapshot.search(embedding, k)]
+
+    def refresh(self):
+        """
+        Reloads the snapshot when the database has a new version, returns True when it did.
+        """
+        with self.connect() as connection:
+            version = database_version(connection, self.collection)
+            if self._snapshot is not None and version == self._snapshot.version:
+                return False
+            snapshot = load_from_database(connection, self.collection)
+        self._save(snapshot)
+        with self._lock:
+            self._snapshot = snapshot
+        metrics.count('vector_snapshot_refresh')
+        return True
+
+    def _initial_snapshot(self):
+        if self.path and os.path.exists(os.path.join(self.path, _DOCUMENTS_FILE)):
+            snapshot = VectorSnapshot.load(self.path)
+            logger.info(f"Loaded saved vector snapshot {self.path}: {len(snapshot)} documents")
+            # The first search checks the version right away, the saved copy may be older than the database
+            return snapshot
+        with self.connect() as connection:
+            snapshot = load_from_database(connection, self.collection)
+        self._save(snapshot)
+        self._next_check = time.monotonic() + self.check_seconds
+        return snapshot
+
+    def _check(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"Vector snapshot version check failed, keeping the current snapshot: {e}")
+        finally:
+            with self._lock:
+                self._next_check = time.monotonic() + self.check_seconds
+                self._checking = False
+
+    def _save(self, snapshot):
+        if not self.path:
+            return
+        try:
+            snapshot.save(self.path)
+        except OSError as e:
+            logger.warning(f"Could not save vector snapshot to {self.path}: {e}")
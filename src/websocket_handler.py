@@ -1,36 +1,111 @@
+import os
 import sys
 import boto3
 import base64
-import eleven
-import twilioumd
+import time
+import threading
 import utils
 import json
 import audioconvert
+import audio_cache
+import streampipeline
+import sentences
+import metrics
+import cancellation
+import vad
+import conversation
+import fillers
+import deadlines
+import transport
 import re
 # Initialize logging
 import logging
 from loguru import logger
-from aws_xray_sdk.core import xray_recorder
 
 logger.remove()
 logger.add(sys.stdout, format="{time} {level} {message}")
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-client = boto3.client('apigatewaymanagementapi',
-                      endpoint_url=f"https://{utils.get_ssm_param('apiSandboxWebsocketBase')}/sandbox")
+# The API Gateway management client and audio cache are created on first use, and eleven labs and twilio are
+# imported by the events that need them, so a cold start for a mark event does not pay for text to speech
+_client = None
+_client_lock = threading.Lock()
+
+# Pipelined mode overlaps reading eleven labs, converting and posting to API Gateway
+PIPELINE_ENABLED = os.environ.get('STREAM_PIPELINE', 'false').lower() == 'true'
+PIPELINE_QUEUE_SIZE = int(os.environ.get('STREAM_PIPELINE_QUEUE_SIZE', '8'))
+PIPELINE_POSTERS = int(os.environ.get('STREAM_PIPELINE_POSTERS', '1'))
+
+# Coalescing mode batches frames into fewer, larger media messages after the first one
+COALESCE_ENABLED = os.environ.get('STREAM_COALESCE', 'false').lower() == 'true'
+COALESCE_MAX_MS = int(os.environ.get('STREAM_COALESCE_MAX_MS', '400'))
+COALESCE_MAX_BYTES = int(os.environ.get('STREAM_COALESCE_MAX_BYTES', '0'))
+API_GATEWAY_MAX_FRAME_BYTES = 32 * 1024  # API Gateway websocket frame size limit
+
+# Silence trimming drops the near silence eleven labs starts with and collapses the silence before the mark, so
+# the caller hears the first word sooner and the mark comes back sooner.  Optionally normalizes the loudness.
+TRIM_SILENCE_ENABLED = os.environ.get('TRIM_SILENCE', 'false').lower() == 'true'
+TRIM_THRESHOLD_DBFS = float(os.environ.get('TRIM_THRESHOLD_DBFS', '-50'))
+TRIM_PRE_ROLL_MS = int(os.environ.get('TRIM_PRE_ROLL_MS', '80'))  # kept before the first word so it is not cut
+TRIM_TRAILING_KEEP_MS = int(os.environ.get('TRIM_TRAILING_KEEP_MS', '60'))
+TRIM_MAX_PAUSE_MS = int(os.environ.get('TRIM_MAX_PAUSE_MS', '500'))  # longer pauses between words are cut
+# e.g. -20, empty leaves the level as synthesized
+NORMALIZE_TARGET_DBFS = os.environ.get('NORMALIZE_TARGET_DBFS', '')
+NORMALIZE_MAX_GAIN_DB = float(os.environ.get('NORMALIZE_MAX_GAIN_DB', '12'))
+
+# Barge in: the VAD runs on the inbound track and speech cancels the audio being played.  Stop events and
+# closed connections always cancel.  On Lambda the start event streams in another container than the media
+# events, so barge in needs CANCEL_BACKEND=dynamodb and is turned off without it.  The VAD state is per
+# container too, a stream's frames spread over containers each see part of the speech and detect it later.
+BARGE_IN_ENABLED = os.environ.get('BARGE_IN', 'false').lower() == 'true'
+if BARGE_IN_ENABLED and conversation.ON_LAMBDA and cancellation.CANCEL_BACKEND != 'dynamodb':
+    logger.warning("BARGE_IN on Lambda needs CANCEL_BACKEND=dynamodb, the start event would never see the "
+                   "cancel, barge in is off")
+    BARGE_IN_ENABLED = False
+_MAX_TRACKED_STREAMS = 1000
+
+# Inbound VAD state per stream sid, kept between media events that land in this container
+_inbound_vads = {}
+_inbound_vads_lock = threading.Lock()
+
+# Overrides the management API endpoint derived from apiSandboxWebsocketBase, e.g. for bench/loadsim.py
+APIGATEWAY_ENDPOINT_URL = os.environ.get('APIGATEWAY_ENDPOINT_URL')
+
+# Final µ-law audio of text already synthesized
+_audio_cache = None
+_audio_cache_created = False
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            endpoint_url = APIGATEWAY_ENDPOINT_URL or f"https://{utils.get_ssm_param('apiSandboxWebsocketBase')}/sandbox"
+            _client = boto3.client('apigatewaymanagementapi', endpoint_url=endpoint_url)
+        return _client
+
+
+def get_audio_cache():
+    """
+    Returns the audio cache, or None when it is turned off.
+    """
+    global _audio_cache, _audio_cache_created
+    with _client_lock:
+        if not _audio_cache_created:
+            _audio_cache = audio_cache.create_audio_cache()
+            _audio_cache_created = True
+        return _audio_cache
 
 
 def handle(event):
     #logger.info(f"Websocket accepted event: {event}")
 
-    twilio_event_type = None
-
     if 'event' in event:
-        twilio_event_type = event['event']
+        body = event
     else:
         body = json.loads(event['body'])
-        twilio_event_type = body['event']
+    twilio_event_type = body['event']
 
     try:
         if twilio_event_type == "start":
@@ -39,62 +114,486 @@ def handle(event):
             call_sid = body['start']['callSid']
             aws_websocket_connection_id = event["requestContext"]["connectionId"]
             stream_sid = body['streamSid']
-            textToSay = body['start']['customParameters']['textToSay']
-            xray_recorder.begin_subsegment('stream_audio')
-            xray_recorder.put_metadata('stream_audio_text', textToSay)
-            stream_audio(stream_sid, aws_websocket_connection_id, textToSay, call_sid)
-            xray_recorder.end_subsegment()
+            custom_parameters = body['start']['customParameters']
+            if custom_parameters.get('mode') == 'conversation' and not conversation.ON_LAMBDA:
+                # The stream stays open for the whole call, the session answers each utterance on it
+                conversation.start_session(stream_sid, call_sid, aws_websocket_connection_id,
+                                           custom_parameters.get('textToSay'))
+            elif 'question' in custom_parameters:
+                # Streaming answer mode, the answer is generated here and spoken sentence by sentence
+                deadline = stream_deadline(custom_parameters)
+                with metrics.span('stream_duration', call_sid=call_sid, mode='answer') as span:
+                    span.put_metadata('stream_answer_question', custom_parameters['question'])
+                    stream_answer_audio(stream_sid, aws_websocket_connection_id, custom_parameters['question'],
+                                        call_sid, deadline=deadline)
+            else:
+                # Also a conversation stream that reached Lambda, the greeting's mark goes back to the gather
+                textToSay = custom_parameters['textToSay']
+                deadline = stream_deadline(custom_parameters)
+                with metrics.span('stream_duration', call_sid=call_sid, mode='text') as span:
+                    span.put_metadata('stream_audio_text', textToSay)
+                    stream_audio(stream_sid, aws_websocket_connection_id, textToSay, call_sid, deadline=deadline)
         elif twilio_event_type == "mark":
             logger.info("Mark event received")
-            eoa_call_sid = event["mark"]["name"]
-            call_sid = re.match(r'eoaCallSid(.+)', eoa_call_sid)[1]
+            mark_name = body["mark"]["name"]
+            match = re.match(r'eoaCallSid(.+)', mark_name)
+            if match is None:
+                # A conversation turn finished playing, the stream stays open
+                session = conversation.get_session(body.get('streamSid'))
+                if session is not None:
+                    session.on_mark(mark_name)
+                return
+            call_sid = match[1]
             logger.info("Marked end of audio and redirecting back to main answer handler")
-            xray_recorder.begin_subsegment('redirect_at_end_of_audio')
-            twilioumd.twilio_redirect_twiml(call_sid)
-            xray_recorder.end_subsegment()
+            with metrics.span('mark_to_redirect', call_sid=call_sid):
+                import twilioumd
+                twilioumd.twilio_redirect_twiml(call_sid)
+        elif twilio_event_type == "media":
+            session = conversation.get_session(body['streamSid'])
+            if session is not None:
+                if body['media'].get('track', 'inbound') == 'inbound':
+                    session.on_media(base64.b64decode(body['media']['payload']))
+            elif BARGE_IN_ENABLED:
+                detect_barge_in(body, event["requestContext"]["connectionId"])
+        elif twilio_event_type == "stop":
+            logger.info("Stop event received")
+            stream_sid = body['streamSid']
+            conversation.end_session(stream_sid)
+            with _inbound_vads_lock:
+                _inbound_vads.pop(stream_sid, None)
+            # Hang up or redirect, anything still streaming to this stream is wasted
+            cancellation.request_cancel(stream_sid, cancellation.STOP)
     except Exception as e:
         logger.error(f"An exception occurred: {str(e)}")
 
 
-def stream_audio(stream_sid, aws_websocket_connection_id, textToSay, call_sid):
-    audio_stream = eleven.say_stream(textToSay)
+def stream_deadline(custom_parameters):
+    """
+    The turn deadline the respond handler passed as deadlineAt, or a new one.  None when deadlines are off.
+    """
+    if 'deadlineAt' in custom_parameters:
+        return deadlines.Deadline.at(custom_parameters['deadlineAt'])
+    return deadlines.for_turn()
+
+
+def stream_audio(stream_sid, aws_websocket_connection_id, textToSay, call_sid, cancel=None, mark_name=None,
+                 deadline=None):
+    """
+    Speaks text on the stream and ends it with a mark.
+    :param cancel: optional cancellation.CancelToken, by default one for the stream sid
+    :param mark_name: optional mark name, by default the eoaCallSid mark that redirects the call to the gather
+    :param deadline: optional deadlines.Deadline of the turn, text to speech gets at least DEADLINE_TTS_MIN_MS of
+                     it for its first audio and is hedged when slow.  When it misses, the fallback audio plays.
+    """
+    import eleven
+
+    on_posted = first_frame_recorder(metrics.Stopwatch(), call_sid=call_sid, mode='text')
+    cancel = cancel or cancellation.CancelToken(stream_sid)
+    message_builder = MediaMessageBuilder(stream_sid)
+    cache = get_audio_cache()
+
+    key = None
+    if cache is not None:
+        key = audio_cache.cache_key(textToSay, **eleven.synthesis_params())
+        cached_audio = cache.get(key)
+        metrics.count('audio_cache_hit', int(cached_audio is not None))
+        if cached_audio is not None:
+            logger.info(f"Audio cache hit, streaming {len(cached_audio)} cached bytes without calling eleven labs")
+            post_payloads(aws_websocket_connection_id, message_builder,
+                          coalesce_frames([cached_audio], coalesce_max_bytes(message_builder)), on_posted, cancel)
+            finish_stream(stream_sid, aws_websocket_connection_id, call_sid, cancel, mark_name)
+            return
+
+    rendered_frames = [] if key is not None else None
+    tts_deadline = deadline.at_least(deadlines.DEADLINE_TTS_MIN_MS) if deadline is not None else None
+    audio_stream = eleven.say_stream_parallel(textToSay, deadline=tts_deadline) if eleven.TTS_PARALLEL_ENABLED \
+        else eleven.say_stream(textToSay, deadline=tts_deadline)
+    try:
+        stream_chunks(aws_websocket_connection_id, message_builder, audio_stream, rendered_frames, on_posted,
+                      cancel)
+    except deadlines.DeadlineExceeded:
+        logger.warning(f"No audio from eleven labs within the deadline, playing the fallback audio")
+        metrics.count('deadline_fallback', stage='tts', call_sid=call_sid)
+        post_fallback_audio(aws_websocket_connection_id, message_builder, on_posted, cancel)
+        key = None
+
+    # Only complete audio goes in the cache
+    if key is not None and cancel.reason is None:
+        cache.put(key, b''.join(rendered_frames))
+
+    finish_stream(stream_sid, aws_websocket_connection_id, call_sid, cancel, mark_name)
+
+
+def post_fallback_audio(aws_websocket_connection_id, message_builder, on_posted, cancel):
+    """
+    Plays the canned answer audio after a missed deadline.  Returns False when there is no fallback audio.
+    """
+    fallback_audio = deadlines.get_fallback_audio()
+    if fallback_audio is None:
+        return False
+    post_payloads(aws_websocket_connection_id, message_builder,
+                  coalesce_frames([fallback_audio], coalesce_max_bytes(message_builder)), on_posted, cancel)
+    return True
+
+
+def stream_answer_audio(stream_sid, aws_websocket_connection_id, question, call_sid, cancel=None, mark_name=None,
+                        deadline=None):
+    """
+    Pulls the answer from the LLM as it streams and sends each sentence to eleven labs as soon as it is complete,
+    so the caller hears the first sentence while the rest is still being generated.  cancel and mark_name are
+    as for stream_audio.
+    :param deadline: optional deadlines.Deadline of the turn.  The first sentence is hedged and bounded by it,
+                     then its audio like in stream_audio.  When either misses, the fallback audio plays.
+    """
+    # Imported here so plain text-to-speech events do not pay for loading langchain
+    import query_lambda
+    import eleven
+
+    stopwatch = metrics.Stopwatch()
+    on_posted = first_frame_recorder(stopwatch, call_sid=call_sid, mode='answer')
+    cancel = cancel or cancellation.CancelToken(stream_sid)
+    message_builder = MediaMessageBuilder(stream_sid)
+
+    # The stage waiting on its first output, for the fallback metric when the deadline passes
+    stage = ['llm']
+
+    def open_sentences():
+        return sentences.iter_sentences(query_lambda.stream_answer(question))
+
+    def sentence_audio():
+        first_sentence = True
+        answer_sentences = open_sentences() if deadline is None else deadlines.hedged_stream(
+            open_sentences, deadline, deadlines.HEDGE_LLM_AFTER_MS, stage='llm')
+        filler_set = fillers.get_fillers()
+        if filler_set is not None:
+            answer_sentences = fillers.mask_latency(
+                answer_sentences, filler_player(aws_websocket_connection_id, message_builder, on_posted, cancel),
+                filler_set, call_sid=call_sid)
+        for sentence in answer_sentences:
+            tts_deadline = None
+            if first_sentence:
+                first_sentence = False
+                # The streaming counterpart of speech_to_answer_ms, speech can start once this sentence is done
+                metrics.record('speech_to_first_sentence_ms', stopwatch.elapsed_ms(), call_sid=call_sid)
+                if deadline is not None:
+                    # The budget is to the first audio, the later sentences are not bounded
+                    stage[0] = 'tts'
+                    tts_deadline = deadline.at_least(deadlines.DEADLINE_TTS_MIN_MS)
+            logger.info(f"Speaking answer sentence: {sentence}")
+            yield from eleven.say_stream(sentence, deadline=tts_deadline)
+
+    try:
+        stream_chunks(aws_websocket_connection_id, message_builder, sentence_audio(), on_posted=on_posted,
+                      cancel=cancel)
+    except deadlines.DeadlineExceeded:
+        logger.warning(f"No answer audio within the deadline ({stage[0]}), playing the fallback audio")
+        metrics.count('deadline_fallback', stage=stage[0], call_sid=call_sid)
+        if not post_fallback_audio(aws_websocket_connection_id, message_builder, on_posted, cancel) and \
+                stage[0] == 'llm':
+            # Like the canned answer of query_chatgpt, spoken when there is no audio for it
+            stream_chunks(aws_websocket_connection_id, message_builder,
+                          eleven.say_stream(deadlines.DEADLINE_FALLBACK_ANSWER), on_posted=on_posted, cancel=cancel)
+    finish_stream(stream_sid, aws_websocket_connection_id, call_sid, cancel, mark_name)
+
+
+def stream_chunks(aws_websocket_connection_id, message_builder, audio_stream, recorded_frames=None,
+                  on_posted=None, cancel=None):
+    """
+    Converts, frames and posts an eleven labs audio stream, pipelined or serially depending on the config.
+    :param recorded_frames: optional list that gets every posted frame, e.g. to fill the audio cache
+    :param on_posted: optional callback run after each media message is posted
+    :param cancel: optional cancellation.CancelToken, posting stops once it is set and the eleven labs request
+                   is closed so no more audio is generated
+    """
+
+    def send(message_str):
+        try:
+            post_to_connection(aws_websocket_connection_id, message_str)
+        except Exception as e:
+            if cancel is not None and is_gone(e):
+                cancel.cancel(cancellation.GONE)
+            raise
+        if on_posted is not None:
+            on_posted()
+
+    def to_payloads(chunks):
+        frames = convert_to_frames(chunks)
+        if recorded_frames is not None:
+            frames = record_frames(frames, recorded_frames)
+        if COALESCE_ENABLED:
+            return coalesce_frames(frames, coalesce_max_bytes(message_builder))
+        return frames
 
     logger.info("Started eleven labs audio stream")
-    for chunk in audio_stream:
-        if chunk is not None:
-            try:
+    try:
+        if PIPELINE_ENABLED:
+            # Fetch, convert and post overlap.  Frames are still posted in order and the mark waits for all of them.
+            streampipeline.run_pipeline(
+                audio_stream,
+                to_payloads,
+                message_builder.build,
+                send,
+                queue_size=PIPELINE_QUEUE_SIZE,
+                posters=PIPELINE_POSTERS,
+                cancel=cancel)
+        else:
+            post_payloads(aws_websocket_connection_id, message_builder, to_payloads(audio_stream), on_posted, cancel)
+    finally:
+        # Aborts the upstream HTTP stream (and a streaming answer) when we stopped early, no-op once it is done
+        close = getattr(audio_stream, 'close', None)
+        if close is not None:
+            close()
 
-                mulaw_bytes = audioconvert.convert_eleven_pcm_chunk_to_twilio_mulaw(chunk)
 
-                message = {
-                    "event": "media",
-                    "streamSid": stream_sid,
-                    "media": {
-                        "payload": base64.b64encode(mulaw_bytes).decode('utf-8')
-                    }
-                }
-                message_str = json.dumps(message)
+def filler_player(aws_websocket_connection_id, message_builder, on_posted=None, cancel=None):
+    """
+    Returns a callback that posts filler µ-law audio to the stream, for fillers.mask_latency.
+    """
 
-                client.post_to_connection(
-                    ConnectionId=aws_websocket_connection_id,
-                    Data=message_str
-                )
+    def play(mulaw_audio):
+        post_payloads(aws_websocket_connection_id, message_builder,
+                      coalesce_frames([mulaw_audio], coalesce_max_bytes(message_builder)), on_posted, cancel)
 
-            except Exception as e:
-                logger.error(f"Error in audio processing: {e}")
+    return play
 
+
+def send_mark(stream_sid, aws_websocket_connection_id, call_sid, mark_name=None):
     logger.info(f"Done streaming audio. Sending mark event to mark end of stream")
     mark = {
         "event": "mark",
         "streamSid": stream_sid,
         "mark": {
-            "name": f"eoaCallSid{call_sid}"
+            "name": mark_name or f"eoaCallSid{call_sid}"
         }
     }
     message_str = json.dumps(mark)
     logger.info(f"Mark message dump: {message_str}")
 
-    client.post_to_connection(
-        ConnectionId=aws_websocket_connection_id,
-        Data=message_str
-    )
+    post_to_connection(aws_websocket_connection_id, message_str)
+
+
+def post_payloads(aws_websocket_connection_id, message_builder, payloads, on_posted=None, cancel=None):
+    for payload in payloads:
+        if cancel is not None and cancel.is_set():
+            break
+        try:
+            post_to_connection(aws_websocket_connection_id, message_builder.build(payload))
+            if on_posted is not None:
+                on_posted()
+        except Exception as e:
+            if cancel is not None and is_gone(e):
+                cancel.cancel(cancellation.GONE)
+            logger.error(f"Error in audio processing: {e}")
+
+
+def finish_stream(stream_sid, aws_websocket_connection_id, call_sid, cancel, mark_name=None):
+    """
+    Ends the stream with the mark that sends the call back to the gather, or the turn's mark in conversation
+    mode.  After a barge in Twilio is first told to drop the audio it still has buffered, after a stop or a
+    closed connection there is nobody to tell.
+    """
+    if cancel.reason is None:
+        send_mark(stream_sid, aws_websocket_connection_id, call_sid, mark_name)
+        return
+
+    logger.info(f"Stream {stream_sid} cancelled: {cancel.reason}")
+    metrics.count('stream_cancelled', reason=cancel.reason, call_sid=call_sid)
+    metrics.record('cancel_latency_ms', (time.time() - cancel.requested_at) * 1000, reason=cancel.reason)
+    if cancel.reason in (cancellation.STOP, cancellation.GONE):
+        return
+    send_clear(stream_sid, aws_websocket_connection_id)
+    send_mark(stream_sid, aws_websocket_connection_id, call_sid, mark_name)
+
+
+def detect_barge_in(body, aws_websocket_connection_id):
+    """
+    Runs the VAD over an inbound media frame.  On speech onset playback of the stream is cancelled and Twilio
+    drops what it has buffered right away, also when the start event already posted all the audio.
+    """
+    media = body['media']
+    if media.get('track', 'inbound') != 'inbound':
+        return
+    stream_sid = body['streamSid']
+    with _inbound_vads_lock:
+        detector = _inbound_vads.get(stream_sid)
+        if detector is None:
+            if len(_inbound_vads) >= _MAX_TRACKED_STREAMS:
+                _inbound_vads.clear()
+            detector = _inbound_vads[stream_sid] = vad.EnergyVad()
+    if not detector.push(base64.b64decode(media['payload'])):
+        return
+
+    logger.info(f"Caller started speaking on stream {stream_sid}, cancelling playback")
+    metrics.count('barge_in_detected')
+    cancellation.request_cancel(stream_sid, cancellation.BARGE_IN)
+    send_clear(stream_sid, aws_websocket_connection_id)
+
+
+def send_clear(stream_sid, aws_websocket_connection_id):
+    try:
+        post_to_connection(aws_websocket_connection_id, json.dumps({"event": "clear", "streamSid": stream_sid}))
+    except Exception as e:
+        logger.error(f"Error sending clear: {e}")
+
+
+def is_gone(error):
+    """
+    True when the websocket connection is closed, e.g. the caller hung up.
+    """
+    if isinstance(error, transport.ConnectionGone):
+        return True
+    return getattr(error, 'response', {}).get('Error', {}).get('Code') == 'GoneException'
+
+
+def first_frame_recorder(stopwatch, **properties):
+    """
+    Returns an on_posted callback that records first_frame_posted_ms the first time it is called.
+    """
+    lock = threading.Lock()
+    recorded = []
+
+    def on_posted():
+        with lock:
+            if recorded:
+                return
+            recorded.append(True)
+        metrics.record(metrics.FIRST_FRAME_POSTED, stopwatch.elapsed_ms(), **properties)
+
+    return on_posted
+
+
+def prewarm_audio_cache(phrases):
+    """
+    Synthesizes and caches known phrases, e.g. the greeting, at deploy time so calls never wait on TTS for them.
+    Set AUDIO_CACHE_S3_BUCKET so the entries land in the shared tier every container reads.
+    """
+    import eleven
+
+    cache = get_audio_cache()
+    if cache is None:
+        raise ValueError("Audio cache is disabled, set AUDIO_CACHE_ENABLED=true to pre-warm it")
+
+    warmed = []
+    for phrase in phrases:
+        key = audio_cache.cache_key(phrase, **eleven.synthesis_params())
+        if cache.get(key) is None:
+            cache.put(key, b''.join(convert_to_frames(eleven.say_stream(phrase))))
+            warmed.append(phrase)
+    logger.info(f"Pre-warmed audio cache with {len(warmed)} of {len(phrases)} phrases")
+    return {'warmed': warmed, 'alreadyCached': len(phrases) - len(warmed)}
+
+
+def convert_to_frames(audio_stream, output_format=None):
+    """
+    Converts eleven labs chunks to frame aligned µ-law payloads.  One converter and packetizer per call so
+    the resampling filter state and any partial frame carry across chunk boundaries.  Ends with the filter tail
+    and a silence padded last frame so everything is out before the mark.  µ-law output from eleven labs
+    is only framed, there is no transcoding.
+    """
+    import eleven
+
+    converter = audioconvert.converter_for_format(output_format or eleven.OUTPUT_FORMAT)
+    packetizer = audioconvert.FramePacketizer()
+    trimmer = create_silence_trimmer()
+    for chunk in audio_stream:
+        if chunk is not None:
+            frames = packetizer.push(converter.convert(chunk))
+            if trimmer is not None:
+                frames = trimmer.push(frames)
+            if frames:
+                yield frames
+
+    frames = packetizer.push(converter.flush()) + packetizer.flush()
+    if trimmer is not None:
+        frames = trimmer.push(frames) + trimmer.flush()
+        for position, trimmed_ms in trimmer.trimmed_ms.items():
+            metrics.record('silence_trimmed_ms', trimmed_ms, position=position)
+    if frames:
+        yield frames
+
+
+def silence_trim_params():
+    """
+    The trimming and normalization settings, None when trimming is off.  Part of the audio cache key, the cached
+    audio is trimmed.
+    """
+    if not TRIM_SILENCE_ENABLED:
+        return None
+    return {
+        'threshold_dbfs': TRIM_THRESHOLD_DBFS,
+        'pre_roll_ms': TRIM_PRE_ROLL_MS,
+        'trailing_keep_ms': TRIM_TRAILING_KEEP_MS,
+        'max_pause_ms': TRIM_MAX_PAUSE_MS,
+        'target_dbfs': float(NORMALIZE_TARGET_DBFS) if NORMALIZE_TARGET_DBFS else None,
+        'max_gain_db': NORMALIZE_MAX_GAIN_DB,
+    }
+
+
+def create_silence_trimmer():
+    """
+    Returns a SilenceTrimmer for one stream, or None when trimming is off.
+    """
+    params = silence_trim_params()
+    return audioconvert.SilenceTrimmer(**params) if params is not None else None
+
+
+def record_frames(frames, recorded):
+    for frames_bytes in frames:
+        recorded.append(frames_bytes)
+        yield frames_bytes
+
+
+def coalesce_frames(frames, max_bytes):
+    """
+    Batches frame aligned payloads into fewer media messages.  The first frames go out right away to keep the
+    time to first audio low, after that the batch size doubles per message up to max_bytes.  Twilio has
+    audio buffered by then, so waiting for a bigger batch does not starve playback.
+    """
+    frame_bytes = audioconvert.TWILIO_FRAME_BYTES
+    max_bytes = max(frame_bytes, max_bytes - max_bytes % frame_bytes)
+    target = 0
+    buffer = bytearray()
+    for payload in frames:
+        buffer += payload
+        while buffer and len(buffer) >= target:
+            size = min(len(buffer), max_bytes)
+            yield bytes(buffer[:size])
+            del buffer[:size]
+            target = min(max(target * 2, frame_bytes * 2), max_bytes)
+
+    while buffer:
+        size = min(len(buffer), max_bytes)
+        yield bytes(buffer[:size])
+        del buffer[:size]
+
+
+def coalesce_max_bytes(message_builder):
+    """
+    Batch size limit from STREAM_COALESCE_MAX_BYTES or STREAM_COALESCE_MAX_MS, capped so the base64 message
+    still fits in one API Gateway websocket frame.
+    """
+    max_bytes = COALESCE_MAX_BYTES or COALESCE_MAX_MS * audioconvert.TWILIO_SAMPLE_RATE // 1000
+    return min(max_bytes, message_builder.max_payload_bytes(API_GATEWAY_MAX_FRAME_BYTES))
+
+
+class MediaMessageBuilder:
+    """
+    Builds Twilio media messages from a template instead of json.dumps on a new dict for every frame.
+    The output is the same string json.dumps gives for the media message dict.
+    """
+
+    def __init__(self, stream_sid):
+        self._prefix = '{"event": "media", "streamSid": ' + json.dumps(stream_sid) + ', "media": {"payload": "'
+        self._suffix = '"}}'
+
+    def build(self, mulaw_bytes):
+        return self._prefix + base64.b64encode(mulaw_bytes).decode('ascii') + self._suffix
+
+    def max_payload_bytes(self, max_message_bytes):
+        return (max_message_bytes - len(self._prefix) - len(self._suffix)) // 4 * 3
+
+
+def post_to_connection(aws_websocket_connection_id, message_str):
+    # API Gateway unless server mode set the transport to its own websockets
+    transport.get_transport(lambda: transport.ApiGatewayTransport(get_client)).post(
+        aws_websocket_connection_id, message_str)